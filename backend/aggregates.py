@@ -0,0 +1,244 @@
+"""Server-side detection statistics.
+
+Dashboard numbers (totals, per-day and per-site counts, confidence
+histograms) come from `detection_rollups`: one small document per
+(UTC day, site) holding image/tree counts, a confidence sum and the
+confidence histogram. The write-behind `DetectionWriter` bumps them with
+`$inc` upserts right after each batch is inserted, so a stats request runs an
+aggregation pipeline over a few hundred rollup documents instead of every
+detection record.
+
+`rebuild_rollups` recomputes the whole collection from `detections` with one
+aggregation pipeline; it runs when the rollups are missing and can be
+triggered through `POST /admin/rollups/rebuild` if they ever drift (e.g. the
+process died between an insert and its rollup update).
+"""
+from collections import defaultdict
+from datetime import timezone
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from geometry import CONF_BINS
+
+UNASSIGNED_SITE = "unassigned"
+BIN_KEYS = [f"b{i:02d}" for i in range(CONF_BINS)]
+
+_DAY = "%Y-%m-%d"
+
+
+def day_of(ts) -> str:
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc)
+    return ts.strftime(_DAY)
+
+
+def rollup_id(day, site) -> str:
+    return f"{day}|{site}"
+
+
+def ensure_rollup_indexes(rollups):
+    try:
+        rollups.create_index([("day", ASCENDING), ("site", ASCENDING)], name="day_site")
+        rollups.create_index([("site", ASCENDING), ("day", ASCENDING)], name="site_day")
+        return True
+    except PyMongoError as e:
+        print(f"⚠️ Rollup index creation failed: {e}")
+        return False
+
+
+def backfill_conf_hist(collection):
+    """Give legacy records (rounded `confidences` list, no histogram) a `conf_hist`, server side"""
+    bin_of = {"$min": [{"$floor": {"$multiply": ["$$c", CONF_BINS]}}, CONF_BINS - 1]}
+    hist = {"$map": {
+        "input": list(range(CONF_BINS)),
+        "as": "b",
+        "in": {"$size": {"$filter": {"input": "$confidences", "as": "c", "cond": {"$eq": [bin_of, "$$b"]}}}},
+    }}
+    try:
+        res = collection.update_many(
+            {"conf_hist": {"$exists": False}, "confidences": {"$type": "array"}},
+            [{"$set": {"conf_hist": hist}}],
+        )
+        if res.modified_count:
+            print(f"✅ Added confidence histograms to {res.modified_count} legacy record(s)")
+    except PyMongoError as e:
+        print(f"⚠️ Confidence histogram backfill failed: {e}")
+
+
+def rollup_updates(records) -> list:
+    """`$inc` upserts folding a batch of freshly inserted records into their rollups"""
+    incs = defaultdict(lambda: defaultdict(float))
+    for r in records:
+        if "tree_count" not in r or "timestamp" not in r:
+            continue
+        inc = incs[(day_of(r["timestamp"]), r.get("site") or UNASSIGNED_SITE)]
+        inc["images"] += 1
+        inc["trees"] += int(r["tree_count"])
+        inc["conf_sum"] += float(r.get("avg_confidence") or 0) * int(r["tree_count"])
+        for key, n in zip(BIN_KEYS, r.get("conf_hist") or ()):
+            if n:
+                inc[f"conf_hist.{key}"] += n
+    return [
+        UpdateOne(
+            {"_id": rollup_id(day, site)},
+            {"$inc": {k: v if k == "conf_sum" else int(v) for k, v in inc.items()},
+             "$setOnInsert": {"day": day, "site": site}},
+            upsert=True,
+        )
+        for (day, site), inc in incs.items()
+    ]
+
+
+def apply_rollups(rollups, records) -> bool:
+    updates = rollup_updates(records)
+    if not updates:
+        return True
+    try:
+        rollups.bulk_write(updates, ordered=False)
+        return True
+    except PyMongoError as e:
+        print(f"⚠️ Rollup update failed: {e}")
+        return False
+
+
+def rebuild_rollups(detections, rollups) -> int:
+    """Recompute every rollup from `detections`; returns the number of rollup documents.
+
+    The grouping runs on the server. Results are written to a scratch
+    collection and renamed over the live one, so readers never see it half built.
+    """
+    group = {
+        "_id": {
+            "day": {"$dateToString": {"format": _DAY, "date": "$timestamp"}},
+            "site": {"$ifNull": ["$site", UNASSIGNED_SITE]},
+        },
+        "images": {"$sum": 1},
+        "trees": {"$sum": "$tree_count"},
+        "conf_sum": {"$sum": {"$multiply": [{"$ifNull": ["$avg_confidence", 0]}, "$tree_count"]}},
+    }
+    for i, key in enumerate(BIN_KEYS):
+        group[key] = {"$sum": {"$arrayElemAt": ["$conf_hist", i]}}
+    pipeline = [
+        {"$match": {"tree_count": {"$type": "number"}, "timestamp": {"$type": "date"}}},
+        {"$group": group},
+    ]
+    docs = []
+    for g in detections.aggregate(pipeline, allowDiskUse=True):
+        day, site = g["_id"]["day"], g["_id"]["site"]
+        docs.append({
+            "_id": rollup_id(day, site),
+            "day": day,
+            "site": site,
+            "images": g["images"],
+            "trees": g["trees"],
+            "conf_sum": g["conf_sum"],
+            "conf_hist": {key: g[key] for key in BIN_KEYS if g[key]},
+        })
+    scratch = rollups.database[rollups.name + "_rebuild"]
+    scratch.drop()
+    if not docs:
+        rollups.delete_many({})
+        return 0
+    scratch.insert_many(docs)
+    scratch.rename(rollups.name, dropTarget=True)
+    ensure_rollup_indexes(rollups)
+    return len(docs)
+
+
+def ensure_rollups(detections, rollups):
+    """Backfill histograms and build the rollups if there are none yet"""
+    backfill_conf_hist(detections)
+    try:
+        if rollups.estimated_document_count() == 0 and detections.estimated_document_count() > 0:
+            n = rebuild_rollups(detections, rollups)
+            print(f"✅ Built {n} detection rollup(s)")
+        ensure_rollup_indexes(rollups)
+    except PyMongoError as e:
+        print(f"⚠️ Rollup rebuild failed: {e}")
+
+
+def _match(start=None, end=None, site=None) -> dict:
+    """Rollup filter; `start`/`end` are inclusive dates"""
+    match = {}
+    days = {}
+    if start is not None:
+        days["$gte"] = start.strftime(_DAY)
+    if end is not None:
+        days["$lte"] = end.strftime(_DAY)
+    if days:
+        match["day"] = days
+    if site:
+        match["site"] = site
+    return match
+
+
+def _sums():
+    return {
+        "images": {"$sum": "$images"},
+        "trees": {"$sum": "$trees"},
+        "conf_sum": {"$sum": "$conf_sum"},
+    }
+
+
+def _finish(doc) -> dict:
+    images, trees = doc.pop("images", 0), doc.pop("trees", 0)
+    conf_sum = doc.pop("conf_sum", 0.0)
+    doc.update({
+        "images": images,
+        "trees": trees,
+        "avg_trees_per_image": round(trees / images, 2) if images else 0,
+        "avg_confidence": round(conf_sum / trees, 4) if trees else 0,
+    })
+    return doc
+
+
+def totals(rollups, start=None, end=None, site=None) -> dict:
+    pipeline = [
+        {"$match": _match(start, end, site)},
+        {"$group": {"_id": None, **_sums(),
+                    "first_day": {"$min": "$day"}, "last_day": {"$max": "$day"},
+                    "sites": {"$addToSet": "$site"}}},
+    ]
+    rows = list(rollups.aggregate(pipeline))
+    if not rows:
+        return _finish({"first_day": None, "last_day": None, "sites": 0})
+    row = rows[0]
+    row.pop("_id")
+    row["sites"] = len(row["sites"])
+    return _finish(row)
+
+
+def daily(rollups, start=None, end=None, site=None) -> list:
+    pipeline = [
+        {"$match": _match(start, end, site)},
+        {"$group": {"_id": "$day", **_sums()}},
+        {"$sort": {"_id": 1}},
+    ]
+    return [_finish({"day": row.pop("_id"), **row}) for row in rollups.aggregate(pipeline)]
+
+
+def by_site(rollups, start=None, end=None) -> list:
+    pipeline = [
+        {"$match": _match(start, end)},
+        {"$group": {"_id": "$site", **_sums(), "first_day": {"$min": "$day"}, "last_day": {"$max": "$day"}}},
+        {"$sort": {"trees": -1, "_id": 1}},
+    ]
+    return [_finish({"site": row.pop("_id"), **row}) for row in rollups.aggregate(pipeline)]
+
+
+def confidence_histogram(rollups, start=None, end=None, site=None, bins=CONF_BINS) -> list:
+    """Box confidence histogram; `bins` must divide CONF_BINS (stored bins are merged)"""
+    if bins < 1 or CONF_BINS % bins:
+        raise ValueError(f"bins must divide {CONF_BINS}")
+    pipeline = [
+        {"$match": _match(start, end, site)},
+        {"$group": {"_id": None, **{key: {"$sum": f"$conf_hist.{key}"} for key in BIN_KEYS}}},
+    ]
+    rows = list(rollups.aggregate(pipeline))
+    counts = [rows[0][key] if rows else 0 for key in BIN_KEYS]
+    step = CONF_BINS // bins
+    return [
+        {"lo": round(i / bins, 4), "hi": round((i + 1) / bins, 4), "count": sum(counts[i * step:(i + 1) * step])}
+        for i in range(bins)
+    ]
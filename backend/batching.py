@@ -0,0 +1,161 @@
+"""Dynamic micro-batching for YOLO inference.
+
+Requests that arrive within a short window are grouped into a single batched
+model call (the same `model([img1, img2, ...])` path used by models/app.py),
+and each caller gets back its own per-image result.
+
+The admission queue is bounded: when it is full `submit` raises
+`QueueFullError` immediately instead of letting latency grow without limit.
+"""
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import Histogram, LATENCY_BUCKETS_MS, BATCH_SIZE_BUCKETS
+
+_STOP = object()
+
+
+class QueueFullError(RuntimeError):
+    """Raised by `MicroBatcher.submit` when the admission queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class _Request:
+    __slots__ = ("image", "future", "enqueued_at")
+
+    def __init__(self, image):
+        self.image = image
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """Collects images for up to `max_wait_ms` (or `max_batch_size` items) and
+    runs them through `predict_fn` in one call.
+
+    `predict_fn` takes a list of images and must return a list of per-image
+    results in the same order. It is called from `workers` dedicated threads
+    (never from the asyncio event loop), so at most `workers` batches run at
+    once and at most `max_queue` images wait for a slot.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10, workers=1, max_queue=64):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.workers = max(1, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._threads = []
+        self.rejected = 0
+
+        self.batch_size_hist = Histogram(
+            "batch_size", BATCH_SIZE_BUCKETS, "Images per batched model call")
+        self.queue_wait_hist = Histogram(
+            "batch_queue_wait_ms", LATENCY_BUCKETS_MS, "Time a request waited for its batch to start")
+        self.inference_hist = Histogram(
+            "batch_inference_ms", LATENCY_BUCKETS_MS, "Duration of one batched model call")
+
+    def start(self):
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._threads = [
+            threading.Thread(target=self._run, name=f"inference-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self, timeout=5.0):
+        alive = [t for t in self._threads if t.is_alive()]
+        for _ in alive:
+            self._queue.put(_STOP)
+        for t in alive:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, image) -> Future:
+        """Queue an image for inference; the returned future resolves to its result.
+
+        Raises QueueFullError if the admission queue is full.
+        """
+        req = _Request(image)
+        try:
+            self._queue.put_nowait(req)
+        except queue.Full:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+        return req.future
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def retry_after(self):
+        """Rough number of seconds until the current backlog drains."""
+        batch_seconds = self.inference_hist.snapshot()["mean"] / 1000.0 or 1.0
+        batches = self._queue.qsize() / (self.max_batch_size * self.workers)
+        return max(1, math.ceil(batches * batch_seconds))
+
+    def _collect(self, first):
+        """Fill a batch starting with `first`; returns (batch, stop_requested)."""
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch, stop = self._collect(first)
+            # Drop requests whose caller already gave up
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for r in batch:
+                self.queue_wait_hist.observe((started - r.enqueued_at) * 1000)
+            self.batch_size_hist.observe(len(batch))
+
+            try:
+                results = self.predict_fn([r.image for r in batch])
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            finally:
+                self.inference_hist.observe((time.perf_counter() - started) * 1000)
+
+            for r, res in zip(batch, results):
+                r.future.set_result(res)
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": self._queue.qsize(),
+            "rejected": self.rejected,
+            "batch_size": self.batch_size_hist.snapshot(),
+            "queue_wait_ms": self.queue_wait_hist.snapshot(),
+            "inference_ms": self.inference_hist.snapshot(),
+        }
@@ -0,0 +1,358 @@
+"""Load-testing and latency benchmark for the TreeSense API.
+
+Runs the FastAPI app in-process (requests go through httpx's ASGI transport,
+so routing, multipart parsing, decoding, batching and inference are all
+exercised) against an in-memory MongoDB stand-in, and drives `/upload` with
+a configurable number of concurrent clients.
+
+Each batch setting runs in its own subprocess, since batching is configured
+when the app is imported. For every (image, batch size, concurrency)
+scenario it reports throughput, p50/p95/p99 latency and peak RSS, writes the
+results as JSON, and can compare them against a stored baseline:
+
+    python benchmark.py --out bench.json
+    python benchmark.py --sizes 640x480,4000x3000 --batch-sizes 1,8 \\
+        --concurrency 1,16 --requests 200 --baseline bench.json
+
+The result cache is disabled during runs (uploads would otherwise be served
+from it after the first request) unless `--cache` is given.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).parent
+SAMPLE_DIR = BACKEND_DIR.parent / "models" / "sample"
+DEFAULT_SIZES = "640x480,1920x1080,4000x3000"
+
+
+def synthetic_jpeg(width, height, seed=0, quality=90) -> bytes:
+    """Canopy-like test image: smooth green texture with darker round crowns"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((max(2, height // 64), max(2, width // 64), 3), dtype=np.float32)
+    base = np.asarray(Image.fromarray((coarse * 255).astype(np.uint8)).resize((width, height), Image.BILINEAR),
+                      dtype=np.float32)
+    img = base * np.array([0.3, 0.6, 0.25], dtype=np.float32) + np.array([40, 70, 30], dtype=np.float32)
+    yy, xx = np.ogrid[:height, :width]
+    for _ in range(max(1, width * height // 40000)):
+        cx, cy, r = rng.integers(0, width), rng.integers(0, height), rng.integers(8, 40)
+        y0, y1, x0, x1 = max(0, cy - r), min(height, cy + r), max(0, cx - r), min(width, cx + r)
+        crown = (yy[y0:y1] - cy) ** 2 + (xx[:, x0:x1] - cx) ** 2 <= r * r
+        img[y0:y1, x0:x1][crown] *= 0.55
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def build_scenarios(sizes, use_samples, variants):
+    """[(name, width, height, [jpeg bytes, ...])]; several variants per size so
+    requests aren't byte-identical"""
+    scenarios = []
+    for size in sizes:
+        w, h = (int(v) for v in size.lower().split("x"))
+        scenarios.append((f"synthetic_{w}x{h}", w, h, [synthetic_jpeg(w, h, seed) for seed in range(variants)]))
+    if use_samples and SAMPLE_DIR.is_dir():
+        for path in sorted(SAMPLE_DIR.iterdir()):
+            if path.suffix.lower() in (".jpg", ".jpeg", ".png"):
+                with Image.open(path) as im:
+                    w, h = im.size
+                scenarios.append((f"sample_{path.stem}", w, h, [path.read_bytes()]))
+    return scenarios
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return round(sorted_values[idx], 3)
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class RSSSampler:
+    """Tracks peak RSS on a background thread between `reset()` calls"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def reset(self):
+        self.peak = current_rss()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+async def drive(client, payloads, name, concurrency, requests, warmup):
+    """Send `warmup` untimed then `requests` timed uploads from `concurrency` clients"""
+    async def one(i):
+        data = payloads[i % len(payloads)]
+        started = time.perf_counter()
+        r = await client.post("/upload", files={"file": (f"{name}_{i}.jpg", data, "image/jpeg")})
+        return r.status_code, (time.perf_counter() - started) * 1000
+
+    for i in range(warmup):
+        await one(i)
+
+    counter = iter(range(requests))
+    results = []
+
+    async def worker():
+        for i in counter:
+            results.append(await one(i))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results, time.perf_counter() - started
+
+
+async def run_scenarios(config):
+    import httpx
+    import main
+
+    sampler = RSSSampler().start()
+    out = []
+    async with main.app.router.lifespan_context(main.app):
+        deadline = time.monotonic() + config["ready_timeout"]
+        while not main.model_registry.ready:
+            if main.model_registry.status == "failed" or time.monotonic() > deadline:
+                raise RuntimeError(f"Model did not become ready: {main.model_registry.info()}")
+            await asyncio.sleep(0.2)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name, width, height, payloads in build_scenarios(config["sizes"], config["samples"],
+                                                                 config["variants"]):
+                for concurrency in config["concurrency"]:
+                    sampler.reset()
+                    batches_before = main.batcher.batch_size_hist.snapshot()
+                    results, elapsed = await drive(client, payloads, name, concurrency,
+                                                   config["requests"], config["warmup"])
+                    ok = sorted(ms for status, ms in results if status == 200)
+                    batches = main.batcher.batch_size_hist.snapshot()
+                    n_batches = batches["count"] - batches_before["count"]
+                    out.append({
+                        "scenario": name,
+                        "width": width,
+                        "height": height,
+                        "bytes": len(payloads[0]),
+                        "batch_max_size": main.BATCH_MAX_SIZE,
+                        "concurrency": concurrency,
+                        "requests": len(results),
+                        "ok": len(ok),
+                        "rejected": sum(1 for status, _ in results if status == 503),
+                        "errors": sum(1 for status, _ in results if status not in (200, 503)),
+                        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+                        "latency_ms": {
+                            "p50": percentile(ok, 50),
+                            "p95": percentile(ok, 95),
+                            "p99": percentile(ok, 99),
+                            "mean": round(sum(ok) / len(ok), 3) if ok else None,
+                            "max": round(ok[-1], 3) if ok else None,
+                        },
+                        "mean_batch_size": round((batches["sum"] - batches_before["sum"]) / n_batches, 2)
+                        if n_batches else None,
+                        "peak_rss_mb": round(sampler.peak / 2 ** 20, 1),
+                    })
+                    r = out[-1]
+                    print(f"  {name:<28} batch={r['batch_max_size']:<3} conc={concurrency:<3} "
+                          f"{r['throughput_rps']} req/s  p50={r['latency_ms']['p50']}ms "
+                          f"p99={r['latency_ms']['p99']}ms  "
+                          f"rss={r['peak_rss_mb']}MB", file=sys.stderr)
+    sampler.stop()
+    return out
+
+
+def worker_main(config_path, out_path):
+    """Subprocess entry point: configure the app through its environment, run, write results"""
+    with open(config_path) as f:
+        config = json.load(f)
+    if config["db"] == "mongomock":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient  # main does `from pymongo import MongoClient`
+    results = asyncio.run(run_scenarios(config))
+    with open(out_path, "w") as f:
+        json.dump(results, f)
+
+
+def run_batch_setting(config, batch_size, workdir):
+    env = dict(os.environ)
+    env.update({
+        "BATCH_MAX_SIZE": str(batch_size),
+        "DB_SPILL_PATH": str(workdir / f"spill_{batch_size}.jsonl"),
+        "JOBS_DIR": str(workdir / f"jobs_{batch_size}"),
+        "TREES_SPILL_PATH": str(workdir / f"trees_spill_{batch_size}.jsonl"),
+        # Uploads store their originals: keep them out of the real image and render stores
+        "SOURCE_IMAGE_DIR": str(workdir / f"images_{batch_size}"),
+        "RENDER_CACHE_DIR": str(workdir / f"render_cache_{batch_size}"),
+        "PROFILE_SAMPLE_RATE": "0",
+    })
+    if not config["cache"]:
+        env["RESULT_CACHE_ENTRIES"] = "0"
+        env["RESULT_CACHE_PERSIST"] = "0"
+    if config["db"] == "mongomock":
+        env["MONGO_URI"] = "mongodb://localhost:27017"  # never contacted; avoids SRV lookups from .env
+    elif config["db"] == "none":
+        env["MONGO_URI"] = "mongodb://localhost:1"  # unreachable: records spill to disk
+    elif config["db"] != "env":
+        env["MONGO_URI"] = config["db"]
+    if config["weights"]:
+        env["MODEL_PATH"] = config["weights"]
+    config_path = workdir / f"config_{batch_size}.json"
+    out_path = workdir / f"results_{batch_size}.json"
+    config_path.write_text(json.dumps(config))
+    subprocess.run([sys.executable, str(Path(__file__).resolve()), "--worker", str(config_path), str(out_path)],
+                   cwd=str(BACKEND_DIR), env=env, check=True)
+    return json.loads(out_path.read_text())
+
+
+def scenario_key(r):
+    return r["scenario"], r["batch_max_size"], r["concurrency"]
+
+
+def compare(results, baseline, threshold):
+    """Regressions beyond `threshold` (relative) versus a baseline run"""
+    base = {scenario_key(r): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        b = base.get(scenario_key(r))
+        if b is None:
+            continue
+        checks = [
+            ("throughput_rps", b["throughput_rps"], r["throughput_rps"], -1),
+            ("p95_ms", b["latency_ms"]["p95"], r["latency_ms"]["p95"], 1),
+            ("p99_ms", b["latency_ms"]["p99"], r["latency_ms"]["p99"], 1),
+            ("peak_rss_mb", b["peak_rss_mb"], r["peak_rss_mb"], 1),
+        ]
+        for metric, old, new, worse in checks:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change * worse > threshold:
+                regressions.append({
+                    "scenario": r["scenario"],
+                    "batch_max_size": r["batch_max_size"],
+                    "concurrency": r["concurrency"],
+                    "metric": metric,
+                    "baseline": old,
+                    "current": new,
+                    "change": round(change, 4),
+                })
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(BACKEND_DIR),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /upload throughput and latency")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Synthetic image sizes, e.g. 640x480,4000x3000")
+    parser.add_argument("--no-samples", action="store_true", help="Skip images in models/sample/")
+    parser.add_argument("--variants", type=int, default=4, help="Distinct synthetic images per size")
+    parser.add_argument("--batch-sizes", default="1,8", help="BATCH_MAX_SIZE values to compare")
+    parser.add_argument("--concurrency", default="1,8", help="Concurrent clients per scenario")
+    parser.add_argument("--requests", type=int, default=100, help="Timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed requests before each scenario")
+    parser.add_argument("--db", default="mongomock",
+                        help="mongomock (in-memory), none (unreachable, records spill), env (use MONGO_URI) or a URI")
+    parser.add_argument("--weights", default=None, help="Model file (default: the API's usual lookup)")
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache enabled")
+    parser.add_argument("--ready-timeout", type=float, default=300, help="Seconds to wait for the model")
+    parser.add_argument("--out", default=None, help="Write results JSON here")
+    parser.add_argument("--baseline", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change flagged as a regression")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(*args.worker)
+        return
+
+    config = {
+        "sizes": [s for s in args.sizes.split(",") if s],
+        "samples": not args.no_samples,
+        "variants": max(1, args.variants),
+        "concurrency": [int(c) for c in args.concurrency.split(",")],
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "db": args.db,
+        "weights": str(Path(args.weights).resolve()) if args.weights else None,
+        "cache": args.cache,
+        "ready_timeout": args.ready_timeout,
+    }
+    results = []
+    with tempfile.TemporaryDirectory(prefix="treesense-bench-") as tmp:
+        for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+            print(f"▶ BATCH_MAX_SIZE={batch_size}", file=sys.stderr)
+            results.extend(run_batch_setting(config, batch_size, Path(tmp)))
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": config,
+        },
+        "results": results,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.threshold)
+        for reg in report["regressions"]:
+            print(f"❌ {reg['scenario']} batch={reg['batch_max_size']} conc={reg['concurrency']}: "
+                  f"{reg['metric']} {reg['baseline']} -> {reg['current']} ({reg['change']:+.1%})", file=sys.stderr)
+        if report["regressions"]:
+            exit_code = 1
+        else:
+            print("✅ No regressions against baseline", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).write_text(text)
+    else:
+        print(text)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Content-addressed cache of detection results.
+
+Keys are a hash of the raw upload bytes plus the model identity and the
+inference parameters, so a re-uploaded image can be answered without decoding
+or running the model. Two tiers:
+
+- an in-memory LRU bounded by entry count and (approximate) bytes
+- an optional persistent tier in a MongoDB collection
+
+Entries produced by a different model never match (the model id is part of
+the key), and `set_model` drops them from both tiers when the model changes.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import bson
+from pymongo.errors import PyMongoError
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Short content hash of a weights file, used as the model identity"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(contents: bytes, model_id: str, params: dict) -> str:
+    h = hashlib.blake2b(contents, digest_size=20)
+    h.update(model_id.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, collection=None, available=None):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.collection = collection
+        # Optional callable telling whether the persistent tier is reachable
+        self.available = available
+        self.model_id = None
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def set_model(self, model_id):
+        """Switch to a new model: memory tier is cleared, stale persistent entries purged."""
+        with self._lock:
+            changed = model_id != self.model_id
+            self.model_id = model_id
+            if changed:
+                self._entries.clear()
+                self._bytes = 0
+        if changed and self._persistent():
+            try:
+                self.collection.delete_many({"model_id": {"$ne": model_id}})
+            except PyMongoError as e:
+                print(f"⚠️ Result cache purge failed: {e}")
+
+    def key(self, contents: bytes, params: dict) -> str:
+        return cache_key(contents, self.model_id or "", params)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if self._persistent():
+            try:
+                doc = self.collection.find_one({"_id": key, "model_id": self.model_id})
+            except PyMongoError:
+                doc = None
+            if doc is not None:
+                self._store(key, doc["value"])
+                with self._lock:
+                    self.persistent_hits += 1
+                return doc["value"]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value: dict):
+        self._store(key, value)
+        if self._persistent():
+            try:
+                self.collection.replace_one(
+                    {"_id": key}, {"_id": key, "model_id": self.model_id, "value": value}, upsert=True)
+            except PyMongoError as e:
+                print(f"⚠️ Result cache write failed: {e}")
+
+    def _persistent(self):
+        return self.collection is not None and (self.available is None or self.available())
+
+    def _store(self, key, value):
+        if self.max_entries == 0:
+            return
+        size = len(bson.encode(value))  # values hold packed geometry (bytes)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "persistent": self.collection is not None,
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.persistent_hits) / lookups, 3) if lookups else 0,
+            }
@@ -0,0 +1,137 @@
+"""Upload decoding with decode-time downscaling.
+
+The model letterboxes every image to `imgsz` (640 by default), so decoding a
+20-40 MP drone JPEG at full resolution mostly produces pixels that are thrown
+away. JPEGs are decoded with PIL's draft mode instead, which lets libjpeg
+decode directly at 1/2, 1/4 or 1/8 scale -- the smallest scale whose long side
+is still at least the model input size.
+
+The pixel-count limit is checked from the header before any pixel data is
+decoded, EXIF orientation is applied on the (already reduced) image, and the
+result is written as BGR (what ultralytics expects for numpy input) into a
+pooled buffer that is reused across requests.
+"""
+import io
+import math
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+DEFAULT_MAX_PIXELS = 250_000_000
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured pixel-count limit."""
+
+
+class BufferPool:
+    """Reuses uint8 HxWx3 arrays of the same shape between decodes.
+
+    Buffers must be handed back with `release` once inference is done with
+    them; at most `max_per_shape` idle buffers are kept per shape.
+    """
+
+    def __init__(self, max_per_shape=4):
+        self.max_per_shape = max_per_shape
+        self._free = {}
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.allocated = 0
+
+    def acquire(self, shape):
+        with self._lock:
+            free = self._free.get(shape)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, buf):
+        with self._lock:
+            free = self._free.setdefault(buf.shape, [])
+            if len(free) < self.max_per_shape:
+                free.append(buf)
+
+
+class DecodedImage:
+    """Decoded pixels plus what the API needs to know about the original image.
+
+    `width`/`height` are the full-resolution size (after EXIF orientation);
+    `scale` is decoded size / original size, for mapping boxes back.
+    """
+
+    __slots__ = ("array", "width", "height", "scale", "timings", "_pool")
+
+    def __init__(self, array, width, height, scale, timings, pool=None):
+        self.array = array
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.timings = timings
+        self._pool = pool
+
+    def detach(self):
+        """Keep the buffer out of the pool, e.g. when another thread may still read it"""
+        self._pool = None
+
+    def release(self):
+        if self._pool is not None and self.array is not None:
+            self._pool.release(self.array)
+        self.array = None
+
+
+def _draft_size(size, target):
+    """Size to request from draft(): same aspect as the image, long side = target"""
+    w, h = size
+    ratio = target / max(w, h)
+    return max(1, math.ceil(w * ratio)), max(1, math.ceil(h * ratio))
+
+
+def decode_image(contents: bytes, target_size=640, max_pixels=DEFAULT_MAX_PIXELS,
+                 bgr=True, pool: BufferPool = None) -> DecodedImage:
+    """Decode uploaded bytes to an HxWx3 uint8 array.
+
+    `target_size=None` decodes at full resolution (needed for tiled inference).
+    Raises ImageTooLargeError before decoding if the image has too many pixels.
+    """
+    t0 = time.perf_counter()
+    im = Image.open(io.BytesIO(contents))
+    orig_w, orig_h = im.size
+    if max_pixels and orig_w * orig_h > max_pixels:
+        raise ImageTooLargeError(
+            f"Image is {orig_w}x{orig_h} ({orig_w * orig_h:,} pixels), limit is {max_pixels:,}")
+
+    if target_size and im.format == "JPEG" and max(orig_w, orig_h) > 2 * target_size:
+        im.draft("RGB", _draft_size(im.size, target_size))
+    im.load()
+    t_decode = time.perf_counter()
+
+    # EXIF orientations 5-8 are rotated by 90 degrees: the displayed image
+    # (and the size we report) has width and height swapped
+    if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        orig_w, orig_h = orig_h, orig_w
+    im = ImageOps.exif_transpose(im)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    rgb = np.asarray(im)
+    shape = rgb.shape
+    if pool is None and not bgr:
+        buf = rgb  # full-resolution RGB for tiling: avoid a second full-size copy
+    else:
+        buf = pool.acquire(shape) if pool is not None else np.empty(shape, dtype=np.uint8)
+        np.copyto(buf, rgb[..., ::-1] if bgr else rgb)
+    t_done = time.perf_counter()
+
+    return DecodedImage(
+        buf, orig_w, orig_h,
+        scale=shape[1] / orig_w,
+        timings={
+            "decode_ms": round((t_decode - t0) * 1000, 2),
+            "convert_ms": round((t_done - t_decode) * 1000, 2),
+        },
+        pool=pool,
+    )
@@ -0,0 +1,58 @@
+"""Compact per-box storage for detection records.
+
+Box coordinates and scores are kept on every `detections` document as packed
+little-endian arrays in a single `geometry` subdocument instead of one
+subdocument per box:
+
+    {"v": 1, "n": N, "boxes": <N*4 float32 xyxy pixels>, "scores": <N uint16>}
+
+Boxes are in original-image pixels, scores are quantized to 1/65535. That is
+18 bytes per box (a `{"x1", "y1", "x2", "y2", "score"}` subdocument is ~70),
+enough to re-render or re-threshold a result later without re-running the
+model. Every record also carries `conf_hist`, a small fixed-bin histogram of
+its scores, so confidence distributions can be aggregated server side without
+unpacking anything.
+"""
+import numpy as np
+from bson import Binary
+
+GEOMETRY_VERSION = 1
+CONF_BINS = 20
+_SCORE_SCALE = 65535
+
+
+def pack_geometry(boxes, scores) -> dict:
+    boxes = np.ascontiguousarray(boxes, dtype="<f4").reshape(-1, 4)
+    q = np.round(np.clip(np.asarray(scores, dtype=np.float64), 0, 1) * _SCORE_SCALE).astype("<u2")
+    return {
+        "v": GEOMETRY_VERSION,
+        "n": int(len(q)),
+        "boxes": Binary(boxes.tobytes()),
+        "scores": Binary(q.tobytes()),
+    }
+
+
+def unpack_geometry(geometry):
+    """(boxes (N, 4) float32, scores (N,) float32) from a packed `geometry` subdocument"""
+    if geometry.get("v") != GEOMETRY_VERSION:
+        raise ValueError(f"Unsupported geometry version {geometry.get('v')}")
+    boxes = np.frombuffer(bytes(geometry["boxes"]), dtype="<f4").reshape(-1, 4)
+    scores = np.frombuffer(bytes(geometry["scores"]), dtype="<u2").astype(np.float32) / _SCORE_SCALE
+    return boxes, scores
+
+
+def confidence_histogram(scores, bins=CONF_BINS) -> list:
+    """Counts of scores in `bins` equal-width bins over [0, 1]"""
+    idx = np.minimum((np.asarray(scores, dtype=np.float64) * bins).astype(np.int64), bins - 1)
+    return np.bincount(idx, minlength=bins).tolist()
+
+
+def expand_geometry(doc: dict) -> dict:
+    """API view of a record: packed geometry replaced by `boxes` and `confidences` lists"""
+    geometry = doc.pop("geometry", None)
+    doc.pop("conf_hist", None)
+    if geometry is not None:
+        boxes, scores = unpack_geometry(geometry)
+        doc["boxes"] = boxes.astype(np.float64).round(1).tolist()
+        doc["confidences"] = scores.astype(np.float64).round(2).tolist()
+    return doc
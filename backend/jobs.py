@@ -0,0 +1,292 @@
+"""Asynchronous bulk detection jobs.
+
+A job is a set of uploaded images and/or zip/tar archives. Submitting only
+saves the files and records the job; a pool of local worker threads expands
+archives, processes images in batches and stores each image's result.
+
+State lives in a SQLite database next to the job files, so a restarted
+process picks up where it stopped: items that were in flight go back to
+pending, and finished items are never processed twice.
+"""
+import json
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from pathlib import Path
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,          -- queued | running | done
+    created REAL NOT NULL,
+    finished REAL,
+    total INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    site TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,          -- pending | running | done | failed
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (job_id, status);
+"""
+
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_image(name):
+    return Path(name).suffix.lower() in IMAGE_EXTENSIONS
+
+
+class JobStore:
+    """SQLite-backed job and item state (safe to share between threads)"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.root / "jobs.db"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        try:  # job databases created before jobs had a site
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN site TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self._lock = threading.Lock()
+
+    def _exec(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def input_dir(self, job_id):
+        return self.root / job_id / "input"
+
+    def create(self) -> str:
+        job_id = uuid.uuid4().hex
+        self.input_dir(job_id).mkdir(parents=True, exist_ok=True)
+        return job_id
+
+    def enqueue(self, job_id, site=None):
+        """Make a job visible to workers once all its files are saved"""
+        self._exec("INSERT INTO jobs (id, status, created, site) VALUES (?, 'queued', ?, ?)",
+                   (job_id, time.time(), site))
+
+    def recover(self):
+        """Put items that were in flight when the process died back in the queue"""
+        self._exec("UPDATE items SET status = 'pending' WHERE status = 'running'")
+
+    def next_job(self):
+        rows = self._exec(
+            "SELECT id, status, site FROM jobs WHERE status IN ('queued', 'running') ORDER BY created LIMIT 1")
+        return rows[0] if rows else None
+
+    def expand(self, job_id):
+        """Extract archives and register every image of a queued job as an item"""
+        src = self.input_dir(job_id)
+        images, archives = [], []
+        for entry in sorted(src.iterdir()):
+            if entry.is_file() and is_archive(entry.name):
+                images.extend(_extract(entry, src / f"{entry.name}.d"))
+                archives.append(entry)
+            elif entry.is_file() and is_image(entry.name):
+                images.append((entry, entry.name.split("_", 1)[-1]))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+            self._conn.executemany(
+                "INSERT INTO items (job_id, idx, path, filename, status) VALUES (?, ?, ?, ?, 'pending')",
+                [(job_id, i, str(p), name) for i, (p, name) in enumerate(images)])
+            self._conn.execute("UPDATE jobs SET status = 'running', total = ? WHERE id = ?", (len(images), job_id))
+            self._conn.execute("COMMIT")
+        # Archives are only removed once their items are committed, so an
+        # interrupted expansion simply runs again after a restart
+        for archive in archives:
+            archive.unlink()
+        return len(images)
+
+    def claim(self, job_id, limit):
+        """Atomically take up to `limit` pending items of a job"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT idx, path, filename FROM items WHERE job_id = ? AND status = 'pending' "
+                "ORDER BY idx LIMIT ?", (job_id, limit)).fetchall()
+            self._conn.executemany(
+                "UPDATE items SET status = 'running' WHERE job_id = ? AND idx = ?",
+                [(job_id, r[0]) for r in rows])
+            self._conn.execute("COMMIT")
+        return rows
+
+    def complete(self, job_id, outcomes):
+        """Store per-item outcomes: list of (idx, status, result_dict)"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE items SET status = ?, result = ? WHERE job_id = ? AND idx = ?",
+                [(status, json.dumps(result), job_id, idx) for idx, status, result in outcomes])
+            self._conn.execute("COMMIT")
+
+    def finish_if_done(self, job_id):
+        left = self._exec(
+            "SELECT COUNT(*) FROM items WHERE job_id = ? AND status IN ('pending', 'running')", (job_id,))[0][0]
+        if left == 0:
+            self._exec("UPDATE jobs SET status = 'done', finished = ? WHERE id = ? AND status != 'done'",
+                       (time.time(), job_id))
+            # Inputs are no longer needed once every result is stored
+            shutil.rmtree(self.input_dir(job_id), ignore_errors=True)
+            return True
+        return False
+
+    def fail(self, job_id, error):
+        self._exec("UPDATE jobs SET status = 'done', finished = ?, error = ? WHERE id = ?",
+                   (time.time(), str(error), job_id))
+
+    def status(self, job_id):
+        rows = self._exec(
+            "SELECT id, status, created, finished, total, error, site FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        _, status, created, finished, total, error, site = rows[0]
+        counts = dict(self._exec(
+            "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)))
+        done, failed = counts.get("done", 0), counts.get("failed", 0)
+        return {
+            "id": job_id,
+            "status": status,
+            "total": total,
+            "processed": done + failed,
+            "succeeded": done,
+            "failed": failed,
+            "progress": round((done + failed) / total, 4) if total else (1.0 if status == "done" else 0.0),
+            "created": created,
+            "finished": finished,
+            "error": error,
+            "site": site,
+        }
+
+    def iter_results(self, job_id, page=500):
+        """Yield finished item results in submission order, a page at a time"""
+        last = -1
+        while True:
+            rows = self._exec(
+                "SELECT idx, result FROM items WHERE job_id = ? AND status IN ('done', 'failed') AND idx > ? "
+                "ORDER BY idx LIMIT ?", (job_id, last, page))
+            if not rows:
+                return
+            for idx, result in rows:
+                yield result
+            last = rows[-1][0]
+
+
+def _extract(archive, dst):
+    """Extract image members of a zip/tar into `dst`; returns [(path, original_name)].
+
+    Member names are never used as paths, so malicious archives can't write
+    outside `dst`.
+    """
+    shutil.rmtree(dst, ignore_errors=True)  # leftovers of an interrupted expansion
+    dst.mkdir(parents=True)
+    out = []
+    if archive.name.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf:
+            for i, info in enumerate(zf.infolist()):
+                if info.is_dir() or not is_image(info.filename):
+                    continue
+                path = dst / f"{i:06d}{Path(info.filename).suffix.lower()}"
+                with zf.open(info) as src, open(path, "wb") as f:
+                    shutil.copyfileobj(src, f, 1024 * 1024)
+                out.append((path, info.filename))
+    else:
+        with tarfile.open(archive) as tf:
+            for i, member in enumerate(tf):
+                if not member.isfile() or not is_image(member.name):
+                    continue
+                path = dst / f"{i:06d}{Path(member.name).suffix.lower()}"
+                src = tf.extractfile(member)
+                with src, open(path, "wb") as f:
+                    shutil.copyfileobj(src, f, 1024 * 1024)
+                out.append((path, member.name))
+    return out
+
+
+class JobRunner:
+    """Worker threads that drain the job queue.
+
+    `process_fn(items, site)` receives a list of (path, filename) plus the
+    job's site tag and returns one result dict per item (or an Exception
+    instance for items that failed).
+    """
+
+    def __init__(self, store: JobStore, process_fn, workers=1, batch_size=8, poll_interval=1.0):
+        self.store = store
+        self.process_fn = process_fn
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._expand_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self.store.recover()
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Wake idle workers after a job is submitted"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.store.next_job()
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            job_id, status, site = job
+            try:
+                if status == "queued":
+                    with self._expand_lock:
+                        if self.store.next_job() == job:
+                            self.store.expand(job_id)
+                    continue
+                items = self.store.claim(job_id, self.batch_size)
+                if not items:
+                    if not self.store.finish_if_done(job_id):
+                        time.sleep(0.05)  # other workers still finishing this job's items
+                    continue
+                results = self.process_fn([(path, filename) for _, path, filename in items], site)
+                outcomes = []
+                for (idx, _, filename), res in zip(items, results):
+                    if isinstance(res, Exception):
+                        outcomes.append((idx, "failed", {"filename": filename, "error": str(res)}))
+                    else:
+                        outcomes.append((idx, "done", res))
+                self.store.complete(job_id, outcomes)
+            except Exception as e:
+                print(f"⚠️ Job {job_id} failed: {e}")
+                self.store.fail(job_id, e)
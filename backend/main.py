@@ -1,20 +1,74 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, Body, File, Form, UploadFile, HTTPException, Header, Request, WebSocket
+from typing import List
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
+from starlette.websockets import WebSocketDisconnect
+from bson import ObjectId
 from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError, PyMongoError
-from datetime import datetime
+from datetime import date, datetime, timezone
 from dotenv import load_dotenv
 from pathlib import Path
+from collections import deque
+from contextlib import asynccontextmanager
+import asyncio
+import itertools
+import json
 import os
 import io
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
 from PIL import Image
-from ultralytics import YOLO
+
+from batching import MicroBatcher, QueueFullError
+from cache import ResultCache
+from decode import decode_image, BufferPool, ImageTooLargeError, DEFAULT_MAX_PIXELS
+from metrics import Histogram, Counter, Gauge, MetricsRegistry, LATENCY_BUCKETS_MS
+from persistence import DBHealthMonitor, DetectionWriter
+from profiling import RequestProfiler
+from jobs import JobStore, JobRunner, is_archive, is_image
+from registry import ModelRegistry, BACKENDS, model_candidates
+from queries import (SUMMARY_PROJECTION, LIST_SORT, ensure_indexes, migrate_string_timestamps,
+                     encode_cursor, build_filter)
+from geometry import pack_geometry, confidence_histogram, expand_geometry, CONF_BINS
+import aggregates
+from tiling import DEFAULT_TILE_SIZE, DEFAULT_OVERLAP, plan_tiles, boxes_from_result, merge_tile_detections
+import raster
+import renders
+import spatial
+import streaming
+import surveys
+import prefork
 
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db_health.start()
+    detection_writer.start()
+    tree_writer.start()
+    # Weights load (and torch imports) off the startup path; uploads get a
+    # 503 until the model has been warmed up
+    model_registry.load_in_background()
+    batcher.start()
+    if RUN_JOBS:
+        job_runner.start()
+    yield
+    if RUN_JOBS:
+        await run_in_threadpool(job_runner.stop)
+    batcher.stop()
+    await run_in_threadpool(detection_writer.stop)
+    await run_in_threadpool(tree_writer.stop)
+    db_health.stop()
+
 # Initialize FastAPI app
-app = FastAPI(title="TreeSense API", version="1.0.0")
+app = FastAPI(title="TreeSense API", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -28,109 +82,604 @@ app.add_middleware(
 # MongoDB connection
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 # Fail fast if DB is unreachable (avoid long hangs that cause frontend timeouts)
-client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=3000)
+# tz_aware: timestamps are stored as UTC dates and come back as aware datetimes
+client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=3000, tz_aware=True)
 db = client["tree_sense"]
 
+# DB health is tracked by a background ping instead of on every request
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "5"))
+db_health = DBHealthMonitor(db, interval=DB_HEALTH_INTERVAL)
+
 def db_available() -> bool:
+    """Last known DB state (no round trip)"""
+    return db_health.available
+
+def prepare_db():
+    """Indexes and legacy-data migration, run whenever the DB becomes reachable"""
+    ensure_indexes(db)
+    migrate_string_timestamps(db.detections)
+    aggregates.ensure_rollups(db.detections, db.detection_rollups)
+    spatial_index.ensure_indexes()
+    survey_store.ensure_indexes()
+
+# Under prefork.py every worker shares the database; only one builds indexes,
+# migrates and backfills (rollup rebuilds are not safe to run concurrently)
+if prefork.is_primary():
+    db_health.on_recover(prepare_db)
+
+def spill_path(env, name):
+    """Spill file of this process: one per pre-fork worker, so no two processes append to or replay the same file"""
+    path = os.getenv(env, str(Path(__file__).parent / name))
+    prefork.adopt_orphans(path)
+    return prefork.worker_path(path)
+
+# Detection records are written behind the request: batched insert_many on
+# size/time thresholds, spilled to a bounded local file while Mongo is down
+# and replayed when it comes back. Every inserted batch is folded into the
+# per-day/per-site rollups the stats endpoints read.
+detection_writer = DetectionWriter(
+    db.detections,
+    db_health,
+    batch_size=int(os.getenv("DB_WRITE_BATCH", "100")),
+    flush_interval=float(os.getenv("DB_FLUSH_INTERVAL", "1.0")),
+    spill_path=spill_path("DB_SPILL_PATH", "detections_spill.jsonl"),
+    spill_max_bytes=int(float(os.getenv("DB_SPILL_MAX_MB", "64")) * 1024 * 1024),
+    on_written=lambda records: aggregates.apply_rollups(db.detection_rollups, records),
+)
+
+# Georeferenced trees (from /upload/geotiff) get one `trees` document each,
+# written behind the request like detections. Each batch is added to the
+# density pyramid; polygon counts keep STRtrees of hot areas in memory.
+spatial_index = spatial.SpatialIndex(
+    db.trees,
+    db.density_tiles,
+    hot_zoom=int(os.getenv("SPATIAL_HOT_ZOOM", "14")),
+    hot_after=int(os.getenv("SPATIAL_HOT_AFTER", "2")),
+    max_hot_tiles=int(os.getenv("SPATIAL_HOT_TILES", "64")),
+    hot_ttl=float(os.getenv("SPATIAL_HOT_TTL", "30")),
+)
+tree_writer = DetectionWriter(
+    db.trees,
+    db_health,
+    batch_size=int(os.getenv("TREES_WRITE_BATCH", "1000")),
+    flush_interval=float(os.getenv("DB_FLUSH_INTERVAL", "1.0")),
+    spill_path=spill_path("TREES_SPILL_PATH", "trees_spill.jsonl"),
+    spill_max_bytes=int(float(os.getenv("TREES_SPILL_MAX_MB", "256")) * 1024 * 1024),
+    max_queue=int(os.getenv("TREES_MAX_QUEUE", "100000")),
+    on_written=spatial_index.on_written,
+)
+
+# Repeat surveys keep per-tile fingerprints and results, so the next survey
+# of a site only re-runs the model on tiles whose content changed
+survey_store = surveys.SurveyStore(db.surveys, db.survey_tiles)
+SURVEY_MAX_DISTANCE = int(os.getenv("SURVEY_MAX_DISTANCE", str(surveys.DEFAULT_MAX_DISTANCE)))
+
+# Inference settings
+CONF_THRESHOLD = 0.25
+# Micro-batching window: concurrent uploads arriving within BATCH_MAX_WAIT_MS
+# are run through the model together (up to BATCH_MAX_SIZE images per call)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+# Inference runs on INFERENCE_WORKERS dedicated threads; at most
+# INFERENCE_QUEUE_SIZE images may wait, beyond that uploads get a fast 503
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+
+# Model registry: weights are loaded in the background after startup and
+# warmed up before the API reports ready. MODEL_PATH pins a weights file,
+# otherwise MODEL_PATHS are tried in order (optionally only one MODEL_BACKEND).
+MODELS_DIR = Path(__file__).parent.parent / "models"
+MODEL_PATHS = model_candidates(MODELS_DIR, os.getenv("MODEL_PATH"))
+MODEL_BACKEND = os.getenv("MODEL_BACKEND") or None
+MODEL_IMGSZ = int(os.getenv("MODEL_IMGSZ")) if os.getenv("MODEL_IMGSZ") else None
+MODEL_WARMUP_RUNS = int(os.getenv("MODEL_WARMUP_RUNS", "2"))
+# Token required by the /admin endpoints (disabled when unset)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def on_model_swap(handle):
+    # Cached results were computed by the previous weights
+    result_cache.set_model(handle.model_id)
+
+model_registry = ModelRegistry(
+    MODEL_PATHS,
+    imgsz=MODEL_IMGSZ,
+    backend=MODEL_BACKEND,
+    instances=INFERENCE_WORKERS,
+    warmup_runs=MODEL_WARMUP_RUNS,
+    warmup_batch_sizes=sorted({1, BATCH_MAX_SIZE}),
+    on_swap=on_model_swap,
+)
+
+def predict_batch(images):
+    """Run one batched model call and return one Results object per image.
+
+    The handle is read once per batch, so a batch that started before a hot
+    swap finishes on the old model.
+    """
+    handle = model_registry.current
+    if handle is None:
+        raise RuntimeError("ML model not loaded")
+    return handle.predict(images, CONF_THRESHOLD)
+
+batcher = MicroBatcher(
+    predict_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    workers=INFERENCE_WORKERS,
+    max_queue=INFERENCE_QUEUE_SIZE,
+)
+
+# Result cache: repeated uploads of the same bytes (with the same model and
+# parameters) skip decode and inference. Entries are bounded by count and size;
+# RESULT_CACHE_PERSIST=1 adds a persistent tier in the `result_cache` collection.
+RESULT_CACHE_ENTRIES = int(os.getenv("RESULT_CACHE_ENTRIES", "1024"))
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "64"))
+RESULT_CACHE_PERSIST = os.getenv("RESULT_CACHE_PERSIST", "0").lower() in ("1", "true", "yes")
+
+result_cache = ResultCache(
+    max_entries=RESULT_CACHE_ENTRIES,
+    max_bytes=int(RESULT_CACHE_MB * 1024 * 1024),
+    collection=db.result_cache if RESULT_CACHE_PERSIST else None,
+    available=db_available,
+)
+
+# Annotated images (/detections/{id}/image, /thumbnail) are drawn from the stored
+# original and boxes, never by running the model again. Originals and renders
+# live in two size-bounded LRU directories on local disk; 0 MB disables either.
+SOURCE_IMAGE_DIR = os.getenv("SOURCE_IMAGE_DIR", str(Path(__file__).parent / "images"))
+SOURCE_IMAGE_MB = float(os.getenv("SOURCE_IMAGE_MB", "2048"))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", str(Path(__file__).parent / "render_cache"))
+RENDER_CACHE_MB = float(os.getenv("RENDER_CACHE_MB", "256"))
+RENDER_MAX_AGE = int(os.getenv("RENDER_MAX_AGE", "86400"))
+
+source_images = renders.DiskLRU(SOURCE_IMAGE_DIR, int(SOURCE_IMAGE_MB * 1024 * 1024))
+render_cache = renders.DiskLRU(RENDER_CACHE_DIR, int(RENDER_CACHE_MB * 1024 * 1024))
+
+def store_source(contents: bytes):
+    """Keep the original bytes of an uploaded image; returns its key (None when not kept)"""
+    if not source_images.enabled:
+        return None
+    key = renders.source_key(contents)
     try:
-        # Cheap ping
-        db.command("ping")
-        return True
-    except Exception:
-        return False
-
-# Load YOLO model
-# Try multiple possible model paths
-MODEL_PATHS = [
-    Path(__file__).parent.parent / "models" / "best.pt",
-    Path(__file__).parent.parent / "models" / "hello.pt",
-    Path(__file__).parent.parent / "models" / "best.onnx",
-]
-
-model = None
-for model_path in MODEL_PATHS:
-    if model_path.exists():
-        try:
-            print(f"🔍 Attempting to load model from {model_path}")
-            model = YOLO(str(model_path))
-            print(f"✅ Model loaded successfully from {model_path}")
+        if source_images.get(key) is None and source_images.put(key, contents) is None:
+            return None
+    except OSError as e:
+        print(f"⚠️ Could not store source image: {e}")
+        return None
+    return key
+
+def inference_params(tiled: bool, tile_size: int, tile_overlap: float) -> dict:
+    """Everything besides the image bytes and model that affects the result"""
+    params = {
+        "format": 2,  # result layout (2: packed box geometry)
+        "conf": CONF_THRESHOLD,
+        "imgsz": model_input_size(),
+        "tiled": tiled,
+    }
+    if tiled:
+        params.update(tile_size=tile_size, tile_overlap=tile_overlap)
+    return params
+
+# Uploads larger than this many pixels are rejected from the header, before decoding
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(DEFAULT_MAX_PIXELS)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Reused BGR buffers for decoded uploads (returned after inference)
+decode_pool = BufferPool()
+
+# Per-stage latency of /upload, to see where time goes
+STAGES = ("read", "cache_lookup", "decode", "inference", "extract", "persist", "total")
+stage_hists = {
+    name: Histogram("upload_stage_ms", LATENCY_BUCKETS_MS, "Time spent in each /upload stage", {"stage": name})
+    for name in STAGES
+}
+
+def model_input_size() -> int:
+    """Long side the model letterboxes to; JPEGs are decoded no larger than needed for it"""
+    handle = model_registry.current
+    return handle.imgsz if handle is not None else 640
+
+def require_model():
+    """503 while the model is still loading, 500 if no model could be loaded"""
+    if model_registry.ready:
+        return
+    if model_registry.status in ("idle", "loading"):
+        raise HTTPException(503, "ML model is loading, please retry shortly", headers={"Retry-After": "5"})
+    raise HTTPException(500, "ML model not loaded")
+
+def summarize_detections(boxes, scores, image, tiles: dict = None) -> dict:
+    """Per-image result fields shared by the upload, cache and job paths.
+
+    Boxes are mapped back to original-image pixels and stored packed (see
+    geometry.py) together with a confidence histogram for the rollups.
+    """
+    scale = image.scale or 1.0
+    result_data = {
+        "tree_count": int(len(scores)),
+        "avg_confidence": round(float(scores.mean()), 2) if len(scores) else 0,
+        "image_size": {
+            "width": image.width,
+            "height": image.height
+        },
+        "geometry": pack_geometry(np.asarray(boxes, dtype=np.float64) / scale, scores),
+        "conf_hist": confidence_histogram(scores),
+    }
+    if tiles is not None:
+        result_data["tiles"] = tiles
+    return result_data
+
+def submit_or_503(image):
+    """Queue an image on the batcher, translating a full queue into a fast 503"""
+    try:
+        return asyncio.wrap_future(batcher.submit(image))
+    except QueueFullError as e:
+        raise HTTPException(
+            503,
+            "Inference queue is full, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+async def predict_tiled(arr: np.ndarray, tile_size: int, overlap: float):
+    """Sliced inference for large images: tiles of the full-resolution RGB array
+    go through the shared batcher one batch at a time, then seam duplicates are merged."""
+    windows, crops, skipped = await run_in_threadpool(plan_tiles, arr, tile_size, overlap)
+    tile_boxes, tile_scores = [], []
+    while True:
+        chunk = await run_in_threadpool(lambda: list(itertools.islice(crops, BATCH_MAX_SIZE)))
+        if not chunk:
             break
+        results = await asyncio.gather(*[submit_or_503(tile) for tile in chunk])
+        for r in results:
+            b, sc = boxes_from_result(r)
+            tile_boxes.append(b)
+            tile_scores.append(sc)
+    boxes, scores = await run_in_threadpool(merge_tile_detections, windows, tile_boxes, tile_scores)
+    return boxes, scores, {"processed": int(len(windows)), "skipped_blank": skipped}
+
+def predict_blocking(images):
+    """Batched inference for background/streaming work running in a worker thread.
+
+    Waits for queue space instead of failing, since there is no client to send
+    a 503 to halfway through a stream.
+    """
+    futures = []
+    for image in images:
+        while True:
+            try:
+                futures.append(batcher.submit(image))
+                break
+            except QueueFullError as e:
+                time.sleep(min(e.retry_after, 1))
+    return [f.result() for f in futures]
+
+def save_summary(record: dict):
+    """Queue a detection summary record on the write-behind writer"""
+    detection_writer.enqueue(record)
+
+def index_trees(windows, record: dict):
+    """Pass raster windows through unchanged while queueing every tree's
+    WGS84 location for the spatial index"""
+    high_water = tree_writer.max_queue * 0.8
+    for boxes, scores, transform, crs in windows:
+        if crs is not None:
+            centers, _ = raster.pixel_boxes_to_map(boxes, transform, crs, "EPSG:4326")
+            # Back off instead of spilling while the writer catches up
+            while tree_writer.queue_depth > high_water:
+                time.sleep(0.05)
+            for doc in spatial.tree_docs(record["_id"], centers, scores, record["timestamp"], record.get("site")):
+                tree_writer.enqueue(doc)
+            record["trees_indexed"] = record.get("trees_indexed", 0) + len(centers)
+        yield boxes, scores, transform, crs
+
+def process_job_items(items, site=None):
+    """Process one batch of bulk-job images: cache lookups, one batched model
+    call for the misses, and write-behind persistence of every result"""
+    while not model_registry.ready:
+        if model_registry.status == "failed":
+            raise RuntimeError("ML model not loaded")
+        time.sleep(1)  # jobs recovered at startup wait for the model to warm up
+    outcomes = [None] * len(items)
+    image_keys = [None] * len(items)
+    pending = []
+    params = inference_params(False, DEFAULT_TILE_SIZE, DEFAULT_OVERLAP)
+    for i, (path, filename) in enumerate(items):
+        try:
+            contents = Path(path).read_bytes()
+            image_keys[i] = store_source(contents)
+            key = result_cache.key(contents, params)
+            cached = result_cache.get(key)
+            if cached is not None:
+                outcomes[i] = cached
+            else:
+                pending.append((i, key, decode_image(
+                    contents, model_input_size(), MAX_IMAGE_PIXELS, pool=decode_pool)))
         except Exception as e:
-            print(f"⚠️ Error loading {model_path}: {e}")
+            outcomes[i] = e
+    if pending:
+        try:
+            results = predict_blocking([image.array for _, _, image in pending])
+        except Exception as e:
+            results = [e] * len(pending)
+        for (i, key, image), result in zip(pending, results):
+            image.release()
+            if isinstance(result, Exception):
+                outcomes[i] = result
+                continue
+            boxes, scores = boxes_from_result(result)
+            outcomes[i] = summarize_detections(boxes, scores, image)
+            result_cache.put(key, outcomes[i])
+
+    job_results = []
+    for i, ((path, filename), outcome) in enumerate(zip(items, outcomes)):
+        if isinstance(outcome, Exception):
+            job_results.append(outcome)
             continue
+        record = {"filename": filename, **outcome, "timestamp": datetime.now(timezone.utc), "source": "job"}
+        if site:
+            record["site"] = site
+        if image_keys[i]:
+            record["image_key"] = image_keys[i]
+        inserted_id = detection_writer.enqueue(record)
+        job_results.append({
+            "id": str(inserted_id) if inserted_id is not None else None,
+            "filename": filename,
+            **expand_geometry(dict(outcome)),
+            "timestamp": record["timestamp"].isoformat(),
+        })
+    return job_results
+
+# Bulk jobs: state and files live under JOBS_DIR so jobs survive restarts
+JOBS_DIR = os.getenv("JOBS_DIR", str(Path(__file__).parent / "jobs_data"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+job_store = JobStore(JOBS_DIR)
+job_runner = JobRunner(job_store, process_job_items, workers=JOB_WORKERS, batch_size=BATCH_MAX_SIZE)
+# Jobs are claimed, expanded and recovered by one process: under prefork.py the
+# other workers only submit them (worker 0 picks them up within a poll interval)
+RUN_JOBS = prefork.is_primary()
+
+# Live video streams (/stream): at most STREAM_MAX_PENDING frames wait per
+# connection, frames older than STREAM_MAX_LATENCY_MS are dropped unprocessed
+STREAM_MAX_PENDING = int(os.getenv("STREAM_MAX_PENDING", str(streaming.DEFAULT_MAX_PENDING)))
+STREAM_MAX_LATENCY_MS = float(os.getenv("STREAM_MAX_LATENCY_MS", str(streaming.DEFAULT_MAX_LATENCY_MS)))
+stream_totals = {"streams": 0, "received": 0, "processed": 0, "dropped": 0}  # closed streams
+active_streams = set()
+
+
+def stream_stats() -> dict:
+    """Frame counters over closed and currently open streams"""
+    stats = dict(stream_totals, active=len(active_streams))
+    for session in list(active_streams):
+        for key in ("received", "processed", "dropped"):
+            stats[key] += getattr(session, key)
+    return stats
+
+# Prometheus metrics (GET /metrics): everything below is read at scrape time
+metrics_registry = MetricsRegistry()
+metrics_registry.register(
+    *stage_hists.values(),
+    batcher.batch_size_hist,
+    batcher.queue_wait_hist,
+    batcher.inference_hist,
+    detection_writer.write_hist,
+    Gauge("inference_queue_depth", "Images waiting for an inference worker", fn=lambda: batcher.queue_depth),
+    Counter("inference_rejected_total", "Uploads rejected because the inference queue was full",
+            fn=lambda: batcher.rejected),
+    Gauge("model_ready", "1 once a model is loaded and warmed up", fn=lambda: model_registry.ready),
+    Gauge("model_load_seconds", "Time to load the active model's weights",
+          fn=lambda: model_registry.current.load_seconds if model_registry.current else None),
+    Gauge("model_warmup_seconds", "Time spent warming up the active model",
+          fn=lambda: model_registry.current.warmup_seconds if model_registry.current else None),
+    Counter("result_cache_lookups_total", "Result cache lookups by outcome", {"result": "hit"},
+            fn=lambda: result_cache.hits),
+    Counter("result_cache_lookups_total", labels={"result": "persistent_hit"},
+            fn=lambda: result_cache.persistent_hits),
+    Counter("result_cache_lookups_total", labels={"result": "miss"}, fn=lambda: result_cache.misses),
+    Gauge("result_cache_hit_ratio", "Share of lookups served from the result cache",
+          fn=lambda: result_cache.stats()["hit_rate"]),
+    Gauge("result_cache_bytes", "Approximate size of the in-memory result cache",
+          fn=lambda: result_cache.stats()["bytes"]),
+    Gauge("db_up", "Last known MongoDB reachability", fn=db_available),
+    Gauge("db_writer_queue_depth", "Detection records waiting to be written", fn=lambda: detection_writer.queue_depth),
+    Counter("db_records_total", "Detection records by write outcome", {"outcome": "written"},
+            fn=lambda: detection_writer.written),
+    Counter("db_records_total", labels={"outcome": "spilled"}, fn=lambda: detection_writer.spilled),
+    Counter("db_records_total", labels={"outcome": "replayed"}, fn=lambda: detection_writer.replayed),
+    Counter("db_records_total", labels={"outcome": "dropped"}, fn=lambda: detection_writer.dropped),
+    Counter("db_write_failures_total", "Failed insert_many batches", fn=lambda: detection_writer.failures),
+    Counter("decode_buffers_total", "Decode buffers by source", {"source": "allocated"},
+            fn=lambda: decode_pool.allocated),
+    Counter("decode_buffers_total", labels={"source": "reused"}, fn=lambda: decode_pool.reused),
+    Gauge("streams_active", "Open /stream connections", fn=lambda: len(active_streams)),
+    Counter("stream_frames_total", "Live stream frames by outcome", {"outcome": "received"},
+            fn=lambda: stream_stats()["received"]),
+    Counter("stream_frames_total", labels={"outcome": "processed"}, fn=lambda: stream_stats()["processed"]),
+    Counter("stream_frames_total", labels={"outcome": "dropped"}, fn=lambda: stream_stats()["dropped"]),
+    Gauge("process_memory_bytes", "Memory of this worker process", {"kind": "rss"},
+          fn=lambda: prefork.process_memory().get("rss_mb", 0) * 2 ** 20),
+    Gauge("process_memory_bytes", labels={"kind": "pss"},
+          fn=lambda: prefork.process_memory().get("pss_mb", 0) * 2 ** 20),
+)
+http_in_flight = metrics_registry.register(Gauge("http_requests_in_flight", "Requests currently being handled"))
+_http_metrics = {}
+_http_metrics_lock = threading.Lock()
 
-if model is None:
-    print("❌ No valid model found. Please ensure a trained YOLO model exists in the models folder.")
-    print("   Supported: best.pt, hello.pt, best.onnx")
+def http_metrics(method: str, route: str, status: int):
+    """Request counter and latency histogram for one (method, route, status)"""
+    key = (method, route, status)
+    with _http_metrics_lock:
+        if key not in _http_metrics:
+            labels = {"method": method, "route": route, "status": str(status)}
+            _http_metrics[key] = metrics_registry.register(
+                Counter("http_requests_total", "Handled requests", labels),
+                Histogram("http_request_ms", LATENCY_BUCKETS_MS, "Time to produce response headers", labels),
+            )
+        return _http_metrics[key]
+
+# Opt-in sampling profiler: PROFILE_SAMPLE_RATE profiles a random share of
+# requests, POST /admin/profile arms the next N; collapsed stacks land in PROFILE_DIR
+request_profiler = RequestProfiler(
+    os.getenv("PROFILE_DIR", str(Path(__file__).parent / "profiles")),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    started = time.perf_counter()
+    http_in_flight.inc()
+    status = 500
+    try:
+        with request_profiler.profile(request.method, request.url.path):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_in_flight.dec()
+        route = request.scope.get("route")
+        counter, hist = http_metrics(request.method, route.path if route is not None else "unmatched", status)
+        counter.inc()
+        hist.observe((time.perf_counter() - started) * 1000)
 
 # Root endpoint
 @app.get("/")
 def root():
     return {
         "message": "TreeSense API is running",
-        "model_loaded": model is not None,
-        "endpoints": ["/upload", "/detections", "/detections/{id}"]
+        "model_loaded": model_registry.ready,
+        "endpoints": ["/upload", "/upload/geotiff", "/jobs", "/jobs/{id}", "/jobs/{id}/results",
+                      "/detections", "/detections/stats", "/detections/stats/daily", "/detections/stats/sites",
+                      "/detections/stats/confidence", "/detections/{id}", "/detections/{id}/image",
+                      "/detections/{id}/thumbnail", "/trees", "/trees/count",
+                      "/trees/density/{z}/{x}/{y}", "/stream", "/surveys", "/workers", "/stats", "/metrics", "/ready", "/admin/model"]
     }
 
 # Tree detection endpoint
 @app.post("/upload")
-async def detect_trees(file: UploadFile = File(...)):
-    """Upload an image and detect trees"""
+async def detect_trees(
+    file: UploadFile = File(...),
+    tiled: bool = False,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    tile_overlap: float = DEFAULT_OVERLAP,
+    site: str = None,
+):
+    """Upload an image and detect trees.
+
+    With `?tiled=true` the image is sliced into overlapping tiles (for large
+    aerial orthomosaics) instead of being downsampled to the model input size.
+    `site` tags the record for the per-site statistics.
+    """
     try:
         # Validate file type
         if not file.content_type.startswith("image/"):
             raise HTTPException(400, "File must be an image")
         
-        # Read image
+        # Check if model is loaded
+        require_model()
+        
+        if tiled and (tile_size < 32 or not 0 <= tile_overlap < 1):
+            raise HTTPException(400, "tile_size must be >= 32 and tile_overlap in [0, 1)")
+        
+        timings = {}
+        t0 = time.perf_counter()
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        # Keep the original (for rendering annotated images) while inference runs
+        source_stored = asyncio.ensure_future(run_in_threadpool(store_source, contents))
+        t1 = time.perf_counter()
+        timings["read"] = t1 - t0
         
-        # Check if model is loaded
-        if model is None:
-            raise HTTPException(500, "ML model not loaded")
+        # Look up the result cache before decoding anything
+        cache_key = await run_in_threadpool(
+            result_cache.key, contents, inference_params(tiled, tile_size, tile_overlap))
+        cached = await run_in_threadpool(result_cache.get, cache_key)
+        t2 = time.perf_counter()
+        timings["cache_lookup"] = t2 - t1
         
-        # Run detection
-        results = model(image, conf=0.25)
+        if cached is not None:
+            result_data = cached
+        else:
+            # Decode in the threadpool so the event loop stays free. Tiled mode
+            # needs full resolution; otherwise JPEGs decode at reduced scale.
+            try:
+                image = await run_in_threadpool(
+                    decode_image, contents,
+                    None if tiled else model_input_size(),
+                    MAX_IMAGE_PIXELS,
+                    not tiled,
+                    None if tiled else decode_pool,
+                )
+            except ImageTooLargeError as e:
+                raise HTTPException(413, str(e))
+            del contents
+            t3 = time.perf_counter()
+            timings["decode"] = t3 - t2
+            
+            tiles = None
+            try:
+                if tiled:
+                    boxes, scores, tiles = await predict_tiled(image.array, tile_size, tile_overlap)
+                else:
+                    # Run detection (batched with other concurrent uploads)
+                    result = await submit_or_503(image.array)
+            except asyncio.CancelledError:
+                image.detach()  # an inference worker may still be reading the buffer
+                raise
+            finally:
+                image.release()
+            t4 = time.perf_counter()
+            timings["inference"] = t4 - t3
+            
+            # Extract results
+            if not tiled:
+                boxes, scores = boxes_from_result(result)
+            result_data = summarize_detections(boxes, scores, image, tiles)
+            timings["extract"] = time.perf_counter() - t4
+            await run_in_threadpool(result_cache.put, cache_key, result_data)
         
-        # Extract results
-        boxes = results[0].boxes
-        tree_count = len(boxes)
-        confidences = boxes.conf.tolist() if tree_count > 0 else []
-        avg_confidence = sum(confidences) / len(confidences) if confidences else 0
+        tree_count = result_data["tree_count"]
         
         # Prepare detection data
         detection_data = {
             "filename": file.filename,
-            "tree_count": tree_count,
-            "avg_confidence": round(avg_confidence, 2),
-            "confidences": [round(c, 2) for c in confidences],
-            "image_size": {
-                "width": image.width,
-                "height": image.height
-            },
-            "timestamp": datetime.now().isoformat()
+            **result_data,
+            "timestamp": datetime.now(timezone.utc)
         }
+        if site:
+            detection_data["site"] = site
+        image_key = await source_stored
+        if image_key:
+            detection_data["image_key"] = image_key
+        geometry = expand_geometry({"geometry": result_data["geometry"]})
         
-        # Save to MongoDB (non-fatal if DB is down)
+        # Queue for MongoDB (written in the background; spilled to disk if the DB is down)
         response_data = {
             "filename": detection_data["filename"],
             "tree_count": detection_data["tree_count"],
             "avg_confidence": detection_data["avg_confidence"],
-            "confidences": detection_data["confidences"],
+            "confidences": geometry.get("confidences", []),
+            "boxes": geometry.get("boxes", []),
             "image_size": detection_data["image_size"],
-            "timestamp": detection_data["timestamp"]
+            "timestamp": detection_data["timestamp"].isoformat(),
+            "cached": cached is not None,
         }
-        try:
-            if db_available():
-                result = db.detections.insert_one(detection_data)
-                response_data["id"] = str(result.inserted_id)
-                response_data["db_saved"] = True
-            else:
-                response_data["db_saved"] = False
-        except PyMongoError as e:
-            # Log and proceed; still return inference result quickly
-            print(f"⚠️ MongoDB save failed: {e}")
+        if "tiles" in detection_data:
+            response_data["tiles"] = detection_data["tiles"]
+        if site:
+            response_data["site"] = site
+        t5 = time.perf_counter()
+        inserted_id = detection_writer.enqueue(detection_data)
+        if inserted_id is not None:
+            response_data["id"] = str(inserted_id)
+            response_data["db_saved"] = True
+            if image_key:
+                response_data["image_url"] = f"/detections/{inserted_id}/image"
+                response_data["thumbnail_url"] = f"/detections/{inserted_id}/thumbnail"
+        else:
             response_data["db_saved"] = False
+        t6 = time.perf_counter()
+        timings["persist"] = t6 - t5
+        timings["total"] = t6 - t0
+        for stage, seconds in timings.items():
+            stage_hists[stage].observe(seconds * 1000)
+        response_data["timings_ms"] = {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()}
         
         return {
             "success": True,
@@ -143,10 +692,427 @@ async def detect_trees(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(500, f"Error processing image: {str(e)}")
 
+# GeoTIFF / COG detection endpoint
+@app.post("/upload/geotiff")
+async def detect_trees_geotiff(
+    file: UploadFile = File(...),
+    format: str = "geojson",
+    geometry: str = "point",
+    crs: str = None,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    tile_overlap: float = DEFAULT_OVERLAP,
+    window_size: int = raster.DEFAULT_WINDOW_SIZE,
+    overview_level: int = None,
+    site: str = None,
+):
+    """Detect trees in a georeferenced raster, reading it window by window.
+
+    Returns tree points (or boxes) in map coordinates, streamed as GeoJSON
+    (EPSG:4326 unless `crs` is given) or as a GeoPackage download.
+    """
+    if raster.rasterio is None:
+        raise HTTPException(501, "GeoTIFF support requires rasterio on the server")
+    require_model()
+    if format not in ("geojson", "gpkg") or geometry not in ("point", "box"):
+        raise HTTPException(400, "format must be geojson|gpkg and geometry point|box")
+    if tile_size < 32 or not 0 <= tile_overlap < 1:
+        raise HTTPException(400, "tile_size must be >= 32 and tile_overlap in [0, 1)")
+
+    # Spool the upload to disk in chunks; rasterio reads windows from the file
+    suffix = Path(file.filename or "").suffix or ".tif"
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        await run_in_threadpool(shutil.copyfileobj, file.file, tmp, 1024 * 1024)
+    finally:
+        tmp.close()
+
+    record = {"_id": ObjectId(), "filename": file.filename, "source": "geotiff", "timestamp": datetime.now(timezone.utc)}
+    if site:
+        record["site"] = site
+    windows = index_trees(
+        raster.detect_windows(tmp.name, predict_blocking, tile_size, tile_overlap, window_size, overview_level),
+        record)
+
+    if format == "gpkg":
+        out_path = tmp.name + ".gpkg"
+        try:
+            count = await run_in_threadpool(raster.write_gpkg, windows, out_path, crs, geometry)
+        except Exception as e:
+            os.unlink(tmp.name)
+            raise HTTPException(500, f"Error processing raster: {str(e)}")
+        os.unlink(tmp.name)
+        record["tree_count"] = count
+        await run_in_threadpool(save_summary, record)
+        return FileResponse(
+            out_path,
+            media_type="application/geopackage+sqlite3",
+            filename=f"{Path(file.filename or 'trees').stem}_trees.gpkg",
+            headers={"X-Tree-Count": str(count)},
+            background=BackgroundTask(os.unlink, out_path),
+        )
+
+    def stream():
+        summary = {}
+        try:
+            yield from raster.iter_geojson(windows, crs or "EPSG:4326", geometry, summary)
+            record.update(tree_count=summary["tree_count"], avg_confidence=summary["avg_confidence"],
+                          crs=summary["crs"])
+            save_summary(record)
+        finally:
+            os.unlink(tmp.name)
+
+    return StreamingResponse(stream(), media_type="application/geo+json")
+
+def survey_json(doc: dict) -> dict:
+    doc["id"] = str(doc.pop("_id"))
+    if doc.get("previous_id") is not None:
+        doc["previous_id"] = str(doc["previous_id"])
+    doc["timestamp"] = doc["timestamp"].isoformat()
+    return doc
+
+def find_survey(survey_id: str) -> dict:
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    survey = survey_store.get(ObjectId(survey_id)) if ObjectId.is_valid(survey_id) else None
+    if survey is None:
+        raise HTTPException(404, "Survey not found")
+    return survey
+
+# Repeat survey of a site (incremental)
+@app.post("/surveys", status_code=201)
+async def run_survey(
+    site: str,
+    file: UploadFile = File(...),
+    tile_size: int = DEFAULT_TILE_SIZE,
+    tile_overlap: float = DEFAULT_OVERLAP,
+    window_size: int = raster.DEFAULT_WINDOW_SIZE,
+    overview_level: int = None,
+    max_distance: int = None,
+):
+    """Count trees in a new orthomosaic of `site`, re-running the model only on
+    tiles that changed since the site's previous survey.
+
+    Returns the count with tile/tree change totals; the per-tile change report
+    is at `/surveys/{id}/tiles`.
+    """
+    if raster.rasterio is None:
+        raise HTTPException(501, "GeoTIFF support requires rasterio on the server")
+    require_model()
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    if tile_size < 32 or not 0 <= tile_overlap < 1:
+        raise HTTPException(400, "tile_size must be >= 32 and tile_overlap in [0, 1)")
+    max_distance = SURVEY_MAX_DISTANCE if max_distance is None else max_distance
+    if not 0 <= max_distance <= 255:
+        raise HTTPException(400, "max_distance must be in [0, 255]")
+
+    suffix = Path(file.filename or "").suffix or ".tif"
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        await run_in_threadpool(shutil.copyfileobj, file.file, tmp, 1024 * 1024)
+    finally:
+        tmp.close()
+
+    started = time.perf_counter()
+    try:
+        meta = await run_in_threadpool(surveys.raster_meta, tmp.name, overview_level)
+        core, margin = surveys.grid_layout(tile_size, tile_overlap)
+        # Tiles are only comparable under the same model and inference settings
+        params = {**inference_params(True, tile_size, tile_overlap), "model": model_registry.current.model_id}
+        grid = surveys.grid_signature(meta["crs"], meta["transform"], core, margin, params)
+        previous_survey, previous = await run_in_threadpool(survey_store.previous, site, grid)
+        # A survey covers the whole site: its trees replace those of earlier
+        # surveys (reused tiles would otherwise index the same trees again)
+        earlier = await run_in_threadpool(survey_store.site_survey_ids, site)
+        trees_replaced = await run_in_threadpool(
+            spatial_index.remove, {"site": site, "detection_id": {"$in": earlier}}) if earlier else 0
+
+        record = {"_id": ObjectId(), "filename": file.filename, "source": "survey", "site": site,
+                  "timestamp": datetime.now(timezone.utc)}
+        tiles = []
+        windows = index_trees(
+            surveys.survey_windows(tmp.name, predict_blocking, grid, previous, tiles, window_size,
+                                   max_distance, overview_level, BATCH_MAX_SIZE),
+            record)
+
+        def tally():
+            count, conf_sum, hist = 0, 0.0, np.zeros(CONF_BINS, dtype=np.int64)
+            for _, scores, _, _ in windows:
+                count += len(scores)
+                conf_sum += float(scores.sum())
+                hist += confidence_histogram(scores)
+            return count, conf_sum, hist
+
+        count, conf_sum, hist = await run_in_threadpool(tally)
+        avg_confidence = round(conf_sum / count, 2) if count else 0
+        survey = {
+            "_id": record["_id"],
+            "site": site,
+            "filename": file.filename,
+            "timestamp": record["timestamp"],
+            "crs": str(meta["crs"]) if meta["crs"] is not None else None,
+            "grid": grid,
+            "previous_id": previous_survey["_id"] if previous_survey else None,
+            "tree_count": count,
+            "avg_confidence": avg_confidence,
+            "trees_replaced": trees_replaced,
+            **surveys.change_summary(tiles, previous),
+            "seconds": round(time.perf_counter() - started, 2),
+        }
+        await run_in_threadpool(survey_store.save, survey, tiles)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Error processing survey: {str(e)}")
+    finally:
+        os.unlink(tmp.name)
+
+    record.update(tree_count=count, avg_confidence=avg_confidence, conf_hist=hist.tolist(), crs=survey["crs"])
+    save_summary(record)
+    return {"success": True, "message": f"Counted {count} trees", "data": survey_json(survey)}
+
+# Surveys of a site, newest first
+@app.get("/surveys")
+def list_surveys(site: str = None, limit: int = 50):
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    try:
+        docs = survey_store.recent(site, max(1, min(limit, 500)))
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error fetching surveys: {str(e)}")
+    return {"success": True, "count": len(docs), "data": [survey_json(d) for d in docs]}
+
+@app.get("/surveys/{survey_id}")
+def get_survey(survey_id: str):
+    return {"success": True, "data": survey_json(find_survey(survey_id))}
+
+# Per-tile change report
+@app.get("/surveys/{survey_id}/tiles")
+def survey_tiles(survey_id: str, status: str = None, limit: int = 1000, skip: int = 0):
+    """Tiles of a survey in grid order with their status (`unchanged`, `similar`,
+    `changed`, `new`), tree counts and the change against the previous survey"""
+    if status is not None and status not in surveys.STATUSES:
+        raise HTTPException(400, f"status must be one of {', '.join(surveys.STATUSES)}")
+    survey = find_survey(survey_id)
+    try:
+        rows = survey_store.report(survey["_id"], status, max(1, min(limit, 10000)), max(0, skip))
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error fetching survey tiles: {str(e)}")
+    return {"success": True, "count": len(rows), "crs": survey.get("crs"), "data": rows}
+
+def decode_frame(contents: bytes):
+    try:
+        return decode_image(contents, model_input_size(), MAX_IMAGE_PIXELS, pool=decode_pool)
+    except Exception:
+        return None  # corrupt or oversized frame: counted as dropped
+
+async def infer_frames(session, frames, include_boxes):
+    """Decode, batch and track one group of stream frames; returns the progress messages"""
+    images = await run_in_threadpool(lambda: [decode_frame(payload) for _, _, payload in frames])
+    futures = []
+    for image in images:
+        try:
+            futures.append(asyncio.wrap_future(batcher.submit(image.array)) if image is not None else None)
+        except QueueFullError:
+            futures.append(None)  # shared queue is full: drop the frame instead of waiting
+    try:
+        results = await asyncio.gather(*[f for f in futures if f is not None], return_exceptions=True)
+    except asyncio.CancelledError:
+        for image in images:
+            if image is not None:
+                image.detach()  # an inference worker may still be reading the buffer
+        raise
+    results = iter(results)
+    messages = []
+    for (seq, received_at, _), image, future in zip(frames, images, futures):
+        result = next(results) if future is not None else None
+        if result is None or isinstance(result, Exception):
+            session.dropped += 1
+        else:
+            boxes, scores = boxes_from_result(result)
+            messages.append(session.update(seq, image.array, boxes, scores, received_at, include_boxes))
+        if image is not None:
+            image.release()
+    return messages
+
+# Live video stream (WebSocket)
+@app.websocket("/stream")
+async def stream_video(
+    websocket: WebSocket,
+    site: str = None,
+    name: str = None,
+    boxes: bool = False,
+    min_hits: int = 2,
+    max_pending: int = None,
+):
+    """Count trees in a live video stream.
+
+    The client sends one encoded frame (JPEG/PNG) per binary message and
+    `{"type": "end"}` as text when done. Each processed frame is answered with
+    a `frame` message holding the running unique-tree count; frames are
+    dropped when inference falls behind. The final `summary` is also saved as
+    a detection record (`source: "stream"`).
+    """
+    await websocket.accept()
+    if not model_registry.ready:
+        await websocket.send_json({"type": "error", "message": "ML model is not loaded yet"})
+        await websocket.close(code=1013)
+        return
+    if max_pending is not None and max_pending < 1:
+        await websocket.send_json({"type": "error", "message": "max_pending must be >= 1"})
+        await websocket.close(code=1008)
+        return
+    # Clients may only lower the buffer: STREAM_MAX_PENDING bounds the frames held per connection
+    max_pending = STREAM_MAX_PENDING if max_pending is None else min(max_pending, STREAM_MAX_PENDING)
+    session = streaming.StreamSession(max_pending, STREAM_MAX_LATENCY_MS, min_hits=min_hits)
+    pending = deque()
+    wake = asyncio.Event()
+    state = {"ended": False, "connected": True}
+
+    async def receive():
+        seq = 0
+        try:
+            while True:
+                msg = await websocket.receive()
+                if msg["type"] == "websocket.disconnect":
+                    state["connected"] = False
+                    break
+                if msg.get("bytes") is not None:
+                    session.admit(pending, (seq, time.perf_counter(), msg["bytes"]))
+                    seq += 1
+                    wake.set()
+                elif msg.get("text"):
+                    try:
+                        if json.loads(msg["text"]).get("type") == "end":
+                            break
+                    except (ValueError, AttributeError):
+                        pass
+        finally:
+            state["ended"] = True
+            wake.set()
+
+    active_streams.add(session)
+    receiver = asyncio.create_task(receive())
+    try:
+        while state["connected"]:
+            frames = session.take(pending, BATCH_MAX_SIZE)
+            if not frames:
+                if state["ended"]:
+                    break
+                wake.clear()
+                await wake.wait()
+                continue
+            for msg in await infer_frames(session, frames, boxes):
+                await websocket.send_json(msg)
+
+        summary = session.summary()
+        if session.processed:
+            scores = np.asarray(session.tracker.confirmed_scores)
+            record = {
+                "filename": name or "stream",
+                "source": "stream",
+                "tree_count": summary["unique"],
+                "avg_confidence": summary["avg_confidence"],
+                "conf_hist": confidence_histogram(scores),
+                "frames": {k: summary[k] for k in ("received", "processed", "dropped")},
+                "timestamp": datetime.now(timezone.utc),
+            }
+            if site:
+                record["site"] = site
+            inserted_id = detection_writer.enqueue(record)
+            summary["id"] = str(inserted_id) if inserted_id is not None else None
+        if state["connected"]:
+            await websocket.send_json(summary)
+            await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        active_streams.discard(session)
+        stream_totals["streams"] += 1
+        for key in ("received", "processed", "dropped"):
+            stream_totals[key] += getattr(session, key)
+
+# Bulk job submission
+@app.post("/jobs", status_code=202)
+async def create_job(files: List[UploadFile] = File(...), site: str = Form(None)):
+    """Submit many images and/or zip/tar archives for background detection.
+
+    Returns a job id immediately; poll `/jobs/{id}` for progress and download
+    `/jobs/{id}/results` (JSONL) when done.
+    """
+    accepted = [f for f in files if f.filename and (is_image(f.filename) or is_archive(f.filename))]
+    if not accepted:
+        raise HTTPException(400, "No image or archive files in the request")
+
+    job_id = job_store.create()
+    input_dir = job_store.input_dir(job_id)
+
+    def save_all():
+        for i, f in enumerate(accepted):
+            # Index prefix keeps submission order and avoids name collisions
+            with open(input_dir / f"{i:06d}_{Path(f.filename).name}", "wb") as out:
+                shutil.copyfileobj(f.file, out, 1024 * 1024)
+
+    await run_in_threadpool(save_all)
+    await run_in_threadpool(job_store.enqueue, job_id, site)
+    job_runner.notify()
+    return {
+        "success": True,
+        "job_id": job_id,
+        "files": len(accepted),
+        "skipped": len(files) - len(accepted),
+        "status_url": f"/jobs/{job_id}",
+        "results_url": f"/jobs/{job_id}/results"
+    }
+
+# Bulk job progress
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    status = job_store.status(job_id)
+    if status is None:
+        raise HTTPException(404, "Job not found")
+    return {"success": True, "data": status}
+
+# Bulk job results (streamed JSONL, one line per processed image)
+@app.get("/jobs/{job_id}/results")
+def get_job_results(job_id: str):
+    if job_store.status(job_id) is None:
+        raise HTTPException(404, "Job not found")
+    lines = (result + "\n" for result in job_store.iter_results(job_id))
+    return StreamingResponse(
+        lines,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{job_id}.jsonl"'},
+    )
+
 # Get all detections
 @app.get("/detections")
-def get_detections(limit: int = 50):
-    """Fetch all detection records"""
+def get_detections(
+    limit: int = 50,
+    before: str = None,
+    fields: str = "summary",
+    start: datetime = None,
+    end: datetime = None,
+    min_trees: int = None,
+    max_trees: int = None,
+    filename: str = None,
+    site: str = None,
+):
+    """Fetch detection records, newest first.
+
+    Paginate by passing the previous page's `next_cursor` as `before`.
+    `fields=summary` (default) omits per-box arrays; `fields=full` returns
+    whole documents (boxes and confidences unpacked). `start`/`end` (ISO
+    datetimes), `min_trees`/`max_trees`, `filename` and `site` filter the listing.
+    """
+    if fields not in ("summary", "full"):
+        raise HTTPException(400, "fields must be 'summary' or 'full'")
+    limit = max(1, min(limit, 500))
+    try:
+        query = build_filter(before, start, end, min_trees, max_trees, filename, site)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     try:
         if not db_available():
             # Return 200 with empty data and a message to avoid frontend hard-fail
@@ -157,25 +1123,137 @@ def get_detections(limit: int = 50):
                 "message": "Database not available"
             }
 
+        projection = SUMMARY_PROJECTION if fields == "summary" else None
         detections = list(
-            db.detections.find()
-            .sort("timestamp", -1)
+            db.detections.find(query, projection)
+            .sort(LIST_SORT)
             .limit(limit)
         )
+        next_cursor = encode_cursor(detections[-1]) if len(detections) == limit else None
 
         # Convert ObjectId to string for JSON serialization
         for detection in detections:
             if "_id" in detection:
                 detection["id"] = str(detection.pop("_id"))
+            expand_geometry(detection)
 
         return {
             "success": True,
             "count": len(detections),
-            "data": detections
+            "data": detections,
+            "next_cursor": next_cursor
         }
     except Exception as e:
         raise HTTPException(500, f"Error fetching detections: {str(e)}")
 
+def stats_or_503(fn, *args, **kwargs):
+    """Run a rollup query, mapping an unreachable database to 503"""
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    try:
+        return fn(db.detection_rollups, *args, **kwargs)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error computing statistics: {str(e)}")
+
+# Detection statistics (computed from the per-day/per-site rollups, not the raw records)
+@app.get("/detections/stats")
+def get_detection_stats(start: date = None, end: date = None, site: str = None):
+    """Totals over all records, or over the UTC days `start`..`end` (inclusive) and one `site`"""
+    return {"success": True, "data": stats_or_503(aggregates.totals, start, end, site)}
+
+@app.get("/detections/stats/daily")
+def get_daily_stats(start: date = None, end: date = None, site: str = None):
+    """Images, trees and average confidence per UTC day"""
+    return {"success": True, "data": stats_or_503(aggregates.daily, start, end, site)}
+
+@app.get("/detections/stats/sites")
+def get_site_stats(start: date = None, end: date = None):
+    """Images, trees and average confidence per site, most trees first"""
+    return {"success": True, "data": stats_or_503(aggregates.by_site, start, end)}
+
+@app.get("/detections/stats/confidence")
+def get_confidence_stats(start: date = None, end: date = None, site: str = None, bins: int = CONF_BINS):
+    """Histogram of individual box confidences"""
+    return {"success": True, "data": stats_or_503(aggregates.confidence_histogram, start, end, site, bins)}
+
+async def render_response(detection_id, if_none_match, max_side=None, fmt="jpeg", min_conf=0.0, labels=False):
+    """Serve one rendering of a detection: 304 for a matching ETag, the cached
+    file when there is one, otherwise render from the stored original"""
+    if not ObjectId.is_valid(detection_id):
+        raise HTTPException(404, "Detection not found")
+    if fmt not in renders.FORMATS:
+        raise HTTPException(400, f"format must be one of {', '.join(renders.FORMATS)}")
+    if not 0 <= min_conf <= 1:
+        raise HTTPException(400, "min_conf must be in [0, 1]")
+    key = renders.render_key(detection_id, max_side, fmt, min_conf, labels)
+    media_type = renders.FORMATS[fmt][0]
+    headers = {"ETag": f'"{key}"', "Cache-Control": f"public, max-age={RENDER_MAX_AGE}"}
+    # Records never change, so the ETag alone decides (no DB or disk access)
+    if renders.etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    path = await run_in_threadpool(render_cache.get, key)
+    if path is None:
+        if not db_available():
+            raise HTTPException(503, "Database not available")
+        try:
+            detection = await run_in_threadpool(
+                db.detections.find_one, {"_id": ObjectId(detection_id)},
+                {"image_key": 1, "geometry": 1, "boxes": 1, "confidences": 1})
+        except PyMongoError as e:
+            raise HTTPException(500, f"Error fetching detection: {str(e)}")
+        if not detection:
+            raise HTTPException(404, "Detection not found")
+        source = source_images.get(detection["image_key"]) if detection.get("image_key") else None
+        if source is None:
+            raise HTTPException(404, "Original image not available for this detection")
+        expand_geometry(detection)
+
+        def draw():
+            return renders.render(source.read_bytes(), detection.get("boxes", []), detection.get("confidences", []),
+                                  max_side, fmt, min_conf, labels, MAX_IMAGE_PIXELS)
+
+        try:
+            data = await run_in_threadpool(draw)
+        except FileNotFoundError:  # evicted since the lookup
+            raise HTTPException(404, "Original image not available for this detection")
+        except (ImageTooLargeError, OSError, ValueError) as e:
+            raise HTTPException(500, f"Error rendering image: {str(e)}")
+        try:
+            path = await run_in_threadpool(render_cache.put, key, data)
+        except OSError as e:
+            print(f"⚠️ Could not cache render {key}: {e}")
+            path = None
+        if path is None:  # render cache disabled, the render is larger than it, or the write failed
+            return Response(data, media_type=media_type, headers=headers)
+    # Streamed from disk in chunks; progressive JPEGs display while they arrive
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+# Annotated image of a detection
+@app.get("/detections/{detection_id}/image")
+async def get_detection_image(
+    detection_id: str,
+    format: str = "jpeg",
+    min_conf: float = 0.0,
+    labels: bool = False,
+    if_none_match: str = Header(None),
+):
+    """Full-resolution original with the detected boxes drawn on it (no inference)"""
+    return await render_response(detection_id, if_none_match, None, format, min_conf, labels)
+
+# Annotated thumbnail of a detection
+@app.get("/detections/{detection_id}/thumbnail")
+async def get_detection_thumbnail(
+    detection_id: str,
+    size: int = 256,
+    format: str = "jpeg",
+    if_none_match: str = Header(None),
+):
+    """Downsized annotated image; `size` is rounded up to a standard size (64..1024)"""
+    return await render_response(detection_id, if_none_match, renders.thumbnail_size(size), format)
+
 # Get detection by ID
 @app.get("/detections/{detection_id}")
 def get_detection(detection_id: str):
@@ -184,14 +1262,14 @@ def get_detection(detection_id: str):
         if not db_available():
             raise HTTPException(503, "Database not available")
 
-        from bson import ObjectId
         detection = db.detections.find_one({"_id": ObjectId(detection_id)})
         
         if not detection:
             raise HTTPException(404, "Detection not found")
         
-        # Convert ObjectId to string
+        # Convert ObjectId to string, unpack box geometry
         detection["id"] = str(detection.pop("_id"))
+        expand_geometry(detection)
         
         return {
             "success": True,
@@ -202,11 +1280,218 @@ def get_detection(detection_id: str):
     except Exception as e:
         raise HTTPException(500, f"Error fetching detection: {str(e)}")
 
+def parse_bbox(bbox: str):
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(400, "bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not (minx < maxx and miny < maxy):
+        raise HTTPException(400, "bbox must be min_lon,min_lat,max_lon,max_lat")
+    return minx, miny, maxx, maxy
+
+def require_spatial():
+    if spatial.shapely is None:
+        raise HTTPException(501, "Spatial queries require shapely on the server")
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+
+def count_response(geom, site):
+    try:
+        return {"success": True, "data": spatial_index.count(geom, site)}
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error counting trees: {str(e)}")
+
+# Trees in a bounding box (WGS84)
+@app.get("/trees/count")
+def count_trees_bbox(bbox: str, site: str = None):
+    """Count georeferenced trees in `bbox=min_lon,min_lat,max_lon,max_lat`"""
+    require_spatial()
+    return count_response(spatial.shapely.box(*parse_bbox(bbox)), site)
+
+# Trees in a polygon
+@app.post("/trees/count")
+def count_trees_polygon(geometry: dict = Body(...), site: str = None):
+    """Count georeferenced trees in a GeoJSON Polygon / MultiPolygon (or a
+    Feature wrapping one), coordinates in WGS84 lon/lat"""
+    require_spatial()
+    if geometry.get("type") == "Feature":
+        geometry = geometry.get("geometry") or {}
+    if geometry.get("type") not in ("Polygon", "MultiPolygon"):
+        raise HTTPException(400, "Body must be a GeoJSON Polygon or MultiPolygon")
+    try:
+        from shapely.geometry import shape
+        geom = shape(geometry)
+    except Exception as e:
+        raise HTTPException(400, f"Invalid geometry: {e}")
+    if geom.is_empty or not geom.is_valid:
+        raise HTTPException(400, "Invalid geometry")
+    return count_response(geom, site)
+
+# Tree points in a bounding box
+@app.get("/trees")
+def list_trees(bbox: str, site: str = None, limit: int = 1000):
+    """Tree points inside `bbox` as a GeoJSON FeatureCollection (at most `limit`, max 10000)"""
+    require_spatial()
+    minx, miny, maxx, maxy = parse_bbox(bbox)
+    limit = max(1, min(limit, 10000))
+    query = {"loc": {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [[
+        [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]}}}}
+    if site:
+        query["site"] = site
+    try:
+        docs = list(db.trees.find(query, {"_id": 0, "loc": 1, "score": 1, "detection_id": 1}).limit(limit))
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error fetching trees: {str(e)}")
+    features = [{
+        "type": "Feature",
+        "geometry": d["loc"],
+        "properties": {"confidence": d.get("score"), "detection_id": str(d.get("detection_id"))},
+    } for d in docs]
+    return {"type": "FeatureCollection", "features": features, "truncated": len(features) == limit}
+
+# Tree density tiles (slippy-map z/x/y)
+@app.get("/trees/density/{z}/{x}/{y}")
+def density_tile(z: int, x: int, y: int, format: str = "json", vmax: float = None):
+    """Tree counts on a 32x32 grid over a Web Mercator tile, as JSON or a heatmap PNG.
+
+    Zooms 8-16 are read from the precomputed pyramid; deeper zooms are cut
+    from their zoom-16 parent.
+    """
+    if format not in ("json", "png"):
+        raise HTTPException(400, "format must be json or png")
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    try:
+        grid = spatial_index.density_tile(z, x, y)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error reading density tile: {str(e)}")
+    if format == "png":
+        return Response(spatial.density_png(grid, vmax), media_type="image/png",
+                        headers={"Cache-Control": "public, max-age=60"})
+    # cell_zoom: zoom level of the cells the counts were computed at (coarser than z + 5 beyond zoom 16)
+    return {"success": True, "data": {"z": z, "x": x, "y": y, "cells": grid.tolist(),
+                                      "cell_zoom": min(z, spatial.TILE_MAX_ZOOM) + spatial.CELL_BITS,
+                                      "total": int(round(float(grid.sum()))), "max": float(grid.max())}}
+
 # Health check
 @app.get("/health")
 def health_check():
     return {
         "status": "healthy",
-        "model_loaded": model is not None,
-        "database_connected": db_available()
+        "model_loaded": model_registry.ready,
+        "model": model_registry.info(),
+        "database_connected": db_available(),
+        "database_checked_at": db_health.last_check,
+        "db_writer": detection_writer.stats(),
+        "trees_writer": tree_writer.stats()
     }
+
+# Inference statistics (batch size / latency histograms for tuning the batching window)
+@app.get("/stats")
+def get_stats():
+    return {
+        "success": True,
+        "batching": batcher.stats(),
+        "result_cache": result_cache.stats(),
+        "upload_stages_ms": {name: h.snapshot() for name, h in stage_hists.items()},
+        "decode_buffers": {"allocated": decode_pool.allocated, "reused": decode_pool.reused},
+        "profiler": request_profiler.stats(),
+        "spatial": spatial_index.stats(),
+        "streams": stream_stats(),
+        "source_images": source_images.stats(),
+        "render_cache": render_cache.stats(),
+        "worker": prefork.worker_info()
+    }
+
+# Memory of every server process (parent + workers under prefork.py)
+@app.get("/workers")
+def get_workers():
+    return {"success": True, **prefork.workers_report()}
+
+# Prometheus scrape endpoint
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+# Readiness probe: 200 only once a model is loaded and warmed up
+@app.get("/ready")
+def readiness():
+    if not model_registry.ready:
+        raise HTTPException(503, f"Model {model_registry.status}", headers={"Retry-After": "5"})
+    return {"ready": True, "model": model_registry.current.info()}
+
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if token != ADMIN_TOKEN:
+        raise HTTPException(401, "Invalid admin token")
+
+# Active model
+@app.get("/admin/model")
+def get_model(x_admin_token: str = Header(None)):
+    check_admin(x_admin_token)
+    return {"success": True, "data": model_registry.info()}
+
+# Hot swap to another weights file
+@app.post("/admin/model")
+async def swap_model(
+    path: str,
+    imgsz: int = None,
+    warmup_runs: int = None,
+    x_admin_token: str = Header(None),
+):
+    """Load and warm up `path` (relative to models/ or absolute), then switch to it.
+
+    Requests already being inferred finish on the previous model; the
+    previous model keeps serving until the new one is ready.
+    """
+    check_admin(x_admin_token)
+    weights = Path(path)
+    if not weights.is_absolute():
+        weights = MODELS_DIR / weights
+    if weights.suffix.lower() not in BACKENDS:
+        raise HTTPException(400, f"Unsupported model format, expected one of: {', '.join(BACKENDS)}")
+    if not weights.is_file():
+        raise HTTPException(404, f"Model file not found: {weights}")
+    try:
+        handle = await run_in_threadpool(model_registry.load, weights, imgsz, warmup_runs)
+    except Exception as e:
+        raise HTTPException(500, f"Error loading model: {str(e)}")
+    print(f"✅ Swapped model to {weights}")
+    return {"success": True, "data": handle.info()}
+
+# Profile the next N requests
+@app.post("/admin/profile")
+def arm_profiler(requests: int = 1, x_admin_token: str = Header(None)):
+    """Record collapsed-stack profiles (flamegraph.pl / speedscope input) for
+    the next `requests` requests, written to PROFILE_DIR"""
+    check_admin(x_admin_token)
+    request_profiler.profile_next(requests)
+    return {"success": True, "data": request_profiler.stats()}
+
+@app.post("/admin/rollups/rebuild")
+def rebuild_rollups(x_admin_token: str = Header(None)):
+    """Recompute the statistics rollups from the detection records (e.g. after
+    the process died between a write and its rollup update)"""
+    check_admin(x_admin_token)
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    try:
+        n = aggregates.rebuild_rollups(db.detections, db.detection_rollups)
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error rebuilding rollups: {str(e)}")
+    return {"success": True, "data": {"rollups": n}}
+
+@app.post("/admin/density/rebuild")
+def rebuild_density(x_admin_token: str = Header(None)):
+    """Recompute the tree density pyramid from the `trees` collection"""
+    check_admin(x_admin_token)
+    if not db_available():
+        raise HTTPException(503, "Database not available")
+    try:
+        n = spatial_index.rebuild()
+    except PyMongoError as e:
+        raise HTTPException(500, f"Error rebuilding density tiles: {str(e)}")
+    return {"success": True, "data": {"trees": n}}
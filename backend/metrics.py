@@ -0,0 +1,157 @@
+"""Lightweight in-process metrics for the TreeSense backend.
+
+Kept dependency-free on purpose: the histograms are cheap enough to update
+on every request and can be snapshotted as plain dicts for the API, and a
+`MetricsRegistry` renders everything in the Prometheus text format.
+"""
+import bisect
+import threading
+
+# Default latency buckets in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Default batch size buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram:
+    """Thread-safe fixed-bucket histogram (Prometheus-style `le` buckets)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, buckets, description="", labels=None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Return cumulative bucket counts plus count/sum/mean."""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = {}
+        running = 0
+        for bound, c in zip(self.buckets, counts):
+            running += c
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = running + counts[-1]
+        return {
+            "count": count,
+            "sum": round(total, 3),
+            "mean": round(total / count, 3) if count else 0,
+            "buckets": cumulative,
+        }
+
+    def samples(self):
+        snap = self.snapshot()
+        for bound, count in snap["buckets"].items():
+            yield self.name + "_bucket", {**self.labels, "le": bound}, count
+        yield self.name + "_sum", self.labels, snap["sum"]
+        yield self.name + "_count", self.labels, snap["count"]
+
+
+class Counter:
+    """Monotonic counter; `fn` reads the value from elsewhere at scrape time."""
+
+    kind = "counter"
+
+    def __init__(self, name, description="", labels=None, fn=None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.fn = fn
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self.fn() if self.fn is not None else self._value
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    """Value that can go up and down (or is read through `fn` at scrape time)."""
+
+    kind = "gauge"
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together for a `/metrics` scrape.
+
+    Metrics sharing a name (but not labels) form one Prometheus family.
+    """
+
+    def __init__(self, namespace="treesense"):
+        self.namespace = namespace
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, *metrics):
+        with self._lock:
+            self._metrics.extend(metrics)
+        return metrics[0] if len(metrics) == 1 else metrics
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        families = {}
+        for m in metrics:
+            families.setdefault(m.name, []).append(m)
+        lines = []
+        for name, members in families.items():
+            full = f"{self.namespace}_{name}" if self.namespace else name
+            if members[0].description:
+                lines.append(f"# HELP {full} {members[0].description}")
+            lines.append(f"# TYPE {full} {members[0].kind}")
+            for m in members:
+                try:
+                    samples = list(m.samples())
+                except Exception:
+                    continue  # a broken callback must not fail the whole scrape
+                for sample_name, labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{full}{sample_name[len(name):]}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
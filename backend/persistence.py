@@ -0,0 +1,246 @@
+"""Background MongoDB health tracking and write-behind persistence.
+
+Keeps database round trips off the request path:
+
+- `DBHealthMonitor` pings the server on a background thread and exposes the
+  last known state, so request handlers never ping themselves.
+- `DetectionWriter` queues records in memory and a background thread writes
+  them with `insert_many` once a batch is full or a flush interval passes.
+  While MongoDB is unreachable batches are spilled to a bounded JSONL file on
+  local disk and replayed when the connection comes back.
+
+Records get their `_id` (an ObjectId) before being queued, so the API can
+return the id immediately and replays never create duplicates.
+"""
+import os
+import queue
+import threading
+import time
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from metrics import Histogram, LATENCY_BUCKETS_MS
+
+_STOP = object()
+
+
+class DBHealthMonitor:
+    """Pings the database every `interval` seconds on a background thread."""
+
+    def __init__(self, db, interval=5.0):
+        self.db = db
+        self.interval = float(interval)
+        self.available = False
+        self.last_check = None
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def on_recover(self, callback):
+        """Register a callback fired when the database becomes reachable again"""
+        self._listeners.append(callback)
+
+    def check_now(self) -> bool:
+        try:
+            self.db.command("ping")
+            ok = True
+        except Exception:
+            ok = False
+        recovered = ok and not self.available
+        self.available = ok
+        self.last_check = time.time()
+        if recovered:
+            for cb in self._listeners:
+                cb()
+        return ok
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 5)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_now()
+            self._stop.wait(self.interval)
+
+
+class DetectionWriter:
+    """Write-behind queue for detection records.
+
+    Batches are flushed with `insert_many` when `batch_size` records are
+    queued or `flush_interval` seconds have passed. Failed or unreachable
+    writes go to `spill_path` (at most `spill_max_bytes`) and are replayed once
+    the health monitor reports the database is back.
+    """
+
+    def __init__(self, collection, health, batch_size=100, flush_interval=1.0,
+                 spill_path="detections_spill.jsonl", spill_max_bytes=64 * 1024 * 1024,
+                 max_queue=10000, on_written=None):
+        self.collection = collection
+        # Called with the records a batch actually inserted (duplicates of
+        # already written ones excluded), e.g. to maintain rollups
+        self.on_written = on_written
+        self.health = health
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.spill_path = spill_path
+        self.spill_max_bytes = int(spill_max_bytes)
+        self.max_queue = max(1, int(max_queue))
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._spill_lock = threading.Lock()
+        self._replay_needed = threading.Event()
+        self._thread = None
+        self.written = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failures = 0
+        self.write_hist = Histogram(
+            "db_write_ms", LATENCY_BUCKETS_MS, "Duration of one insert_many batch (including failed ones)")
+
+        health.on_recover(self._replay_needed.set)
+        if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > 0:
+            self._replay_needed.set()
+
+    def enqueue(self, record: dict):
+        """Queue a record for writing; assigns `_id` if missing and returns it.
+
+        Returns None only if the record had to be dropped (queue and spill full).
+        """
+        record.setdefault("_id", ObjectId())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if not self._spill([record]):
+                return None
+        return record["_id"]
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """Flush whatever is queued (or spill it) and stop the writer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            if batch:
+                self._write(batch)
+            if self._replay_needed.is_set() and self.health.available:
+                self._replay()
+
+    def _insert(self, records) -> bool:
+        started = time.perf_counter()
+        inserted = records
+        try:
+            self.collection.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys mean a record was already written (e.g. a replay
+            # after a partially applied batch); anything else is a real failure
+            errors = e.details.get("writeErrors", [])
+            if not all(err.get("code") == 11000 for err in errors):
+                self.failures += 1
+                print(f"⚠️ MongoDB batch write failed: {e}")
+                return False
+            duplicates = {err.get("index") for err in errors}
+            inserted = [r for i, r in enumerate(records) if i not in duplicates]
+        except PyMongoError as e:
+            self.failures += 1
+            print(f"⚠️ MongoDB batch write failed: {e}")
+            return False
+        finally:
+            self.write_hist.observe((time.perf_counter() - started) * 1000)
+        if self.on_written is not None and inserted:
+            try:
+                self.on_written(inserted)
+            except Exception as e:
+                print(f"⚠️ Post-write hook failed: {e}")
+        return True
+
+    def _write(self, batch):
+        if self.health.available and self._insert(batch):
+            self.written += len(batch)
+            return
+        self._spill(batch)
+
+    def _spill(self, records) -> bool:
+        lines = "".join(json_util.dumps(r) + "\n" for r in records)
+        with self._spill_lock:
+            size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+            if size + len(lines) > self.spill_max_bytes:
+                self.dropped += len(records)
+                print(f"⚠️ Spill buffer full, dropping {len(records)} detection record(s)")
+                return False
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self.spilled += len(records)
+        self._replay_needed.set()
+        return True
+
+    def _replay(self):
+        """Write spilled records back to MongoDB in batches; keeps the file on failure"""
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                self._replay_needed.clear()
+                return
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                records = [json_util.loads(line) for line in f if line.strip()]
+            for i in range(0, len(records), self.batch_size):
+                chunk = records[i:i + self.batch_size]
+                if not self._insert(chunk):
+                    # Keep what is left for the next attempt
+                    with open(self.spill_path, "w", encoding="utf-8") as f:
+                        f.writelines(json_util.dumps(r) + "\n" for r in records[i:])
+                    return
+                self.replayed += len(chunk)
+                self.written += len(chunk)
+            os.remove(self.spill_path)
+            self._replay_needed.clear()
+        print(f"✅ Replayed {len(records)} spilled detection record(s)")
+
+    def stats(self):
+        spill_bytes = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "spill_bytes": spill_bytes,
+            "write_ms": self.write_hist.snapshot(),
+        }
@@ -0,0 +1,348 @@
+"""Pre-fork multi-worker server with a load-once model.
+
+`uvicorn --workers N` starts N fresh interpreters: every one of them imports
+torch and ultralytics and loads its own copy of the weights. This launcher
+loads them once and forks the workers from the loaded process instead:
+
+- The parent imports the heavy libraries and loads and warms up the PyTorch
+  weights (`registry.preload`) before forking. Workers inherit the model
+  copy-on-write and start serving after a short warm-up of their own.
+  `gc.freeze()` keeps the garbage collector from writing to (and so copying)
+  the inherited objects.
+- Nothing that opens connections or starts threads (the app module with its
+  MongoClient, job store and writers) is imported before fork: each worker
+  imports `main:app` itself.
+- Each worker gets an equal share of the CPUs for its intra-op thread pools
+  (torch, OpenCV, OpenMP/MKL), so N workers don't oversubscribe the cores.
+  `--affinity` also pins every worker to its own cores.
+- All workers accept connections from one listening socket opened by the
+  parent, which restarts workers that die and forwards SIGTERM/SIGINT.
+- Workers share the job store, job files and disk caches, but not spill
+  files (`worker_path` gives each worker its own). Bulk jobs and database
+  maintenance run in worker 0 only (`is_primary`).
+
+    python prefork.py --workers 4 --port 8000
+    python prefork.py --workers 4 --threads 2 --affinity
+
+`GET /workers` reports the memory of the parent and every worker. PSS splits
+shared pages between the processes mapping them, so the PSS total is the
+real footprint of the whole server.
+"""
+import gc
+import importlib
+import os
+import shutil
+import signal
+import socket
+import sys
+import time
+from pathlib import Path
+
+# Imported before fork so workers share their code and data pages
+PRELOAD_MODULES = ("numpy", "cv2", "PIL.Image", "torch", "fastapi", "starlette.applications",
+                   "pymongo", "bson", "uvicorn")
+MODELS_DIR = Path(__file__).parent.parent / "models"
+RESTART_BACKOFF = 1.0  # seconds to wait before restarting a worker that died right after starting
+MAX_FAST_FAILURES = 5  # give up when a worker keeps dying at startup
+
+
+def cpu_list() -> list:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS / Windows
+        return list(range(os.cpu_count() or 1))
+
+
+def worker_cpus(index, workers, cpus) -> list:
+    """Cores of worker `index` when the CPUs are split evenly between workers"""
+    share = len(cpus) // workers
+    if share == 0:
+        return [cpus[index % len(cpus)]]
+    return cpus[index * share:(index + 1) * share]
+
+
+def limit_threads(threads, inference_workers=1):
+    """Size the intra-op thread pools of the libraries already imported.
+
+    Each inference thread runs its own torch intra-op team, so they split the
+    budget between them.
+    """
+    threads = max(1, int(threads))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(max(1, threads // max(1, int(inference_workers))))
+    if "cv2" in sys.modules:
+        sys.modules["cv2"].setNumThreads(threads)
+
+
+# ---------- per-worker state ----------
+
+def is_primary() -> bool:
+    """True in worker 0 of the pre-fork server and in a plain single-process server.
+
+    Work that must run in one process only (the bulk job runner, one-off
+    database maintenance) is started in the primary worker.
+    """
+    return os.getenv("WORKER_INDEX", "0") == "0"
+
+
+def worker_path(path) -> str:
+    """`path` with the worker index before its suffix (unchanged outside the pre-fork server)"""
+    index = os.getenv("WORKER_INDEX")
+    if index is None:
+        return str(path)
+    p = Path(path)
+    return str(p.with_name(f"{p.stem}.w{index}{p.suffix}"))
+
+
+def adopt_orphans(path):
+    """Append the spill files of workers that no longer exist to this worker's file.
+
+    Only the primary does this, at startup: files left by a single-process
+    run (`path` itself) or by worker indexes beyond the current `--workers`
+    would otherwise never be replayed.
+    """
+    if os.getenv("WORKER_INDEX") is None or not is_primary():
+        return
+    workers = int(os.getenv("PREFORK_WORKERS", "1"))
+    p = Path(path)
+    mine = Path(worker_path(path))
+    orphans = [p] + [f for f in p.parent.glob(f"{p.stem}.w*{p.suffix}")
+                     if f.stem.rsplit(".w", 1)[-1].isdigit() and int(f.stem.rsplit(".w", 1)[-1]) >= workers]
+    for orphan in orphans:
+        if not orphan.is_file():
+            continue
+        with open(orphan, "rb") as src, open(mine, "ab") as dst:
+            shutil.copyfileobj(src, dst)
+        orphan.unlink()
+        print(f"✅ Adopted spill file {orphan.name}")
+
+
+# ---------- memory reporting ----------
+
+def process_memory(pid="self") -> dict:
+    """RSS / PSS / shared / private memory of a process in MB (Linux /proc)"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return {"rss_mb": round(int(line.split()[1]) / 1024, 1)}
+        except OSError:
+            pass
+        return {}
+    kb = lambda *keys: round(sum(fields.get(k, 0) for k in keys) / 1024, 1)
+    return {
+        "rss_mb": kb("Rss"),
+        "pss_mb": kb("Pss"),
+        "shared_mb": kb("Shared_Clean", "Shared_Dirty"),
+        "private_mb": kb("Private_Clean", "Private_Dirty"),
+        "swap_mb": kb("Swap"),
+    }
+
+
+def child_pids(parent) -> list:
+    """Live child processes of `parent`, from /proc"""
+    pids = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return pids
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields after it are fixed
+                state, ppid = f.read().rsplit(")", 1)[1].split()[:2]
+        except (OSError, IndexError, ValueError):
+            continue
+        if int(ppid) == parent and state != "Z":
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def worker_info() -> dict:
+    """This process: worker index, thread budget, CPUs and memory"""
+    index = os.getenv("WORKER_INDEX")
+    info = {
+        "pid": os.getpid(),
+        "index": int(index) if index is not None else None,
+        "threads": int(os.getenv("WORKER_THREADS")) if os.getenv("WORKER_THREADS") else None,
+        "memory": process_memory(),
+    }
+    try:
+        info["cpus"] = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+    return info
+
+
+def workers_report() -> dict:
+    """Memory of the pre-fork parent and all of its workers (just this
+    process when running without the pre-fork server)"""
+    parent = os.getenv("PREFORK_PARENT")
+    if parent is None or int(parent) != os.getppid():
+        me = worker_info()
+        return {"prefork": False, "workers": [me], "total": dict(me["memory"])}
+    parent = int(parent)
+    workers = [{"pid": pid, "self": pid == os.getpid(), "memory": process_memory(pid)}
+               for pid in child_pids(parent)]
+    processes = [process_memory(parent)] + [w["memory"] for w in workers]
+    total = {key: round(sum(m.get(key, 0) for m in processes), 1) for key in ("rss_mb", "pss_mb", "private_mb")}
+    return {
+        "prefork": True,
+        "parent": {"pid": parent, "memory": processes[0]},
+        "workers": workers,
+        "total": total,
+    }
+
+
+# ---------- launcher ----------
+
+def preload_model(inference_workers):
+    """Load the weights main.py would pick, configured from the same environment"""
+    from registry import model_candidates, preload
+
+    candidates = model_candidates(MODELS_DIR, os.getenv("MODEL_PATH"))
+    imgsz = int(os.getenv("MODEL_IMGSZ")) if os.getenv("MODEL_IMGSZ") else None
+    started = time.perf_counter()
+    handle = preload(candidates, imgsz, os.getenv("MODEL_BACKEND") or None, inference_workers)
+    if handle is None:
+        print("⚠️ No PyTorch weights to preload; workers will load the model themselves")
+    else:
+        print(f"✅ Preloaded {handle.path} in {time.perf_counter() - started:.1f}s "
+              f"(parent RSS {process_memory().get('rss_mb', '?')} MB)")
+    return handle
+
+
+def run_worker(index, sock, args, threads, cpus):
+    """Body of a forked worker; never returns"""
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.environ["WORKER_INDEX"] = str(index)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        limit_threads(threads, int(os.getenv("INFERENCE_WORKERS", "1")))
+
+        import uvicorn
+        config = uvicorn.Config("main:app", log_level=args.log_level, timeout_keep_alive=args.keep_alive)
+        uvicorn.Server(config).run(sockets=[sock])
+    except Exception as e:
+        print(f"❌ Worker {index} failed: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve(args):
+    cpus = cpu_list()
+    workers = max(1, args.workers)
+    threads = args.threads or max(1, len(cpus) // workers)
+    # Picked up by OpenMP / MKL / OpenBLAS when they first start their pools
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ["PREFORK_PARENT"] = str(os.getpid())
+    os.environ["PREFORK_WORKERS"] = str(workers)
+    os.environ["WORKER_THREADS"] = str(threads)
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(args.backlog)
+    sock.set_inheritable(True)
+
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    # The parent only runs the warm-up inference: keep it single-threaded so
+    # no thread pools exist at fork time
+    limit_threads(1)
+    if not args.no_preload:
+        preload_model(int(os.getenv("INFERENCE_WORKERS", "1")))
+    gc.collect()
+    gc.freeze()
+
+    children = {}  # pid -> (index, started)
+    fast_failures = {}  # index -> consecutive deaths right after starting
+    stopping = False
+    exit_code = 0
+
+    def spawn(index):
+        cpus_i = worker_cpus(index, workers, cpus) if args.affinity else None
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index, sock, args, threads, cpus_i)
+        children[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn(i)
+    print(f"🚀 Serving on {args.host}:{args.port} with {workers} worker(s), {threads} thread(s) each"
+          + (" (pinned)" if args.affinity else ""))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid, (None, None))
+        if index is None or stopping:
+            continue
+        print(f"⚠️ Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}")
+        fast = time.monotonic() - started < 5
+        fast_failures[index] = fast_failures.get(index, 0) + 1 if fast else 0
+        if fast_failures[index] >= MAX_FAST_FAILURES:
+            print(f"❌ Worker {index} keeps failing at startup, shutting down")
+            stop(None, None)
+            exit_code = 1
+            continue
+        if fast:
+            time.sleep(RESTART_BACKOFF)
+        spawn(index)
+    sock.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    p = argparse.ArgumentParser(description="Serve the API from pre-forked workers sharing one model load")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "2")))
+    p.add_argument("--threads", type=int, default=int(os.getenv("WORKER_THREADS", "0")) or None,
+                   help="intra-op threads per worker (default: CPUs / workers)")
+    p.add_argument("--affinity", action="store_true", help="pin each worker to its own CPUs")
+    p.add_argument("--no_preload", action="store_true", help="let every worker load its own model")
+    p.add_argument("--backlog", type=int, default=2048)
+    p.add_argument("--keep_alive", type=int, default=5)
+    p.add_argument("--log_level", default="info")
+    args = p.parse_args()
+
+    load_dotenv()  # MODEL_* settings in .env apply to the preload too
+    sys.exit(serve(args))
@@ -0,0 +1,137 @@
+"""Opt-in sampling profiler for slices of API requests.
+
+While a selected request runs, a background thread samples the Python stack
+of every thread (event loop, threadpool, inference workers) every
+`interval` seconds. Samples are written in the collapsed-stack format
+("outer;inner;leaf count" per line) read by flamegraph.pl, speedscope and
+inferno, so a profile can be turned into a flame graph directly.
+
+Only one request is profiled at a time; others that are selected while a
+profile is running are skipped.
+"""
+import collections
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples all thread stacks into collapsed-stack counts."""
+
+    def __init__(self, interval=0.005):
+        self.interval = float(interval)
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class RequestProfiler:
+    """Decides which requests to profile and writes one file per profile.
+
+    A request is profiled if `profile_next(n)` armed it or, otherwise, with
+    probability `sample_rate`. Profiles land in `out_dir` as
+    `<timestamp>_<method>_<path>.folded`.
+    """
+
+    def __init__(self, out_dir, sample_rate=0.0, interval=0.005):
+        self.out_dir = Path(out_dir)
+        self.sample_rate = float(sample_rate)
+        self.interval = float(interval)
+        self.written = 0
+        self._armed = 0
+        self._active = False
+        self._lock = threading.Lock()
+
+    def profile_next(self, n):
+        with self._lock:
+            self._armed = max(0, int(n))
+
+    def _select(self):
+        with self._lock:
+            if self._active:
+                return False
+            if self._armed > 0:
+                self._armed -= 1
+            elif not (self.sample_rate > 0 and random.random() < self.sample_rate):
+                return False
+            self._active = True
+            return True
+
+    @contextmanager
+    def profile(self, method, path):
+        if not self._select():
+            yield None
+            return
+        profiler = SamplingProfiler(self.interval)
+        started = time.time()
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            try:
+                self.out_dir.mkdir(parents=True, exist_ok=True)
+                slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+                out = self.out_dir / f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}" \
+                                     f"-{int(started * 1000) % 1000:03d}_{method}_{slug}.folded"
+                profiler.write_collapsed(out)
+                self.written += 1
+            except OSError as e:
+                print(f"⚠️ Could not write profile: {e}")
+            finally:
+                with self._lock:
+                    self._active = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "armed": self._armed,
+                "active": self._active,
+                "written": self.written,
+                "out_dir": str(self.out_dir),
+            }
@@ -0,0 +1,109 @@
+"""Index management and query helpers for the `detections` collection.
+
+History listings use keyset pagination on (timestamp, _id) instead of
+skip/offset, so every page is an index range scan no matter how deep it is.
+"""
+import base64
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+# Fields returned by `fields=summary` (no per-box arrays)
+SUMMARY_PROJECTION = {
+    "filename": 1,
+    "tree_count": 1,
+    "avg_confidence": 1,
+    "image_size": 1,
+    "timestamp": 1,
+    "tiles": 1,
+    "source": 1,
+    "site": 1,
+    "image_key": 1,
+}
+
+LIST_SORT = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+
+def ensure_indexes(db):
+    """Create the indexes the API queries rely on (idempotent)"""
+    try:
+        # Listing, date-range filters and keyset pagination; tree_count is a
+        # trailing key so count-range filters are checked inside the index
+        db.detections.create_index(
+            LIST_SORT + [("tree_count", ASCENDING)], name="timestamp_id_tree_count")
+        db.detections.create_index(
+            [("filename", ASCENDING)] + LIST_SORT, name="filename_timestamp_id")
+        db.detections.create_index(
+            [("site", ASCENDING)] + LIST_SORT, name="site_timestamp_id")
+        return True
+    except PyMongoError as e:
+        print(f"⚠️ Index creation failed: {e}")
+        return False
+
+
+def migrate_string_timestamps(collection):
+    """Convert legacy ISO-string timestamps to native BSON dates (in place, server side)"""
+    try:
+        res = collection.update_many(
+            {"timestamp": {"$type": "string"}},
+            [{"$set": {"timestamp": {"$dateFromString": {"dateString": "$timestamp"}}}}],
+        )
+        if res.modified_count:
+            print(f"✅ Migrated {res.modified_count} string timestamp(s) to dates")
+    except PyMongoError as e:
+        print(f"⚠️ Timestamp migration failed: {e}")
+
+
+def encode_cursor(doc) -> str:
+    """Opaque `before=` token pointing just past `doc` in listing order"""
+    ts = doc["timestamp"]
+    if isinstance(ts, str):  # legacy record not migrated yet
+        ts = datetime.fromisoformat(ts)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    raw = f"{int(ts.timestamp() * 1000)}:{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str):
+    """Inverse of `encode_cursor`; raises ValueError on malformed tokens"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        millis, oid = raw.split(":", 1)
+        ts = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        return ts, ObjectId(oid)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def build_filter(before=None, start=None, end=None, min_trees=None, max_trees=None, filename=None, site=None):
+    """Mongo filter for the history listing; every clause is served by an index"""
+    query = {}
+    if filename:
+        query["filename"] = filename
+    if site:
+        query["site"] = site
+    ts_range = {}
+    if start is not None:
+        ts_range["$gte"] = start
+    if end is not None:
+        ts_range["$lt"] = end
+    if ts_range:
+        query["timestamp"] = ts_range
+    count_range = {}
+    if min_trees is not None:
+        count_range["$gte"] = min_trees
+    if max_trees is not None:
+        count_range["$lte"] = max_trees
+    if count_range:
+        query["tree_count"] = count_range
+    if before:
+        ts, oid = decode_cursor(before)
+        keyset = {"$or": [
+            {"timestamp": {"$lt": ts}},
+            {"timestamp": ts, "_id": {"$lt": oid}},
+        ]}
+        query = {"$and": [query, keyset]} if query else keyset
+    return query
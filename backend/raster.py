@@ -0,0 +1,213 @@
+"""Windowed GeoTIFF / COG ingestion with georeferenced detections.
+
+The raster is never loaded whole: it is read one block-aligned window at a
+time (optionally from an overview level), each window goes through sliced
+inference (see tiling.py), and detections are streamed out in map
+coordinates as soon as their window is done. Peak memory is bounded by the
+window size, not by the raster size.
+
+Windows overlap by a margin so trees on window edges are seen whole; each
+detection is owned by the window whose core (non-overlapping) area contains
+its centre, so nothing is counted twice and no global box list is kept.
+
+Command line:
+
+    python raster.py ortho.tif --weights ../models/best.pt --out trees.geojson
+    python raster.py ortho.tif --weights ../models/best.pt --out trees.gpkg --overview 1
+"""
+import json
+import math
+
+import numpy as np
+
+from tiling import DEFAULT_TILE_SIZE, DEFAULT_OVERLAP, sliced_predict
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:  # optional: only needed for GeoTIFF ingestion
+    rasterio = None
+
+DEFAULT_WINDOW_SIZE = 2048
+
+
+def require_rasterio():
+    if rasterio is None:
+        raise RuntimeError("GeoTIFF support requires rasterio (pip install rasterio pyproj)")
+
+
+def core_windows(src, window_size=DEFAULT_WINDOW_SIZE):
+    """Yield non-overlapping core windows snapped to the dataset's block grid.
+
+    Reading whole internal blocks (or COG tiles) avoids decompressing the same
+    block for several windows.
+    """
+    block_h, block_w = src.block_shapes[0]
+    core_w = max(block_w, int(math.ceil(window_size / block_w)) * block_w)
+    core_h = max(block_h, int(math.ceil(window_size / block_h)) * block_h)
+    for row in range(0, src.height, core_h):
+        for col in range(0, src.width, core_w):
+            yield Window(col, row, min(core_w, src.width - col), min(core_h, src.height - row))
+
+
+def to_uint8(arr):
+    """(bands, h, w) raster block -> (h, w, 3) uint8 RGB"""
+    if arr.shape[0] >= 3:
+        arr = arr[:3]
+    else:
+        arr = np.repeat(arr[:1], 3, axis=0)
+    if arr.dtype != np.uint8:
+        if np.issubdtype(arr.dtype, np.integer):
+            arr = (arr.astype(np.float32) * (255.0 / np.iinfo(arr.dtype).max))
+        else:
+            arr = np.clip(arr, 0.0, 1.0) * 255.0
+        arr = arr.astype(np.uint8)
+    return np.ascontiguousarray(arr.transpose(1, 2, 0))
+
+
+def detect_windows(path, predict_fn, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                   window_size=DEFAULT_WINDOW_SIZE, overview_level=None, iou_thres=0.5):
+    """Generator over (boxes_px, scores, transform, crs) per window.
+
+    `boxes_px` are xyxy pixel boxes in the coordinates of the opened dataset
+    (the overview, if one is selected); `transform` maps them to the raster CRS.
+    """
+    require_rasterio()
+    margin = max(1, int(math.ceil(tile_size * overlap)))
+    open_kwargs = {"overview_level": overview_level} if overview_level is not None else {}
+    with rasterio.open(path, **open_kwargs) as src:
+        for core in core_windows(src, window_size):
+            col0 = max(0, int(core.col_off) - margin)
+            row0 = max(0, int(core.row_off) - margin)
+            col1 = min(src.width, int(core.col_off + core.width) + margin)
+            row1 = min(src.height, int(core.row_off + core.height) + margin)
+            read_win = Window(col0, row0, col1 - col0, row1 - row0)
+
+            mask = src.dataset_mask(window=read_win)
+            if not mask.any():
+                continue  # all nodata
+            arr = to_uint8(src.read(window=read_win))
+            arr[mask == 0] = 255  # nodata reads as blank so its tiles are skipped
+            del mask
+
+            out = sliced_predict(predict_fn, arr, tile_size, overlap, iou_thres=iou_thres)
+            boxes, scores = out["boxes"], out["scores"]
+            del arr
+            if len(boxes) == 0:
+                continue
+
+            # Shift into dataset pixel space and keep only boxes owned by this core
+            boxes = boxes + np.array([col0, row0, col0, row0])
+            cx = (boxes[:, 0] + boxes[:, 2]) / 2
+            cy = (boxes[:, 1] + boxes[:, 3]) / 2
+            own = ((cx >= core.col_off) & (cx < core.col_off + core.width)
+                   & (cy >= core.row_off) & (cy < core.row_off + core.height))
+            if own.any():
+                yield boxes[own], scores[own], src.transform, src.crs
+
+
+def pixel_boxes_to_map(boxes, transform, src_crs, dst_crs=None):
+    """Convert xyxy pixel boxes to map coordinates.
+
+    Returns (centers, corners): (N, 2) box centres and (N, 4) x0, y0, x1, y1
+    map extents, reprojected to `dst_crs` when given.
+    """
+    px = np.concatenate([(boxes[:, 0] + boxes[:, 2]) / 2, boxes[:, 0], boxes[:, 2]])
+    py = np.concatenate([(boxes[:, 1] + boxes[:, 3]) / 2, boxes[:, 1], boxes[:, 3]])
+    xs, ys = transform * (px, py)
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if dst_crs is not None and src_crs is not None and str(src_crs) != str(dst_crs):
+        from pyproj import Transformer
+        transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+        xs, ys = transformer.transform(xs, ys)
+        xs, ys = np.asarray(xs), np.asarray(ys)
+    n = len(boxes)
+    centers = np.stack([xs[:n], ys[:n]], axis=1)
+    corners = np.stack([
+        np.minimum(xs[n:2 * n], xs[2 * n:]), np.minimum(ys[n:2 * n], ys[2 * n:]),
+        np.maximum(xs[n:2 * n], xs[2 * n:]), np.maximum(ys[n:2 * n], ys[2 * n:]),
+    ], axis=1)
+    return centers, corners
+
+
+def _feature(center, corner, score, geometry):
+    if geometry == "box":
+        x0, y0, x1, y1 = (float(v) for v in corner)
+        geom = {"type": "Polygon", "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]}
+    else:
+        geom = {"type": "Point", "coordinates": [float(center[0]), float(center[1])]}
+    return {"type": "Feature", "geometry": geom, "properties": {"confidence": round(float(score), 4)}}
+
+
+def iter_geojson(windows, dst_crs="EPSG:4326", geometry="point", summary=None):
+    """Stream a GeoJSON FeatureCollection as text chunks, one chunk per window.
+
+    `summary`, if given, is a dict filled in with tree_count/avg_confidence once
+    the stream is exhausted (also written into the collection's properties).
+    """
+    summary = summary if summary is not None else {}
+    count, conf_sum = 0, 0.0
+    yield '{"type": "FeatureCollection", "features": ['
+    for boxes, scores, transform, crs in windows:
+        centers, corners = pixel_boxes_to_map(boxes, transform, crs, dst_crs)
+        feats = [json.dumps(_feature(c, b, s, geometry)) for c, b, s in zip(centers, corners, scores)]
+        yield ("," if count else "") + ",".join(feats)
+        count += len(feats)
+        conf_sum += float(scores.sum())
+        summary["source_crs"] = str(crs) if crs is not None else None
+    summary.update({
+        "tree_count": count,
+        "avg_confidence": round(conf_sum / count, 2) if count else 0,
+        "crs": dst_crs or summary.get("source_crs"),
+    })
+    yield '], "properties": ' + json.dumps(summary) + '}'
+
+
+def write_gpkg(windows, out_path, dst_crs=None, geometry="point", layer="trees"):
+    """Append detections to a GeoPackage window by window; returns the tree count."""
+    import geopandas as gpd
+    from shapely import box as shapely_box, points
+
+    count = 0
+    for boxes, scores, transform, crs in windows:
+        centers, corners = pixel_boxes_to_map(boxes, transform, crs, dst_crs)
+        geoms = shapely_box(*corners.T) if geometry == "box" else points(centers)
+        gdf = gpd.GeoDataFrame({"confidence": scores.astype(np.float32)}, geometry=geoms, crs=dst_crs or crs)
+        gdf.to_file(out_path, layer=layer, driver="GPKG", mode="a" if count else "w")
+        count += len(gdf)
+    if count == 0:
+        # Still produce a valid (empty) layer
+        empty = gpd.GeoDataFrame({"confidence": np.zeros(0, dtype=np.float32)}, geometry=[], crs=dst_crs)
+        empty.to_file(out_path, layer=layer, driver="GPKG")
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+    from ultralytics import YOLO
+
+    p = argparse.ArgumentParser(description="Detect trees in a GeoTIFF window by window")
+    p.add_argument('raster')
+    p.add_argument('--weights', required=True)
+    p.add_argument('--out', required=True, help='.geojson or .gpkg')
+    p.add_argument('--conf', type=float, default=0.25)
+    p.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE)
+    p.add_argument('--overlap', type=float, default=DEFAULT_OVERLAP)
+    p.add_argument('--window_size', type=int, default=DEFAULT_WINDOW_SIZE)
+    p.add_argument('--overview', type=int, default=None, help='read from this overview level')
+    p.add_argument('--geometry', default='point', choices=['point', 'box'])
+    p.add_argument('--crs', default=None, help='output CRS (default: EPSG:4326 for GeoJSON, raster CRS for GPKG)')
+    args = p.parse_args()
+
+    y = YOLO(args.weights)
+    predict = lambda tiles: y(tiles, conf=args.conf, imgsz=args.tile_size, verbose=False)
+    wins = detect_windows(args.raster, predict, args.tile_size, args.overlap, args.window_size, args.overview)
+    if args.out.lower().endswith('.gpkg'):
+        n = write_gpkg(wins, args.out, args.crs, args.geometry)
+    else:
+        summary = {}
+        with open(args.out, 'w') as f:
+            for chunk in iter_geojson(wins, args.crs or "EPSG:4326", args.geometry, summary):
+                f.write(chunk)
+        n = summary["tree_count"]
+    print(f"{args.raster}: {n} trees -> {args.out}")
@@ -0,0 +1,261 @@
+"""Model registry: background loading, warm-up and hot swapping.
+
+The API process binds its port immediately; weights are loaded (and
+ultralytics/torch imported) on a background thread, then a few warm-up
+inferences are run before the registry reports ready.
+
+A new weights file can be swapped in at runtime. The replacement is loaded
+and warmed up off to the side and then published with a single reference
+assignment: batches that already picked up the old handle finish on it, new
+batches use the new one.
+
+Under the pre-fork server (prefork.py) the weights are loaded once in the
+parent with `preload` and forked workers adopt that handle, sharing its
+memory copy-on-write, instead of loading their own copy.
+"""
+import ast
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cache import file_digest
+
+BACKENDS = {".pt": "pytorch", ".onnx": "onnx"}
+DEFAULT_MODEL_NAMES = ("best.pt", "hello.pt", "best.onnx")
+
+# Handle loaded by a pre-fork parent; workers inherit it through fork()
+_preloaded = None
+
+
+def backend_for(path) -> str:
+    return BACKENDS.get(Path(path).suffix.lower(), "unknown")
+
+
+def model_candidates(models_dir, pinned=None) -> list:
+    """Weights files to try in order: `pinned` alone, or the default names in `models_dir`"""
+    if pinned:
+        return [Path(pinned)]
+    return [Path(models_dir) / name for name in DEFAULT_MODEL_NAMES]
+
+
+def _usable(candidates, backend=None):
+    for path in candidates:
+        if path.exists() and (not backend or backend_for(path) == backend):
+            yield path
+
+
+def preload(candidates, imgsz=None, backend=None, instances=1):
+    """Load and warm up the first usable candidate in this process for forked
+    workers to adopt. Returns the handle, or None if nothing could be loaded.
+
+    Only PyTorch weights are preloaded: onnxruntime sessions keep thread
+    pools that don't survive fork(), so ONNX models are loaded per worker.
+    """
+    global _preloaded
+    for path in _usable([Path(c) for c in candidates], backend):
+        if backend_for(path) != "pytorch":
+            return None
+        try:
+            handle = ModelHandle(path, imgsz, instances)
+            # One inference fuses layers and builds the predictors here, so
+            # workers don't rewrite (and un-share) the weights on first use
+            handle.warmup(runs=1)
+        except Exception as e:
+            print(f"⚠️ Error preloading {path}: {e}")
+            continue
+        _preloaded = handle
+        return handle
+    return None
+
+
+def onnx_metadata(path) -> dict:
+    """Export metadata ultralytics stores in an ONNX file (imgsz, batch,
+    export args); tree-count-training/export.py carries it over to the INT8
+    artifact"""
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    meta = session.get_modelmeta().custom_metadata_map
+    out = {"precision": meta.get("precision", "fp32")}
+    for key in ("imgsz", "batch", "args"):
+        if key in meta:
+            try:
+                out[key] = ast.literal_eval(meta[key])
+            except (ValueError, SyntaxError):
+                pass
+    return out
+
+
+class ModelHandle:
+    """One loaded model plus everything the API needs to know about it.
+
+    Ultralytics predictors keep per-call state and aren't thread-safe, so a
+    handle holds `instances` copies of the weights (one per inference worker)
+    and each batch borrows one for the duration of its model call.
+    """
+
+    def __init__(self, path, imgsz=None, instances=1):
+        from ultralytics import YOLO
+
+        self.path = Path(path)
+        self.backend = backend_for(path)
+        self.precision = "fp32"
+        self.max_batch = None  # static-batch exports only take this many images per call
+        started = time.perf_counter()
+        if self.backend == "onnx":
+            meta = onnx_metadata(self.path)
+            self.precision = meta["precision"]
+            if imgsz is None:
+                imgsz = meta.get("imgsz")
+            if not meta.get("args", {}).get("dynamic"):
+                self.max_batch = int(meta.get("batch") or 1)
+        models = [YOLO(str(self.path), task="detect") for _ in range(max(1, int(instances)))]
+        if imgsz is None:
+            imgsz = models[0].overrides.get("imgsz") or 640
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        self.model_id = file_digest(self.path)
+        self.load_seconds = time.perf_counter() - started
+        self.warmup_seconds = 0.0
+        self.loaded_at = time.time()
+        self.preloaded = False  # adopted from a pre-fork parent
+        self._models = models
+        self._free = queue.LifoQueue()
+        for m in models:
+            self._free.put(m)
+
+    def _run(self, model, images, **kwargs):
+        step = self.max_batch or len(images) or 1
+        results = []
+        for i in range(0, len(images), step):
+            results.extend(model(images[i:i + step], imgsz=self.imgsz, verbose=False, **kwargs))
+        return results
+
+    def predict(self, images, conf):
+        model = self._free.get()
+        try:
+            return self._run(model, images, conf=conf)
+        finally:
+            self._free.put(model)
+
+    def warmup(self, runs=2, batch_sizes=(1,)):
+        """Run dummy inferences on every instance so the first real requests
+        don't pay for graph setup and allocator growth"""
+        started = time.perf_counter()
+        dummy = np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        for model in self._models:
+            for _ in range(max(0, runs)):
+                for bs in batch_sizes:
+                    self._run(model, [dummy] * bs)
+        self.warmup_seconds = time.perf_counter() - started
+
+    def info(self):
+        return {
+            "path": str(self.path),
+            "backend": self.backend,
+            "precision": self.precision,
+            "max_batch": self.max_batch,
+            "imgsz": self.imgsz,
+            "model_id": self.model_id,
+            "instances": len(self._models),
+            "load_seconds": round(self.load_seconds, 3),
+            "warmup_seconds": round(self.warmup_seconds, 3),
+            "loaded_at": self.loaded_at,
+            "preloaded": self.preloaded,
+        }
+
+
+class ModelRegistry:
+    """Holds the active `ModelHandle` and manages loading and swaps.
+
+    `candidates` are tried in order at startup (first existing file that
+    loads wins); `backend` ("pytorch" or "onnx") restricts them to one kind.
+    `on_swap(handle)` is called whenever a new model goes live.
+    """
+
+    def __init__(self, candidates, imgsz=None, backend=None, instances=1, warmup_runs=2,
+                 warmup_batch_sizes=(1,), on_swap=None):
+        self.candidates = [Path(c) for c in candidates]
+        self.imgsz = imgsz
+        self.backend = backend
+        self.instances = instances
+        self.warmup_runs = warmup_runs
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.on_swap = on_swap
+        self.current = None
+        self.status = "idle"  # idle | loading | ready | failed
+        self.error = None
+        self._swap_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.current is not None
+
+    def load(self, path, imgsz=None, warmup_runs=None) -> ModelHandle:
+        """Load and warm up a model, then make it the active one"""
+        with self._swap_lock:
+            handle = ModelHandle(path, imgsz if imgsz is not None else self.imgsz, self.instances)
+            self._publish(handle, warmup_runs)
+        if self.on_swap is not None:
+            self.on_swap(handle)
+        return handle
+
+    def _publish(self, handle, warmup_runs=None):
+        """Warm up and activate a handle; the caller holds the swap lock"""
+        handle.warmup(self.warmup_runs if warmup_runs is None else warmup_runs, self.warmup_batch_sizes)
+        # Atomic publish: in-flight batches keep their reference to the old handle
+        self.current = handle
+        self.status = "ready"
+        self.error = None
+
+    def _adopt_preloaded(self) -> bool:
+        """Use the pre-fork parent's handle if it matches this registry's settings"""
+        handle = _preloaded
+        if handle is None or len(handle._models) != self.instances:
+            return False
+        if self.imgsz is not None and handle.imgsz != self.imgsz:
+            return False
+        if handle.path not in list(_usable(self.candidates, self.backend))[:1]:
+            return False
+        handle.preloaded = True
+        with self._swap_lock:
+            # Warm-up here sizes this worker's thread pools and activation buffers
+            self._publish(handle)
+        if self.on_swap is not None:
+            self.on_swap(handle)
+        print(f"✅ Using model preloaded by the parent process from {handle.path} "
+              f"({handle.warmup_seconds:.1f}s warm-up)")
+        return True
+
+    def _load_initial(self):
+        self.status = "loading"
+        if self._adopt_preloaded():
+            return
+        for path in _usable(self.candidates, self.backend):
+            try:
+                print(f"🔍 Attempting to load model from {path}")
+                handle = self.load(path)
+                print(f"✅ Model loaded successfully from {path} "
+                      f"({handle.load_seconds:.1f}s load, {handle.warmup_seconds:.1f}s warm-up)")
+                return
+            except Exception as e:
+                print(f"⚠️ Error loading {path}: {e}")
+                self.error = str(e)
+        self.status = "failed"
+        print("❌ No valid model found. Please ensure a trained YOLO model exists in the models folder.")
+        print("   Supported: " + ", ".join(p.name for p in self.candidates))
+
+    def load_in_background(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._load_initial, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def info(self):
+        return {
+            "status": self.status,
+            "error": self.error,
+            "model": self.current.info() if self.current is not None else None,
+        }
@@ -0,0 +1,225 @@
+"""Annotated result images rendered from stored detections.
+
+`/upload` and bulk jobs keep the original image bytes in a content-addressed
+store on local disk. Annotated images and thumbnails are drawn on demand from
+that original and the record's stored boxes, so viewing a result never runs
+the model again. Renders are kept in a second size-bounded directory:
+
+- `DiskLRU`: files under `root/<2 hex>/<key>`, evicted least recently used
+  first once the directory grows past `max_bytes`. Recency is kept in file
+  mtimes, so it survives restarts and is shared by the pre-fork workers.
+  Each worker keeps an in-memory index of the directory, adopts files stored
+  by another worker on first lookup, and enforces the size limit against the
+  directory itself (re-read every `RESCAN_SECONDS`, or sooner once its own
+  estimate goes over), so N workers don't grow it to N x `max_bytes`.
+- Render keys are derived from the detection id and the render options only.
+  Records never change, so the key doubles as the ETag and conditional
+  requests are answered without touching the database or the disk.
+
+JPEG renders are progressive, so a large render streamed from disk shows up
+at full size right away and sharpens as it arrives.
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from decode import decode_image
+
+RENDER_VERSION = 1  # bump when drawing changes so old cached renders stop matching
+FORMATS = {"jpeg": ("image/jpeg", "jpg"), "png": ("image/png", "png"), "webp": ("image/webp", "webp")}
+BOX_COLOR = (0, 230, 255)  # BGR
+THUMBNAIL_SIZES = (64, 128, 256, 512, 1024)
+STALE_TMP_SECONDS = 3600
+RESCAN_SECONDS = 10
+
+
+def source_key(contents: bytes) -> str:
+    return hashlib.blake2b(contents, digest_size=20).hexdigest()
+
+
+def render_key(detection_id, max_side=None, fmt="jpeg", min_conf=0.0, labels=False) -> str:
+    """Cache key (and ETag) of one rendering of a detection"""
+    options = f"{detection_id}|{max_side or 'full'}|{fmt}|{min_conf:.3f}|{int(labels)}|v{RENDER_VERSION}"
+    digest = hashlib.blake2b(options.encode(), digest_size=10).hexdigest()
+    return f"{detection_id}-{digest}.{FORMATS[fmt][1]}"
+
+
+def thumbnail_size(size) -> int:
+    """Smallest standard thumbnail size covering `size`, so clients share cached renders"""
+    for s in THUMBNAIL_SIZES:
+        if size <= s:
+            return s
+    return THUMBNAIL_SIZES[-1]
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def render(contents, boxes, scores, max_side=None, fmt="jpeg", min_conf=0.0, labels=False,
+           max_pixels=None, quality=85) -> bytes:
+    """Draw detection boxes (original-image pixels) on the original image.
+
+    With `max_side` the image is decoded at reduced scale (JPEG draft mode)
+    and downsized before drawing, so thumbnails of large images stay cheap.
+    """
+    image = decode_image(contents, max_side, max_pixels)
+    arr = image.array
+    if max_side and max(arr.shape[:2]) > max_side:
+        r = max_side / max(arr.shape[:2])
+        arr = cv2.resize(arr, (max(1, round(arr.shape[1] * r)), max(1, round(arr.shape[0] * r))),
+                         interpolation=cv2.INTER_AREA)
+    scale = arr.shape[1] / image.width
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    keep = scores >= min_conf
+    thickness = max(1, round(max(arr.shape[:2]) / 400))
+    for (x0, y0, x1, y1), score in zip(np.round(boxes[keep] * scale).astype(int).tolist(), scores[keep].tolist()):
+        cv2.rectangle(arr, (x0, y0), (x1, y1), BOX_COLOR, thickness, cv2.LINE_AA)
+        if labels and x1 - x0 >= 24:
+            cv2.putText(arr, f"{score:.2f}", (x0, max(y0 - 3, 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.35 * thickness, BOX_COLOR, max(1, thickness // 2), cv2.LINE_AA)
+
+    buf = io.BytesIO()
+    pil = Image.fromarray(arr[..., ::-1])
+    if fmt == "jpeg":
+        pil.save(buf, "JPEG", quality=quality, progressive=True, optimize=True)
+    elif fmt == "webp":
+        pil.save(buf, "WEBP", quality=quality)
+    else:
+        pil.save(buf, "PNG")
+    return buf.getvalue()
+
+
+class DiskLRU:
+    """Size-bounded directory of files, evicted least recently used first.
+
+    `max_bytes=0` disables it: nothing is stored and every lookup misses.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._synced = 0.0
+        if self.max_bytes:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._sync()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key) -> Path:
+        return self.root / key[:2] / key
+
+    def _sync(self):
+        """Rebuild the index from the directory (oldest mtime first) and evict
+        from it, so files written by other workers count against the limit"""
+        found = []
+        for path in self.root.glob("*/*"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if path.suffix == ".tmp":
+                # Left over from an interrupted write; recent ones may belong
+                # to another worker sharing the directory
+                if time.time() - st.st_mtime > STALE_TMP_SECONDS:
+                    path.unlink(missing_ok=True)
+                continue
+            found.append((st.st_mtime, path.name, st.st_size))
+        entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        with self._lock:
+            self._entries = entries
+            self._bytes = sum(entries.values())
+            self._synced = time.monotonic()
+            victims = self._evict_locked()
+        self._remove(victims)
+
+    def get(self, key):
+        """Path of a stored file (marked as recently used), or None"""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            size = path.stat().st_size
+        except OSError:
+            size = None
+        with self._lock:
+            if size is None:  # never stored, or evicted by another worker
+                self._bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+                return None
+            # Also adopts files stored by another worker
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, data: bytes):
+        """Store `data` under `key`; returns its path, or None if it doesn't fit"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return None
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)  # readers never see a partial file
+        with self._lock:
+            self._bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            stale = self._bytes > self.max_bytes or time.monotonic() - self._synced > RESCAN_SECONDS
+        if stale:
+            self._sync()
+        return path
+
+    def _evict_locked(self) -> list:
+        victims = []
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            victims.append(key)
+        self.evictions += len(victims)
+        return victims
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                self._path(key).unlink(missing_ok=True)
+            except OSError as e:
+                print(f"⚠️ Could not evict {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
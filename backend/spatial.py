@@ -0,0 +1,438 @@
+"""Spatial index and density pyramid for georeferenced trees.
+
+Every tree found in a georeferenced raster is stored as its own document in
+the `trees` collection:
+
+    {"detection_id", "site", "loc": <GeoJSON Point, EPSG:4326>, "score", "cell", "timestamp"}
+
+`loc` has a 2dsphere index (used for listings and site-filtered counts).
+`cell` is the Morton (Z-order) key of the Web Mercator grid cell holding the
+tree at CELL_LEVEL, so every quadtree cell at any coarser level is one
+contiguous key range.
+
+`density_tiles` is a precomputed count pyramid: one document per slippy-map
+tile (z/x/y) for z in TILE_MIN_ZOOM..TILE_MAX_ZOOM, each holding a
+TILE_CELLS x TILE_CELLS grid of tree counts. Documents are bumped with `$inc`
+upserts as trees are written, so a density tile is a single primary-key read.
+
+Polygon counts walk the pyramid as a quadtree: cells fully inside the polygon
+are taken from the pyramid, cells the polygon doesn't touch are dropped, and
+only boundary cells at CELL_LEVEL are refined point by point. Boundary
+refinement reads from an in-process shapely STRtree for hot areas (areas that
+keep being queried) and from the `cell` index otherwise. Polygon edges are
+straight lines in longitude/latitude.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+try:
+    import shapely
+except ImportError:  # optional: only needed for spatial queries
+    shapely = None
+
+TILE_MIN_ZOOM = 8
+TILE_MAX_ZOOM = 16
+CELL_BITS = 5  # 32 x 32 cells per density tile
+TILE_CELLS = 1 << CELL_BITS
+CELL_LEVEL = TILE_MAX_ZOOM + CELL_BITS  # finest grid, ~19 m cells at the equator
+MAX_LAT = 85.05112878
+# Polygons spanning more than this many cells at the coarsest level are
+# counted with a plain 2dsphere query instead of the pyramid walk
+MAX_START_CELLS = 4096
+
+
+def require_shapely():
+    if shapely is None:
+        raise RuntimeError("Spatial queries require shapely (pip install shapely)")
+
+
+# ---------- Web Mercator grid ----------
+
+def lonlat_to_cell(lon, lat, level=CELL_LEVEL):
+    """Grid cell (x, y) int64 arrays of lon/lat points at `level`"""
+    n = 1 << level
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT))
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n
+    return (np.clip(x.astype(np.int64), 0, n - 1),
+            np.clip(y.astype(np.int64), 0, n - 1))
+
+
+def cell_bounds(level, x, y):
+    """(min_lon, min_lat, max_lon, max_lat) arrays of grid cells"""
+    n = float(1 << level)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+    def lat(row):
+        return np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def _spread(v):
+    v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton(x, y):
+    """Z-order key of grid cells; a cell's descendants are one contiguous key range"""
+    return (_spread(x) | (_spread(y) << np.uint64(1))).astype(np.int64)
+
+
+def key_range(level, x, y):
+    """[lo, hi) CELL_LEVEL key range covered by cell (x, y) at `level`"""
+    shift = 2 * (CELL_LEVEL - level)
+    m = int(morton(x, y))
+    return m << shift, (m + 1) << shift
+
+
+# ---------- writes ----------
+
+def tree_docs(detection_id, lonlat, scores, timestamp, site=None) -> list:
+    """One `trees` document per (lon, lat) point"""
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    keys = morton(*lonlat_to_cell(lonlat[:, 0], lonlat[:, 1]))
+    docs = []
+    for (lon, lat), score, key in zip(lonlat.tolist(), np.asarray(scores, dtype=np.float64).tolist(), keys.tolist()):
+        doc = {
+            "detection_id": detection_id,
+            "loc": {"type": "Point", "coordinates": [lon, lat]},
+            "score": round(score, 4),
+            "cell": key,
+            "timestamp": timestamp,
+        }
+        if site:
+            doc["site"] = site
+        docs.append(doc)
+    return docs
+
+
+def pyramid_updates(lonlat) -> list:
+    """`$inc` upserts adding points to every level of the density pyramid"""
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    if not len(lonlat):
+        return []
+    cx, cy = lonlat_to_cell(lonlat[:, 0], lonlat[:, 1])
+    return _pyramid_updates_from_cells(cx, cy, np.ones(len(cx), dtype=np.int64))
+
+
+def _pyramid_updates_from_cells(cx, cy, counts) -> list:
+    incs = defaultdict(dict)
+    for z in range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1):
+        # CELL_LEVEL cells -> cells of the z tile grid (level z + CELL_BITS)
+        shift = CELL_LEVEL - (z + CELL_BITS)
+        gx, gy = cx >> shift, cy >> shift
+        combo = np.stack([gx, gy], axis=1)
+        uniq, inverse = np.unique(combo, axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=counts, minlength=len(uniq)).astype(np.int64)
+        for (x, y), n in zip(uniq.tolist(), sums.tolist()):
+            tile = (z, x >> CELL_BITS, y >> CELL_BITS)
+            idx = (y & (TILE_CELLS - 1)) * TILE_CELLS + (x & (TILE_CELLS - 1))
+            inc = incs[tile]
+            inc[f"c.{idx}"] = inc.get(f"c.{idx}", 0) + n
+            inc["n"] = inc.get("n", 0) + n
+    return [
+        UpdateOne({"_id": f"{z}/{x}/{y}"}, {"$inc": inc, "$setOnInsert": {"z": z, "x": x, "y": y}}, upsert=True)
+        for (z, x, y), inc in incs.items()
+    ]
+
+
+def _tile_grid(doc):
+    grid = np.zeros(TILE_CELLS * TILE_CELLS, dtype=np.int64)
+    for idx, n in (doc or {}).get("c", {}).items():
+        grid[int(idx)] = n
+    return grid.reshape(TILE_CELLS, TILE_CELLS)
+
+
+class SpatialIndex:
+    """Density pyramid, polygon counts and the hot-area STRtree cache.
+
+    A `hot_zoom` tile becomes hot once `hot_after` count queries have needed
+    boundary points from it; its points are then loaded into an STRtree
+    (at most `max_hot_tiles` tiles, LRU) and dropped again when trees are
+    written into or removed from it. Writes made by other processes (pre-fork
+    workers) aren't seen here, so a hot tile is also reloaded once it is
+    `hot_ttl` seconds old.
+    """
+
+    def __init__(self, trees, density, hot_zoom=14, hot_after=2, max_hot_tiles=64, max_hot_points=500_000,
+                 hot_ttl=30.0):
+        self.trees = trees
+        self.density = density
+        self.hot_zoom = int(hot_zoom)
+        self.hot_after = max(1, int(hot_after))
+        self.max_hot_tiles = max(0, int(max_hot_tiles))
+        self.max_hot_points = int(max_hot_points)
+        self.hot_ttl = float(hot_ttl)
+        self._hot = OrderedDict()  # (x, y) -> (STRtree, cell keys, loaded at)
+        self._hits = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hot_queries = 0
+        self.index_queries = 0
+
+    def ensure_indexes(self):
+        try:
+            self.trees.create_index([("loc", "2dsphere")], name="loc_2dsphere")
+            self.trees.create_index([("site", ASCENDING), ("loc", "2dsphere")], name="site_loc_2dsphere")
+            self.trees.create_index([("cell", ASCENDING)], name="cell")
+            self.trees.create_index([("detection_id", ASCENDING)], name="detection_id")
+            return True
+        except PyMongoError as e:
+            print(f"⚠️ Spatial index creation failed: {e}")
+            return False
+
+    # ----- incremental maintenance -----
+
+    def on_written(self, records):
+        """Writer hook: fold new trees into the pyramid and drop stale hot tiles"""
+        lonlat = np.array([r["loc"]["coordinates"] for r in records], dtype=np.float64).reshape(-1, 2)
+        updates = pyramid_updates(lonlat)
+        if updates:
+            self.density.bulk_write(updates, ordered=False)
+        hx, hy = lonlat_to_cell(lonlat[:, 0], lonlat[:, 1], self.hot_zoom)
+        self._drop_hot(hx, hy)
+
+    def remove(self, query, batch=1000) -> int:
+        """Delete the trees matching `query` and subtract them from the pyramid"""
+        cells = [(g["_id"], g["n"]) for g in self.trees.aggregate(
+            [{"$match": query}, {"$group": {"_id": "$cell", "n": {"$sum": 1}}}], allowDiskUse=True)]
+        if not cells:
+            return 0
+        self.trees.delete_many(query)
+        total = 0
+        for i in range(0, len(cells), batch):
+            chunk = np.array(cells[i:i + batch], dtype=np.int64)
+            cx, cy = _unmorton(chunk[:, 0])
+            self.density.bulk_write(_pyramid_updates_from_cells(cx, cy, -chunk[:, 1]), ordered=False)
+            shift = CELL_LEVEL - self.hot_zoom
+            self._drop_hot(cx >> shift, cy >> shift)
+            total += int(chunk[:, 1].sum())
+        return total
+
+    def _drop_hot(self, hx, hy):
+        with self._lock:
+            for tile in set(zip(hx.tolist(), hy.tolist())):
+                self._hot.pop(tile, None)
+
+    def rebuild(self, batch=1000) -> int:
+        """Recompute the pyramid from `trees` (counts per CELL_LEVEL cell are grouped on the server)"""
+        scratch = self.density.database[self.density.name + "_rebuild"]
+        scratch.drop()
+        cells = []
+        for g in self.trees.aggregate([{"$group": {"_id": "$cell", "n": {"$sum": 1}}}], allowDiskUse=True):
+            cells.append((g["_id"], g["n"]))
+        total = 0
+        for i in range(0, len(cells), batch):
+            chunk = np.array(cells[i:i + batch], dtype=np.int64)
+            cx, cy = _unmorton(chunk[:, 0])
+            scratch.bulk_write(_pyramid_updates_from_cells(cx, cy, chunk[:, 1]), ordered=False)
+            total += int(chunk[:, 1].sum())
+        if cells:
+            scratch.rename(self.density.name, dropTarget=True)
+        else:
+            self.density.delete_many({})
+        with self._lock:
+            self._hot.clear()
+        return total
+
+    # ----- density tiles -----
+
+    def density_tile(self, z, x, y):
+        """TILE_CELLS x TILE_CELLS counts of slippy tile z/x/y; deeper zooms are cut from TILE_MAX_ZOOM.
+
+        Beyond TILE_MAX_ZOOM each stored cell covers several cells of the
+        tile: its count is spread evenly over them (fractional density), so
+        the grid still sums to the number of trees in the tile.
+        """
+        if z < TILE_MIN_ZOOM:
+            raise ValueError(f"z must be >= {TILE_MIN_ZOOM}")
+        if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+            raise ValueError("Tile out of range")
+        if z <= TILE_MAX_ZOOM:
+            return _tile_grid(self.density.find_one({"_id": f"{z}/{x}/{y}"}))
+        d = z - TILE_MAX_ZOOM
+        size = TILE_CELLS >> d
+        if size == 0:
+            raise ValueError(f"z must be <= {TILE_MAX_ZOOM + CELL_BITS}")
+        parent = _tile_grid(self.density.find_one({"_id": f"{TILE_MAX_ZOOM}/{x >> d}/{y >> d}"}))
+        ox, oy = (x & ((1 << d) - 1)) * size, (y & ((1 << d) - 1)) * size
+        # Stored cells are coarser than this zoom: share each count between the cells it covers
+        block = parent[oy:oy + size, ox:ox + size]
+        return np.kron(block, np.ones((1 << d, 1 << d))) / (1 << d) ** 2
+
+    def _cell_counts(self, level, xs, ys, tiles):
+        """Pyramid counts of cells at `level` (level - CELL_BITS must be a stored zoom)"""
+        z = level - CELL_BITS
+        tx, ty = xs >> CELL_BITS, ys >> CELL_BITS
+        missing = {f"{z}/{a}/{b}" for a, b in zip(tx.tolist(), ty.tolist())} - tiles.keys()
+        if missing:
+            for doc in self.density.find({"_id": {"$in": sorted(missing)}}):
+                tiles[doc["_id"]] = _tile_grid(doc)
+        empty = np.zeros((TILE_CELLS, TILE_CELLS), dtype=np.int64)
+        return np.array([
+            tiles.get(f"{z}/{a}/{b}", empty)[y & (TILE_CELLS - 1), x & (TILE_CELLS - 1)]
+            for a, b, x, y in zip(tx.tolist(), ty.tolist(), xs.tolist(), ys.tolist())
+        ], dtype=np.int64)
+
+    # ----- counts -----
+
+    def count(self, geom, site=None) -> dict:
+        """Number of trees in a lon/lat (Multi)Polygon"""
+        require_shapely()
+        if site:
+            return self._count_2dsphere(geom, site)
+        level = TILE_MIN_ZOOM + CELL_BITS
+        minx, miny, maxx, maxy = geom.bounds
+        (x0, x1), (y1, y0) = lonlat_to_cell([minx, maxx], [miny, maxy], level)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_START_CELLS:
+            return self._count_2dsphere(geom, None)
+        gx, gy = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+        xs, ys = gx.ravel(), gy.ravel()
+        shapely.prepare(geom)
+        tiles = {}
+        inside = 0
+        while True:
+            counts = self._cell_counts(level, xs, ys, tiles)
+            nz = counts > 0
+            xs, ys, counts = xs[nz], ys[nz], counts[nz]
+            boxes = shapely.box(*cell_bounds(level, xs, ys))
+            within = shapely.contains(geom, boxes)
+            edge = ~within & shapely.intersects(geom, boxes)
+            inside += int(counts[within].sum())
+            xs, ys = xs[edge], ys[edge]
+            if level == CELL_LEVEL or not len(xs):
+                break
+            # Children of the boundary cells, one level down
+            xs = (np.repeat(xs * 2, 4) + np.tile([0, 1, 0, 1], len(xs)))
+            ys = (np.repeat(ys * 2, 4) + np.tile([0, 0, 1, 1], len(ys)))
+            level += 1
+        boundary, source = self._count_boundary(geom, xs, ys) if len(xs) else (0, "pyramid")
+        return {
+            "count": inside + boundary,
+            "from_pyramid": inside,
+            "boundary_cells": int(len(xs)),
+            "boundary_trees": boundary,
+            "source": source,
+        }
+
+    def _count_2dsphere(self, geom, site):
+        from shapely.geometry import mapping
+
+        query = {"loc": {"$geoWithin": {"$geometry": mapping(geom)}}}
+        if site:
+            query["site"] = site
+        n = self.trees.count_documents(query)
+        return {"count": n, "from_pyramid": 0, "boundary_cells": 0, "boundary_trees": n, "source": "2dsphere"}
+
+    def _count_boundary(self, geom, xs, ys):
+        """Trees inside `geom` among the given CELL_LEVEL cells"""
+        keys = morton(xs, ys)
+        shift = CELL_LEVEL - self.hot_zoom
+        hot_tiles = list(zip((xs >> shift).tolist(), (ys >> shift).tolist()))
+        by_tile = defaultdict(list)
+        for tile, key in zip(hot_tiles, keys.tolist()):
+            by_tile[tile].append(key)
+        total, cold_keys, used_hot = 0, [], False
+        for tile, tile_keys in by_tile.items():
+            entry = self._hot_tile(tile)
+            if entry is None:
+                cold_keys.extend(tile_keys)
+                continue
+            tree, cell_keys, _ = entry
+            idx = tree.query(geom, predicate="intersects")
+            total += int(np.isin(cell_keys[idx], tile_keys).sum())
+            used_hot = True
+        if cold_keys:
+            pts = [d["loc"]["coordinates"] for d in self.trees.find(
+                {"cell": {"$in": cold_keys}}, {"_id": 0, "loc.coordinates": 1})]
+            if pts:
+                pts = np.asarray(pts, dtype=np.float64)
+                total += int(shapely.intersects_xy(geom, pts[:, 0], pts[:, 1]).sum())
+        with self._lock:
+            if used_hot:
+                self.hot_queries += 1
+            if cold_keys:
+                self.index_queries += 1
+        source = "hot" if not cold_keys else ("index" if not used_hot else "hot+index")
+        return total, source
+
+    def _hot_tile(self, tile):
+        """STRtree of a hot tile's trees, loading it once the tile has become hot"""
+        if self.max_hot_tiles == 0:
+            return None
+        with self._lock:
+            entry = self._hot.get(tile)
+            if entry is not None and time.monotonic() - entry[2] < self.hot_ttl:
+                self._hot.move_to_end(tile)
+                return entry
+            if entry is not None:  # expired: reload it now, the tile is still hot
+                self._hot.pop(tile)
+                self._hits[tile] = self.hot_after - 1
+            self._hits[tile] += 1
+            if self._hits[tile] < self.hot_after:
+                return None
+        lo, hi = key_range(self.hot_zoom, *tile)
+        docs = list(self.trees.find({"cell": {"$gte": lo, "$lt": hi}}, {"_id": 0, "loc.coordinates": 1, "cell": 1})
+                    .limit(self.max_hot_points + 1))
+        if len(docs) > self.max_hot_points:
+            return None
+        pts = np.array([d["loc"]["coordinates"] for d in docs], dtype=np.float64).reshape(-1, 2)
+        entry = (shapely.STRtree(shapely.points(pts)), np.array([d["cell"] for d in docs], dtype=np.int64),
+                 time.monotonic())
+        with self._lock:
+            self._hits.pop(tile, None)
+            self._hot[tile] = entry
+            while len(self._hot) > self.max_hot_tiles:
+                self._hot.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hot_tiles": len(self._hot),
+                "hot_points": int(sum(len(keys) for _, keys, _ in self._hot.values())),
+                "hot_queries": self.hot_queries,
+                "index_queries": self.index_queries,
+            }
+
+
+def _unmorton(keys):
+    def compact(v):
+        v = v & np.uint64(0x5555555555555555)
+        for shift, mask in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                            (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+            v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+        return v.astype(np.int64)
+
+    keys = np.asarray(keys, dtype=np.int64).astype(np.uint64)
+    return compact(keys), compact(keys >> np.uint64(1))
+
+
+def density_png(grid, vmax=None, size=256):
+    """Render a count grid as a transparent-to-red heatmap PNG (bytes)"""
+    import io
+    from PIL import Image
+
+    vmax = float(vmax or grid.max() or 1)
+    t = np.clip(np.log1p(grid) / np.log1p(vmax), 0, 1)
+    stops = np.array([0.0, 0.25, 0.6, 1.0])
+    rgba = np.stack([
+        np.interp(t, stops, [255, 255, 255, 200]),
+        np.interp(t, stops, [255, 235, 120, 0]),
+        np.interp(t, stops, [178, 80, 0, 0]),
+        np.where(grid > 0, np.interp(t, stops, [0, 140, 190, 230]), 0),
+    ], axis=-1).astype(np.uint8)
+    img = Image.fromarray(rgba, "RGBA").resize((size, size), Image.NEAREST)
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
@@ -0,0 +1,303 @@
+"""Live video ingestion: frame dropping, tracking and unique-tree counting.
+
+A client streams encoded frames (JPEG/PNG, one per WebSocket binary message)
+to `/stream`. The server keeps at most `max_pending` frames waiting: when
+inference falls behind, the oldest waiting frames are dropped (and so are
+frames older than `max_latency_ms` by the time they would be processed), so
+results always describe recent frames. Kept frames go through the shared
+micro-batcher together.
+
+Adjacent frames see the same trees, so detections are tracked across frames
+(`IouTracker`: greedy IoU matching after compensating the camera motion
+estimated by phase correlation) and a tree is counted once, when its track
+has been seen in `min_hits` processed frames.
+
+Replaying a video file for testing, through a running server or in-process:
+
+    python streaming.py flight.mp4 --url ws://127.0.0.1:8000/stream --fps 10
+    python streaming.py flight.mp4 --weights ../models/best.pt
+"""
+import json
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+DEFAULT_MAX_PENDING = 4
+DEFAULT_MAX_LATENCY_MS = 2000
+MOTION_SIZE = 256  # long side of the grayscale copy used for motion estimation
+
+
+def pairwise_iou(a, b):
+    """IoU matrix between (N, 4) and (M, 4) xyxy boxes"""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)))
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def motion_frame(image):
+    """Small float32 grayscale copy of a BGR frame for `estimate_shift`"""
+    h, w = image.shape[:2]
+    r = MOTION_SIZE / max(h, w)
+    small = cv2.resize(image, (max(1, round(w * r)), max(1, round(h * r))), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32), r
+
+
+def estimate_shift(prev, cur):
+    """Global (dx, dy) image translation from `prev` to `cur` (motion_frame outputs), in frame pixels"""
+    if prev is None or prev[0].shape != cur[0].shape:
+        return 0.0, 0.0
+    window = cv2.createHanningWindow(cur[0].shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(prev[0], cur[0], window)
+    if response < 0.05:  # no reliable peak (blur, uniform canopy): assume no motion
+        return 0.0, 0.0
+    return dx / cur[1], dy / cur[1]
+
+
+class IouTracker:
+    """Greedy IoU tracker with global motion compensation.
+
+    A track is confirmed (and counted once) after `min_hits` matched frames
+    and forgotten after `max_misses` processed frames without a match.
+    """
+
+    def __init__(self, iou_thres=0.3, min_hits=2, max_misses=5):
+        self.iou_thres = float(iou_thres)
+        self.min_hits = max(1, int(min_hits))
+        self.max_misses = max(0, int(max_misses))
+        self.boxes = np.zeros((0, 4))
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        self.best = np.zeros(0)  # best score seen per track
+        self.confirmed_scores = []  # best score of every counted tree
+        self._confirmed = np.zeros(0, dtype=bool)
+
+    @property
+    def unique(self):
+        return len(self.confirmed_scores)
+
+    def update(self, boxes, scores, shift=(0.0, 0.0)):
+        """Match one frame's detections; returns the number of newly counted trees"""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        predicted = self.boxes + np.array([shift[0], shift[1], shift[0], shift[1]])
+        iou = pairwise_iou(predicted, boxes)
+
+        track_of = np.full(len(boxes), -1)
+        if iou.size:
+            pairs = np.argwhere(iou >= self.iou_thres)
+            order = np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind="stable")
+            used_t, used_d = set(), set()
+            for t, d in pairs[order]:
+                if t in used_t or d in used_d:
+                    continue
+                used_t.add(t)
+                used_d.add(d)
+                track_of[d] = t
+
+        matched = track_of >= 0
+        t_idx = track_of[matched]
+        self.boxes = predicted
+        self.misses += 1
+        self.boxes[t_idx] = boxes[matched]
+        self.hits[t_idx] += 1
+        self.misses[t_idx] = 0
+        self.best[t_idx] = np.maximum(self.best[t_idx], scores[matched])
+
+        # Unmatched detections start new tracks
+        n_new = int((~matched).sum())
+        self.boxes = np.concatenate([self.boxes, boxes[~matched]])
+        self.hits = np.concatenate([self.hits, np.ones(n_new, dtype=np.int64)])
+        self.misses = np.concatenate([self.misses, np.zeros(n_new, dtype=np.int64)])
+        self.best = np.concatenate([self.best, scores[~matched]])
+        self._confirmed = np.concatenate([self._confirmed, np.zeros(n_new, dtype=bool)])
+
+        newly = (self.hits >= self.min_hits) & ~self._confirmed
+        self._confirmed |= newly
+        self.confirmed_scores.extend(self.best[newly].tolist())
+
+        keep = self.misses <= self.max_misses
+        self.boxes, self.hits, self.misses = self.boxes[keep], self.hits[keep], self.misses[keep]
+        self.best, self._confirmed = self.best[keep], self._confirmed[keep]
+        return int(newly.sum())
+
+
+class StreamSession:
+    """Per-stream state: frame accounting, motion estimate and the tracker.
+
+    The transport (WebSocket handler, replay CLI) feeds frames in and calls
+    `update` with each kept frame's detections in frame order.
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, max_latency_ms=DEFAULT_MAX_LATENCY_MS,
+                 iou_thres=0.3, min_hits=2, max_misses=5):
+        self.max_pending = max(1, int(max_pending))
+        self.max_latency = float(max_latency_ms) / 1000.0
+        self.tracker = IouTracker(iou_thres, min_hits, max_misses)
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.started = time.time()
+        self._prev = None
+
+    def admit(self, pending: deque, frame):
+        """Append a frame to the pending queue, dropping the oldest when full"""
+        self.received += 1
+        pending.append(frame)
+        while len(pending) > self.max_pending:
+            pending.popleft()
+            self.dropped += 1
+
+    def take(self, pending: deque, limit, now=None):
+        """Pop up to `limit` frames to process, dropping ones that are already too old.
+
+        Frames are (seq, received_at, payload) tuples.
+        """
+        now = time.perf_counter() if now is None else now
+        batch = []
+        while pending and len(batch) < limit:
+            frame = pending.popleft()
+            if self.max_latency and now - frame[1] > self.max_latency:
+                self.dropped += 1
+                continue
+            batch.append(frame)
+        return batch
+
+    def update(self, seq, image, boxes, scores, received_at=None, include_boxes=False) -> dict:
+        """Track one processed frame (BGR array + its detections); returns the progress message"""
+        cur = motion_frame(image)
+        shift = estimate_shift(self._prev, cur)
+        self._prev = cur
+        new = self.tracker.update(boxes, scores, shift)
+        self.processed += 1
+        msg = {
+            "type": "frame",
+            "seq": seq,
+            "detections": int(len(scores)),
+            "new": new,
+            "unique": self.tracker.unique,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
+        if received_at is not None:
+            msg["latency_ms"] = round((time.perf_counter() - received_at) * 1000, 1)
+        if include_boxes:
+            msg["boxes"] = np.round(np.asarray(boxes, dtype=np.float64), 1).tolist()
+            msg["scores"] = np.round(np.asarray(scores, dtype=np.float64), 3).tolist()
+        return msg
+
+    def summary(self) -> dict:
+        scores = self.tracker.confirmed_scores
+        return {
+            "type": "summary",
+            "unique": self.tracker.unique,
+            "avg_confidence": round(float(np.mean(scores)), 2) if scores else 0,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "seconds": round(time.time() - self.started, 2),
+        }
+
+
+def iter_video(path, fps=None, quality=85):
+    """(frame index, JPEG bytes) of a video file, optionally resampled to `fps`"""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Cannot open video {path}")
+    src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1.0, src_fps / fps) if fps else 1.0
+    i, next_keep = 0, 0.0
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            if i >= next_keep:
+                next_keep += step
+                ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                if ok:
+                    yield i, buf.tobytes()
+            i += 1
+    finally:
+        cap.release()
+
+
+def replay_server(path, url, fps=None, realtime=True):
+    """Send a video file to a running /stream endpoint, printing progress messages"""
+    import threading
+    from websockets.sync.client import connect
+
+    with connect(url, max_size=None) as ws:
+        def receive():
+            for message in ws:
+                msg = json.loads(message)
+                print(json.dumps(msg))
+                if msg.get("type") in ("summary", "error"):
+                    return
+
+        reader = threading.Thread(target=receive, daemon=True)
+        reader.start()
+        started = time.perf_counter()
+        for n, (i, jpg) in enumerate(iter_video(path, fps)):
+            if realtime and fps:
+                time.sleep(max(0.0, started + n / fps - time.perf_counter()))
+            ws.send(jpg)
+        ws.send(json.dumps({"type": "end"}))
+        reader.join()
+
+
+def replay_local(path, weights, fps=None, conf=0.25, imgsz=640, batch=4, **session_kwargs):
+    """Run a video file through the model and tracker in-process (no dropping)"""
+    from ultralytics import YOLO
+
+    from decode import decode_image
+    from tiling import boxes_from_result
+
+    model = YOLO(weights)
+    session = StreamSession(**session_kwargs)
+    frames = []
+
+    def flush():
+        results = model([img.array for _, img in frames], imgsz=imgsz, conf=conf, verbose=False)
+        for (seq, img), r in zip(frames, results):
+            boxes, scores = boxes_from_result(r)
+            print(json.dumps(session.update(seq, img.array, boxes, scores)))
+        frames.clear()
+
+    for i, jpg in iter_video(path, fps):
+        session.received += 1
+        frames.append((i, decode_image(jpg, imgsz)))
+        if len(frames) >= batch:
+            flush()
+    if frames:
+        flush()
+    print(json.dumps(session.summary()))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Replay a video file as a live tree-counting stream")
+    p.add_argument("video")
+    p.add_argument("--url", default=None, help="ws://host:port/stream of a running backend")
+    p.add_argument("--weights", default=None, help="run in-process with this model instead")
+    p.add_argument("--fps", type=float, default=None, help="resample the video to this frame rate")
+    p.add_argument("--no_realtime", action="store_true", help="send frames as fast as possible")
+    p.add_argument("--conf", type=float, default=0.25)
+    p.add_argument("--imgsz", type=int, default=640)
+    p.add_argument("--min_hits", type=int, default=2)
+    args = p.parse_args()
+
+    if args.url:
+        replay_server(args.video, args.url, args.fps, not args.no_realtime)
+    elif args.weights:
+        replay_local(args.video, args.weights, args.fps, args.conf, args.imgsz, min_hits=args.min_hits)
+    else:
+        p.error("pass --url or --weights")
@@ -0,0 +1,316 @@
+"""Incremental re-processing of repeat surveys.
+
+Plantations are flown again and again, and most of each new orthomosaic
+looks like the previous one. A survey run cuts the raster into a tile grid
+that is fixed in map coordinates (tile (i, j) covers the same ground in every
+survey with the same CRS and resolution), fingerprints every tile and only
+runs the model on tiles that differ from the previous survey of the same
+site. Detections of the other tiles are copied over from the stored results.
+
+Each tile has two fingerprints:
+
+- `sha`: BLAKE2b of the tile's pixels; equal hashes mean identical content.
+- `phash`: a 32 x 32 luminance block-mean hash, normalised for brightness and
+  contrast. Two tiles count as the same when no block differs by more than
+  `max_distance` levels (1/32 of the tile's standard deviation each). Sensor
+  noise, exposure changes and recompression stay well below the default of
+  20; a tree appearing or disappearing changes its blocks by far more.
+
+Inference runs on `tile_size` crops: the tile's core plus a margin of
+context on every side. A detection belongs to the tile whose core holds its
+centre, so tiles are independent and a survey's count is the sum of its
+tiles. Per-tile results (boxes relative to the core, packed as in
+geometry.py) are stored in `survey_tiles`, so the next survey compares by
+key lookup instead of recomputing anything.
+"""
+import hashlib
+import json
+import math
+
+import cv2
+import numpy as np
+from bson import Binary
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+from geometry import pack_geometry, unpack_geometry
+from raster import require_rasterio, to_uint8
+from tiling import DEFAULT_TILE_SIZE, DEFAULT_OVERLAP, blank_tile_mask, boxes_from_result
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:  # optional: only needed for GeoTIFF ingestion
+    rasterio = None
+
+PHASH_SIZE = 32
+DEFAULT_MAX_DISTANCE = 20
+# extent_changed: the raster covers a different part of the tile than last time
+STATUSES = ("unchanged", "similar", "changed", "extent_changed", "new")
+REUSED = ("unchanged", "similar")
+
+
+def grid_layout(tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    """(core, margin) of the survey grid for a model tile size.
+
+    Neighbouring crops overlap by `2 * margin`, like sliced inference tiles
+    overlapping by `tile_size * overlap`.
+    """
+    margin = int(math.ceil(tile_size * overlap / 2))
+    return max(1, tile_size - 2 * margin), margin
+
+
+def grid_origin(transform, core):
+    """Pixel position of the map-anchored grid origin.
+
+    For north-up rasters the grid starts at map coordinate 0 in steps of
+    `core` pixels, so every survey at the same resolution gets the same tile
+    keys whatever its extent. Rotated or non-georeferenced rasters use the
+    pixel grid.
+    """
+    if transform is None or transform.b != 0 or transform.d != 0 or not transform.a or not transform.e:
+        return 0, 0
+    return int(round(transform.c / transform.a)), int(round(transform.f / transform.e))
+
+
+def grid_signature(crs, transform, core, margin, params) -> dict:
+    """What must match for two surveys' tiles to be comparable"""
+    res = [round(transform.a, 9), round(transform.e, 9)] if transform is not None else None
+    grid = {"crs": str(crs) if crs is not None else None, "res": res, "core": core, "margin": margin,
+            "params": params}
+    grid["key"] = hashlib.blake2b(json.dumps(grid, sort_keys=True).encode(), digest_size=12).hexdigest()
+    return grid
+
+
+def content_hash(tile) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(tile.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(tile).tobytes())
+    return h.hexdigest()
+
+
+def perceptual_hash(tile) -> bytes:
+    """Brightness/contrast-normalised PHASH_SIZE^2 block means of an RGB tile"""
+    gray = cv2.cvtColor(tile, cv2.COLOR_RGB2GRAY).astype(np.float32)
+    small = cv2.resize(gray, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    # The floor keeps noise on near-uniform tiles from being blown up
+    norm = (small - small.mean()) / max(float(small.std()), 8.0)
+    return np.clip(np.round(norm * 32 + 128), 0, 255).astype(np.uint8).tobytes()
+
+
+def phash_distance(a, b) -> int:
+    """Largest block difference between two perceptual hashes"""
+    a, b = np.frombuffer(bytes(a), dtype=np.uint8), np.frombuffer(bytes(b), dtype=np.uint8)
+    if a.shape != b.shape:
+        return 255
+    return int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max())
+
+
+def raster_meta(path, overview_level=None) -> dict:
+    require_rasterio()
+    open_kwargs = {"overview_level": overview_level} if overview_level is not None else {}
+    with rasterio.open(path, **open_kwargs) as src:
+        return {"width": src.width, "height": src.height, "transform": src.transform, "crs": src.crs}
+
+
+def _compare(fp, prev, max_distance):
+    """(status, distance) of a tile against its previous result"""
+    if prev is None:
+        return "new", None
+    if prev.get("size") != fp["size"]:
+        return "extent_changed", None
+    if prev.get("sha") == fp["sha"]:
+        return "unchanged", 0
+    distance = phash_distance(prev["phash"], fp["phash"])
+    return ("similar" if distance <= max_distance else "changed"), distance
+
+
+def survey_windows(path, predict_fn, grid, previous, tiles_out, window_size=2048,
+                   max_distance=DEFAULT_MAX_DISTANCE, overview_level=None, batch_size=8):
+    """Generator over (boxes_px, scores, transform, crs) per block of tiles.
+
+    Same shape as `raster.detect_windows`, so the output feeds the GeoJSON
+    writer and the spatial index unchanged. `previous` maps tile keys to the
+    previous survey's tile documents; one document per non-blank tile is
+    appended to `tiles_out`.
+    """
+    require_rasterio()
+    core, margin = grid["core"], grid["margin"]
+    open_kwargs = {"overview_level": overview_level} if overview_level is not None else {}
+    with rasterio.open(path, **open_kwargs) as src:
+        ox, oy = grid_origin(src.transform, core)
+        i0, i1 = ox // core, (src.width - 1 + ox) // core
+        j0, j1 = oy // core, (src.height - 1 + oy) // core
+        per_block = max(1, window_size // core)
+        for bj in range(j0, j1 + 1, per_block):
+            for bi in range(i0, i1 + 1, per_block):
+                cols = range(bi, min(bi + per_block, i1 + 1))
+                rows = range(bj, min(bj + per_block, j1 + 1))
+                out = _survey_block(src, predict_fn, cols, rows, ox, oy, core, margin, previous,
+                                    tiles_out, max_distance, batch_size)
+                if out is not None:
+                    yield out[0], out[1], src.transform, src.crs
+
+
+def _survey_block(src, predict_fn, cols, rows, ox, oy, core, margin, previous, tiles_out,
+                  max_distance, batch_size):
+    # Read the whole block plus context once, clipped to the raster
+    col0 = max(0, cols[0] * core - ox - margin)
+    row0 = max(0, rows[0] * core - oy - margin)
+    col1 = min(src.width, (cols[-1] + 1) * core - ox + margin)
+    row1 = min(src.height, (rows[-1] + 1) * core - oy + margin)
+    read_win = Window(col0, row0, col1 - col0, row1 - row0)
+    mask = src.dataset_mask(window=read_win)
+    if not mask.any():
+        return None
+    arr = to_uint8(src.read(window=read_win))
+    arr[mask == 0] = 255
+    del mask
+
+    # Core of every tile in block-array coordinates
+    cores = []
+    for j in rows:
+        for i in cols:
+            x0, y0 = max(0, i * core - ox), max(0, j * core - oy)
+            x1, y1 = min(src.width, (i + 1) * core - ox), min(src.height, (j + 1) * core - oy)
+            if x1 > x0 and y1 > y0:
+                cores.append((i, j, x0 - col0, y0 - row0, x1 - col0, y1 - row0))
+    windows = np.array([c[2:] for c in cores], dtype=np.int64).reshape(-1, 4)
+    blank = blank_tile_mask(arr, windows) if len(windows) else np.zeros(0, dtype=bool)
+
+    out_boxes, out_scores, fresh = [], [], []
+    for (i, j, x0, y0, x1, y1), is_blank in zip(cores, blank):
+        if is_blank:
+            continue
+        tile = arr[y0:y1, x0:x1]
+        key = f"{i}_{j}"
+        fp = {"sha": content_hash(tile), "phash": perceptual_hash(tile), "size": [x1 - x0, y1 - y0]}
+        prev = previous.get(key)
+        status, distance = _compare(fp, prev, max_distance)
+        doc = {
+            "key": key, "col": i, "row": j, "status": status, "distance": distance,
+            "size": fp["size"], "sha": fp["sha"], "phash": Binary(fp["phash"]),
+            "prev_n": prev["n"] if prev is not None else None,
+            "bounds": _map_bounds(src.transform, x0 + col0, y0 + row0, x1 + col0, y1 + row0),
+        }
+        tiles_out.append(doc)
+        if status in REUSED:
+            boxes, scores = unpack_geometry(prev["geometry"])
+            doc.update(geometry=prev["geometry"], n=len(scores))
+            out_boxes.append(boxes + np.array([x0, y0, x0, y0]))
+            out_scores.append(scores)
+        else:
+            fresh.append((doc, x0, y0, x1, y1))
+
+    # Changed and new tiles: model on core + margin crops, keep boxes centred in the core
+    h, w = arr.shape[:2]
+    for start in range(0, len(fresh), batch_size):
+        chunk = fresh[start:start + batch_size]
+        crops, offsets = [], []
+        for _, x0, y0, x1, y1 in chunk:
+            cx0, cy0 = max(0, x0 - margin), max(0, y0 - margin)
+            cx1, cy1 = min(w, x1 + margin), min(h, y1 + margin)
+            crops.append(np.ascontiguousarray(arr[cy0:cy1, cx0:cx1, ::-1]))
+            offsets.append((cx0, cy0))
+        for (doc, x0, y0, x1, y1), (cx0, cy0), result in zip(chunk, offsets, predict_fn(crops)):
+            boxes, scores = boxes_from_result(result)
+            boxes = boxes.astype(np.float64) + np.array([cx0, cy0, cx0, cy0])
+            cx, cy = (boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2
+            own = (cx >= x0) & (cx < x1) & (cy >= y0) & (cy < y1)
+            boxes, scores = boxes[own], scores[own]
+            doc.update(geometry=pack_geometry(boxes - np.array([x0, y0, x0, y0]), scores), n=int(len(scores)))
+            out_boxes.append(boxes)
+            out_scores.append(scores)
+    del arr
+
+    if not out_boxes:
+        return None
+    boxes, scores = np.concatenate(out_boxes), np.concatenate(out_scores)
+    if len(boxes) == 0:
+        return None
+    # Block array -> dataset pixel space
+    return boxes + np.array([col0, row0, col0, row0]), scores
+
+
+def _map_bounds(transform, x0, y0, x1, y1):
+    """[min_x, min_y, max_x, max_y] of a pixel rectangle in the raster CRS"""
+    xs, ys = transform * (np.array([x0, x1], dtype=np.float64), np.array([y0, y1], dtype=np.float64))
+    return [float(min(xs)), float(min(ys)), float(max(xs)), float(max(ys))]
+
+
+def change_summary(tiles, previous) -> dict:
+    """Tile and tree counts of a finished survey against the previous one"""
+    counts = {status: 0 for status in STATUSES}
+    # added/removed only compare tiles covering the same ground in both surveys
+    trees = {"reused": 0, "inferred": 0, "added": 0, "removed": 0}
+    seen = set()
+    for doc in tiles:
+        counts[doc["status"]] += 1
+        seen.add(doc["key"])
+        trees["reused" if doc["status"] in REUSED else "inferred"] += doc["n"]
+        if doc["status"] not in ("new", "extent_changed"):
+            delta = doc["n"] - doc["prev_n"]
+            trees["added" if delta > 0 else "removed"] += abs(delta)
+    counts["not_covered"] = sum(1 for key in previous if key not in seen)
+    counts["total"] = len(tiles)
+    return {"tiles": counts, "trees": trees}
+
+
+class SurveyStore:
+    """Survey summaries (`surveys`) and per-tile results (`survey_tiles`)."""
+
+    def __init__(self, surveys, tiles):
+        self.surveys = surveys
+        self.tiles = tiles
+
+    def ensure_indexes(self):
+        try:
+            self.surveys.create_index(
+                [("site", ASCENDING), ("grid.key", ASCENDING), ("timestamp", DESCENDING)], name="site_grid_time")
+            self.tiles.create_index([("survey_id", ASCENDING), ("key", ASCENDING)], name="survey_key", unique=True)
+            self.tiles.create_index([("survey_id", ASCENDING), ("status", ASCENDING)], name="survey_status")
+            return True
+        except PyMongoError as e:
+            print(f"⚠️ Survey index creation failed: {e}")
+            return False
+
+    def previous(self, site, grid):
+        """(survey doc, {tile key: tile doc}) of the latest comparable survey of a site"""
+        survey = self.surveys.find_one({"site": site, "grid.key": grid["key"]}, sort=[("timestamp", DESCENDING)])
+        if survey is None:
+            return None, {}
+        fields = {"_id": 0, "key": 1, "size": 1, "sha": 1, "phash": 1, "geometry": 1, "n": 1}
+        return survey, {doc["key"]: doc for doc in self.tiles.find({"survey_id": survey["_id"]}, fields)}
+
+    def site_survey_ids(self, site):
+        """Ids of every stored survey of a site"""
+        return self.surveys.distinct("_id", {"site": site})
+
+    def save(self, survey, tiles, batch=1000):
+        """Store the tiles, then the summary that makes them visible to the next survey"""
+        for start in range(0, len(tiles), batch):
+            chunk = [{**doc, "survey_id": survey["_id"]} for doc in tiles[start:start + batch]]
+            self.tiles.insert_many(chunk, ordered=False)
+        self.surveys.insert_one(survey)
+
+    def get(self, survey_id):
+        return self.surveys.find_one({"_id": survey_id})
+
+    def recent(self, site=None, limit=50):
+        query = {"site": site} if site else {}
+        return list(self.surveys.find(query).sort("timestamp", DESCENDING).limit(limit))
+
+    def report(self, survey_id, status=None, limit=1000, skip=0):
+        """Per-tile change report rows, without fingerprints or boxes"""
+        query = {"survey_id": survey_id}
+        if status:
+            query["status"] = status
+        fields = {"_id": 0, "key": 1, "col": 1, "row": 1, "status": 1, "n": 1, "prev_n": 1, "distance": 1,
+                  "bounds": 1}
+        rows = []
+        for doc in self.tiles.find(query, fields).sort([("row", ASCENDING), ("col", ASCENDING)]).skip(skip).limit(limit):
+            doc["trees"] = doc.pop("n")
+            doc["previous_trees"] = doc.pop("prev_n")
+            doc["delta"] = doc["trees"] - (doc["previous_trees"] or 0)
+            rows.append(doc)
+        return rows
@@ -0,0 +1,122 @@
+"""Repeat surveys replace a site's trees in the spatial index instead of adding to them.
+
+Runs /surveys end to end on a synthetic GeoTIFF with mongomock and a fake
+model (dark blobs are trees). Run from backend/: python -m pytest tests
+"""
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+mongomock = pytest.importorskip("mongomock")
+rasterio = pytest.importorskip("rasterio")
+pytest.importorskip("shapely")
+from fastapi.testclient import TestClient
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+WIDTH = HEIGHT = 1536
+ORIGIN = (500000.0, 4500000.0)  # UTM 33N
+RES = 0.05
+
+
+class _Array:
+    def __init__(self, a):
+        self.a = a
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.a
+
+
+class _Boxes:
+    def __init__(self, xyxy, conf):
+        self.xyxy, self.conf = _Array(xyxy), _Array(conf)
+
+    def __len__(self):
+        return len(self.conf.a)
+
+
+def fake_predict(images):
+    """One box per dark blob of every crop"""
+    results = []
+    for img in images:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        _, _, stats, _ = cv2.connectedComponentsWithStats((gray < 80).astype(np.uint8))
+        boxes = np.array([[x, y, x + w, y + h] for x, y, w, h, area in stats[1:] if area > 50],
+                         dtype=np.float32).reshape(-1, 4)
+        results.append(SimpleNamespace(boxes=_Boxes(boxes, np.full(len(boxes), 0.9, dtype=np.float32))))
+    return results
+
+
+def write_raster(path, img):
+    with rasterio.open(path, "w", driver="GTiff", width=img.shape[1], height=img.shape[0], count=3,
+                       dtype="uint8", crs="EPSG:32633", transform=from_origin(*ORIGIN, RES, RES)) as dst:
+        dst.write(img.transpose(2, 0, 1))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    for env, name in (("DB_SPILL_PATH", "detections_spill.jsonl"), ("TREES_SPILL_PATH", "trees_spill.jsonl"),
+                      ("JOBS_DIR", "jobs"), ("SOURCE_IMAGE_DIR", "images"), ("RENDER_CACHE_DIR", "renders")):
+        monkeypatch.setenv(env, str(tmp_path / name))
+    monkeypatch.setenv("MONGO_URI", "mongodb://localhost:27017")  # never contacted
+    sys.modules.pop("main", None)
+    import main
+
+    # mongomock's bulk_write doesn't take ordered= the way the pyramid updates pass it
+    monkeypatch.setattr(mongomock.Collection, "bulk_write", lambda self, updates, ordered=True: [
+        self.update_one(u._filter, u._doc, upsert=u._upsert) for u in updates])
+    db = mongomock.MongoClient(tz_aware=True).tree_sense
+    monkeypatch.setattr(main, "db", db)
+    monkeypatch.setattr(main.detection_writer, "collection", db.detections)
+    monkeypatch.setattr(main.tree_writer, "collection", db.trees)
+    monkeypatch.setattr(main.spatial_index, "trees", db.trees)
+    monkeypatch.setattr(main.spatial_index, "density", db.density_tiles)
+    monkeypatch.setattr(main, "survey_store", main.surveys.SurveyStore(db.surveys, db.survey_tiles))
+    monkeypatch.setattr(main.db_health, "available", True)
+    monkeypatch.setattr(main, "model_registry", SimpleNamespace(
+        ready=True, status="ready", current=SimpleNamespace(model_id="fake", imgsz=640)))
+    monkeypatch.setattr(main, "predict_blocking", fake_predict)
+    main.tree_writer.start()
+    yield main, db
+    main.tree_writer.stop()
+
+
+def test_repeat_survey_keeps_tree_count(app, tmp_path):
+    main, db = app
+    rng = np.random.default_rng(0)
+    img = np.full((HEIGHT, WIDTH, 3), (70, 140, 80), np.uint8)
+    for x, y in rng.integers(40, WIDTH - 40, (80, 2)).tolist():
+        cv2.circle(img, (x, y), 12, (20, 60, 25), -1)
+    write_raster(tmp_path / "first.tif", img)
+    write_raster(tmp_path / "second.tif", img)  # nothing changed: every tile is reused
+
+    bbox = transform_bounds("EPSG:32633", "EPSG:4326", ORIGIN[0], ORIGIN[1] - HEIGHT * RES,
+                            ORIGIN[0] + WIDTH * RES, ORIGIN[1])
+    bbox = ",".join(str(v) for v in (bbox[0] - 1e-4, bbox[1] - 1e-4, bbox[2] + 1e-4, bbox[3] + 1e-4))
+    client = TestClient(main.app)
+    counts = []
+    for name in ("first.tif", "second.tif"):
+        with open(tmp_path / name, "rb") as f:
+            r = client.post("/surveys?site=farm&tile_size=512", files={"file": (name, f, "image/tiff")})
+        assert r.status_code == 201, r.text
+        main.tree_writer.stop()  # flush the queued trees
+        main.tree_writer.start()
+        counts.append(client.get(f"/trees/count?bbox={bbox}").json()["data"]["count"])
+
+    survey = r.json()["data"]
+    assert survey["tree_count"] > 0
+    assert survey["trees_replaced"] == survey["tree_count"]
+    assert counts == [survey["tree_count"]] * 2
+    assert db.trees.count_documents({"site": "farm"}) == survey["tree_count"]
+    pyramid = db.density_tiles.find_one({"z": main.spatial.TILE_MIN_ZOOM})
+    assert pyramid["n"] == survey["tree_count"]
@@ -0,0 +1,240 @@
+"""Sliced (tiled) inference for large aerial images.
+
+Large orthomosaics lose most trees when the whole frame is downsampled to the
+model input size, so the image is cut in memory into overlapping tiles (the
+same idea as `tile_image` in tree-count-training/data_prep.py, without
+writing anything to disk), blank tiles are skipped, the remaining tiles are
+run through the model in batches, and duplicate boxes along tile seams are
+merged so each tree is only counted once.
+
+Can also be used from the command line:
+
+    python tiling.py --weights ../models/best.pt --tile_size 640 --overlap 0.2 ortho.jpg
+"""
+import numpy as np
+
+DEFAULT_TILE_SIZE = 640
+DEFAULT_OVERLAP = 0.2
+# Tiles that are (almost) a single flat colour -- nodata borders, white/black
+# padding -- are skipped. Mirrors the `mean < 240` heuristic in data_prep.py.
+BLANK_STD = 4.0
+BLANK_WHITE_MEAN = 240.0
+
+
+def tile_windows(width, height, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    """Return an (N, 4) int array of x0, y0, x1, y1 tile windows covering the image.
+
+    Tiles advance by `tile_size * (1 - overlap)`; the last row/column is snapped
+    to the image border so every tile is full size when the image allows it.
+    """
+    tile_size = int(tile_size)
+    stride = max(1, int(round(tile_size * (1.0 - overlap))))
+
+    def starts(length):
+        if length <= tile_size:
+            return np.array([0])
+        s = np.arange(0, length - tile_size, stride)
+        return np.append(s, length - tile_size)
+
+    xs, ys = starts(width), starts(height)
+    gx, gy = np.meshgrid(xs, ys)
+    x0, y0 = gx.ravel(), gy.ravel()
+    x1 = np.minimum(x0 + tile_size, width)
+    y1 = np.minimum(y0 + tile_size, height)
+    return np.stack([x0, y0, x1, y1], axis=1).astype(np.int64)
+
+
+def blank_tile_mask(image, windows, sample_step=4, blank_std=BLANK_STD, white_mean=BLANK_WHITE_MEAN):
+    """Vectorized blank-tile check.
+
+    Computes mean and standard deviation of every window at once from summed
+    area tables of a subsampled grayscale copy, instead of calling `tile.mean()`
+    per tile. Returns a boolean array, True where the tile should be skipped.
+    """
+    sub = image[::sample_step, ::sample_step]
+    gray = sub.mean(axis=2) if sub.ndim == 3 else sub.astype(np.float64)
+    sat = np.zeros((gray.shape[0] + 1, gray.shape[1] + 1))
+    sat2 = np.zeros_like(sat)
+    sat[1:, 1:] = gray.cumsum(0).cumsum(1)
+    sat2[1:, 1:] = (gray * gray).cumsum(0).cumsum(1)
+
+    h, w = gray.shape
+    x0 = np.minimum(windows[:, 0] // sample_step, w - 1)
+    y0 = np.minimum(windows[:, 1] // sample_step, h - 1)
+    x1 = np.clip(-(-windows[:, 2] // sample_step), x0 + 1, w)
+    y1 = np.clip(-(-windows[:, 3] // sample_step), y0 + 1, h)
+
+    def window_sum(t):
+        return t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+
+    area = (x1 - x0) * (y1 - y0)
+    mean = window_sum(sat) / area
+    var = np.maximum(window_sum(sat2) / area - mean * mean, 0.0)
+    return (np.sqrt(var) < blank_std) | (mean >= white_mean)
+
+
+def _pairwise_overlap(box, boxes, metric="ios"):
+    """Overlap of one box against many: IoU, or intersection over the smaller box.
+
+    IoS is the better match for seam duplicates, where one copy of a tree is
+    cut off at a tile edge and its IoU with the full box is low.
+    """
+    ix0 = np.maximum(box[0], boxes[:, 0])
+    iy0 = np.maximum(box[1], boxes[:, 1])
+    ix1 = np.minimum(box[2], boxes[:, 2])
+    iy1 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(ix1 - ix0, 0, None) * np.clip(iy1 - iy0, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    if metric == "iou":
+        denom = area + areas - inter
+    else:
+        denom = np.minimum(area, areas)
+    return inter / np.maximum(denom, 1e-9)
+
+
+def merge_boxes(boxes, scores, iou_thres=0.5, method="nms", metric="ios"):
+    """Greedy NMS or weighted box fusion over (N, 4) xyxy boxes.
+
+    Returns (boxes, scores) of the surviving / fused detections, sorted by score.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    order = np.argsort(-scores)
+    out_boxes, out_scores = [], []
+    while order.size:
+        i = order[0]
+        rest = order[1:]
+        overlap = _pairwise_overlap(boxes[i], boxes[rest], metric)
+        dup = overlap > iou_thres
+        if method == "wbf" and dup.any():
+            members = np.concatenate([[i], rest[dup]])
+            w = scores[members]
+            out_boxes.append((boxes[members] * w[:, None]).sum(0) / w.sum())
+        else:
+            out_boxes.append(boxes[i])
+        out_scores.append(scores[i])
+        order = rest[~dup]
+    if not out_boxes:
+        return np.zeros((0, 4)), np.zeros(0)
+    return np.array(out_boxes), np.array(out_scores)
+
+
+def seam_mask(boxes, windows):
+    """True for boxes touching a region covered by more than one tile.
+
+    Only those can be duplicates, so interior boxes skip the O(n^2) merge.
+    """
+    mask = np.zeros(len(boxes), dtype=bool)
+    if len(boxes) == 0:
+        return mask
+    for lo_col, hi_col, b0, b1 in ((0, 2, 0, 2), (1, 3, 1, 3)):
+        starts = np.unique(windows[:, lo_col])
+        ends = np.unique(windows[:, hi_col])
+        # Band between the start of tile k+1 and the end of tile k
+        bands_lo = starts[1:]
+        bands_hi = ends[:-1] if len(ends) > 1 else ends[:0]
+        n = min(len(bands_lo), len(bands_hi))
+        if n == 0:
+            continue
+        lo, hi = bands_lo[:n], bands_hi[:n]
+        hit = (boxes[:, b1, None] >= lo[None, :]) & (boxes[:, b0, None] <= hi[None, :])
+        mask |= hit.any(axis=1)
+    return mask
+
+
+def plan_tiles(image, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, skip_blank=True):
+    """Return (windows, crops, skipped) for an HxWxC RGB uint8 array.
+
+    `crops` are contiguous BGR tiles (the channel order ultralytics expects for
+    numpy input), produced one tile at a time so the whole image is never copied.
+    """
+    h, w = image.shape[:2]
+    windows = tile_windows(w, h, tile_size, overlap)
+    skipped = 0
+    if skip_blank and len(windows) > 1:
+        blank = blank_tile_mask(image, windows)
+        skipped = int(blank.sum())
+        windows = windows[~blank]
+    crops = (np.ascontiguousarray(image[y0:y1, x0:x1, ::-1]) for x0, y0, x1, y1 in windows)
+    return windows, crops, skipped
+
+
+def boxes_from_result(result):
+    """(xyxy, conf) numpy arrays from an ultralytics Results object"""
+    b = result.boxes
+    if b is None or len(b) == 0:
+        return np.zeros((0, 4)), np.zeros(0)
+    return b.xyxy.cpu().numpy(), b.conf.cpu().numpy()
+
+
+def merge_tile_detections(windows, tile_boxes, tile_scores, iou_thres=0.5, method="nms"):
+    """Shift per-tile detections into image coordinates and merge seam duplicates."""
+    if not tile_boxes:
+        return np.zeros((0, 4)), np.zeros(0)
+    offsets = windows[:, [0, 1, 0, 1]]
+    boxes = np.concatenate([b.reshape(-1, 4) + o for b, o in zip(tile_boxes, offsets)])
+    scores = np.concatenate(tile_scores)
+    if len(boxes) == 0:
+        return boxes, scores
+    seam = seam_mask(boxes, windows)
+    merged_boxes, merged_scores = merge_boxes(boxes[seam], scores[seam], iou_thres, method)
+    boxes = np.concatenate([boxes[~seam], merged_boxes])
+    scores = np.concatenate([scores[~seam], merged_scores])
+    order = np.argsort(-scores)
+    return boxes[order], scores[order]
+
+
+def sliced_predict(predict_fn, image, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                   batch_size=8, iou_thres=0.5, method="nms", skip_blank=True):
+    """Synchronous sliced inference.
+
+    `predict_fn` takes a list of BGR tiles and returns one ultralytics Results
+    per tile. Returns a dict with merged `boxes`, `scores` and tile statistics.
+    """
+    windows, crops, skipped = plan_tiles(image, tile_size, overlap, skip_blank)
+    tile_boxes, tile_scores = [], []
+    batch = []
+    for crop in crops:
+        batch.append(crop)
+        if len(batch) == batch_size:
+            for r in predict_fn(batch):
+                b, s = boxes_from_result(r)
+                tile_boxes.append(b); tile_scores.append(s)
+            batch = []
+    if batch:
+        for r in predict_fn(batch):
+            b, s = boxes_from_result(r)
+            tile_boxes.append(b); tile_scores.append(s)
+    boxes, scores = merge_tile_detections(windows, tile_boxes, tile_scores, iou_thres, method)
+    return {
+        "boxes": boxes,
+        "scores": scores,
+        "tiles": {"processed": int(len(windows)), "skipped_blank": skipped},
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    from PIL import Image
+    from ultralytics import YOLO
+
+    p = argparse.ArgumentParser(description="Sliced tree detection for large images")
+    p.add_argument('images', nargs='+')
+    p.add_argument('--weights', required=True)
+    p.add_argument('--conf', type=float, default=0.25)
+    p.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE)
+    p.add_argument('--overlap', type=float, default=DEFAULT_OVERLAP)
+    p.add_argument('--batch', type=int, default=8)
+    p.add_argument('--iou_thres', type=float, default=0.5)
+    p.add_argument('--merge', default='nms', choices=['nms', 'wbf'])
+    args = p.parse_args()
+
+    Image.MAX_IMAGE_PIXELS = None  # orthomosaics are legitimately huge
+    y = YOLO(args.weights)
+    predict = lambda tiles: y(tiles, conf=args.conf, imgsz=args.tile_size, verbose=False)
+    for path in args.images:
+        arr = np.asarray(Image.open(path).convert('RGB'))
+        out = sliced_predict(predict, arr, args.tile_size, args.overlap, args.batch, args.iou_thres, args.merge)
+        print(f"{path}: {len(out['boxes'])} trees "
+              f"({out['tiles']['processed']} tiles, {out['tiles']['skipped_blank']} blank skipped)")
@@ -1,12 +1,13 @@
 "use client";
 
 import { useEffect, useState } from "react";
-import { fetchDetections } from "@/utils/api";
-import { Detection } from "@/constants/types";
+import { fetchDetections, fetchDetectionStats } from "@/utils/api";
+import { Detection, DetectionStats } from "@/constants/types";
 import Link from "next/link";
 
 export default function DetectionsPage() {
   const [detections, setDetections] = useState<Detection[]>([]);
+  const [stats, setStats] = useState<DetectionStats | null>(null);
   const [loading, setLoading] = useState<boolean>(true);
   const [error, setError] = useState<string | null>(null);
 
@@ -14,8 +15,18 @@ export default function DetectionsPage() {
     const loadDetections = async () => {
       try {
         setLoading(true);
-        const response = await fetchDetections(50);
+        // Totals come from the stats endpoint; only the visible page of
+        // records is listed
+        const [response, statsResponse] = await Promise.all([
+          fetchDetections(50),
+          // The list is still useful without totals; they show as n/a
+          fetchDetectionStats().catch((err) => {
+            console.error(err);
+            return null;
+          }),
+        ]);
         setDetections(response.data);
+        setStats(statsResponse?.data ?? null);
       } catch (err) {
         setError("Failed to load detections");
         console.error(err);
@@ -51,12 +62,10 @@ export default function DetectionsPage() {
     );
   }
 
-  const totalTrees = detections.reduce((sum, d) => sum + d.tree_count, 0);
-  const avgConfidence =
-    detections.length > 0
-      ? detections.reduce((sum, d) => sum + d.avg_confidence, 0) /
-        detections.length
-      : 0;
+  // Without stats the totals are unknown, not zero
+  const totalDetections = stats ? stats.images : "n/a";
+  const totalTrees = stats ? stats.trees : "n/a";
+  const avgConfidence = stats ? `${(stats.avg_confidence * 100).toFixed(1)}%` : "n/a";
 
   return (
     <div className="min-h-screen bg-gray-50 p-6">
@@ -78,11 +87,18 @@ export default function DetectionsPage() {
         </div>
 
         {/* Stats */}
+        {!stats && (
+          <div className="bg-yellow-50 border border-yellow-200 rounded-lg p-4 mb-4">
+            <p className="text-yellow-800">
+              Totals are unavailable right now (statistics could not be loaded).
+            </p>
+          </div>
+        )}
         <div className="grid grid-cols-1 md:grid-cols-3 gap-4 mb-6">
           <div className="bg-white rounded-lg shadow p-6">
             <p className="text-sm text-gray-600 mb-1">Total Detections</p>
             <p className="text-3xl font-bold text-gray-900">
-              {detections.length}
+              {totalDetections}
             </p>
           </div>
 
@@ -93,9 +109,7 @@ export default function DetectionsPage() {
 
           <div className="bg-white rounded-lg shadow p-6">
             <p className="text-sm text-gray-600 mb-1">Avg. Confidence</p>
-            <p className="text-3xl font-bold text-blue-600">
-              {(avgConfidence * 100).toFixed(1)}%
-            </p>
+            <p className="text-3xl font-bold text-blue-600">{avgConfidence}</p>
           </div>
         </div>
 
@@ -3,6 +3,12 @@ export const API_ENDPOINTS = {
   UPLOAD: "/upload",
   DETECTIONS: "/detections",
   DETECTION_BY_ID: (id: string) => `/detections/${id}`,
+  DETECTION_IMAGE: (id: string) => `/detections/${id}/image`,
+  DETECTION_THUMBNAIL: (id: string, size = 256) => `/detections/${id}/thumbnail?size=${size}`,
+  DETECTION_STATS: "/detections/stats",
+  DETECTION_STATS_DAILY: "/detections/stats/daily",
+  DETECTION_STATS_SITES: "/detections/stats/sites",
+  DETECTION_STATS_CONFIDENCE: "/detections/stats/confidence",
   HEALTH: "/health",
 } as const;
 
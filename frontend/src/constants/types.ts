@@ -19,11 +19,30 @@ export interface Detection {
   tree_count: number;
   avg_confidence: number;
   confidences: number[];
+  boxes?: [number, number, number, number][];
   image_size: {
     width: number;
     height: number;
   };
   timestamp: string;
+  site?: string;
+  image_url?: string;
+  thumbnail_url?: string;
+}
+
+export interface DetectionStats {
+  images: number;
+  trees: number;
+  avg_trees_per_image: number;
+  avg_confidence: number;
+  first_day: string | null;
+  last_day: string | null;
+  sites: number;
+}
+
+export interface DetectionStatsResponse extends ApiResponse<DetectionStats> {
+  success: boolean;
+  data: DetectionStats;
 }
 
 export interface TreeDetectionResult {
@@ -53,4 +72,5 @@ export interface DetectionsListResponse extends ApiResponse<Detection[]> {
   success: boolean;
   count: number;
   data: Detection[];
+  next_cursor?: string | null;
 }
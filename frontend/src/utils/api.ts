@@ -3,6 +3,7 @@ import { API_ENDPOINTS } from "@/constants/config";
 import {
   DetectionResponse,
   DetectionsListResponse,
+  DetectionStatsResponse,
 } from "@/constants/types";
 
 /**
@@ -33,16 +34,20 @@ export const uploadImage = async (file: File): Promise<DetectionResponse> => {
 };
 
 /**
- * Fetch all detections from the backend
+ * Fetch detections from the backend, newest first
  * @param limit - Maximum number of records to fetch
+ * @param before - `next_cursor` from the previous page, to fetch the next one
  * @returns Promise with detections list
  */
 export const fetchDetections = async (
-  limit: number = 50
+  limit: number = 50,
+  before?: string
 ): Promise<DetectionsListResponse> => {
   try {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (before) params.set("before", before);
     const response = await API.get<DetectionsListResponse>(
-      `${API_ENDPOINTS.DETECTIONS}?limit=${limit}`
+      `${API_ENDPOINTS.DETECTIONS}?${params.toString()}`
     );
     return response.data;
   } catch (error) {
@@ -66,6 +71,28 @@ export const fetchDetectionById = async (id: string) => {
   }
 };
 
+/**
+ * Fetch aggregate statistics (computed server side from daily rollups)
+ * @param site - Only count records tagged with this site
+ * @returns Promise with totals over all detections
+ */
+export const fetchDetectionStats = async (
+  site?: string
+): Promise<DetectionStatsResponse> => {
+  try {
+    const params = new URLSearchParams();
+    if (site) params.set("site", site);
+    const query = params.toString();
+    const response = await API.get<DetectionStatsResponse>(
+      query ? `${API_ENDPOINTS.DETECTION_STATS}?${query}` : API_ENDPOINTS.DETECTION_STATS
+    );
+    return response.data;
+  } catch (error) {
+    console.error("Error fetching detection stats:", error);
+    throw error;
+  }
+};
+
 /**
  * Check API health
  * @returns Promise with health status
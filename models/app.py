@@ -1,58 +1,388 @@
 # Tree Imagining Application - Tree Detection using YOLOv8 Counts the Trees in Aerial Images
+#
+# Batch counting CLI for large image sets:
+#
+#   python app.py /data/survey --out counts.jsonl --annotate annotated/
+#   python app.py "tiles/**/*.tif" --list extra.txt --out counts.parquet --procs 4
+#
+# Files are decoded on prefetch threads while the model works on the
+# previous batch, annotated copies are drawn by a separate process pool, and
+# one row per image is appended to the output as soon as its batch finishes.
+# Re-running the same command skips files already in the output, so an
+# interrupted overnight run picks up where it stopped.
 
-from ultralytics import YOLO
+import argparse
+import csv
+import glob
+import json
 import os
+import queue
+import threading
+import time
 from pathlib import Path
 
-# Load your trained model
-model = YOLO("best.pt")
-
-# Define image paths
-image_paths = ["sample/image1.jpeg", "sample/image2.jpeg"]
-
-# Check if images exist
-existing_images = [img for img in image_paths if os.path.exists(img)]
-
-if not existing_images:
-    print("Images not found in current directory!")
-    print("Please ensure image1.jpg and image2.jpg are in the models folder")
-else:
-    print(f"Found {len(existing_images)} images\n")
-    
-    # Run inference
-    results = model(existing_images, conf=0.25)
-    
-    total_trees = 0
-    
-    # Process results
-    for i, result in enumerate(results):
-        boxes = result.boxes
-        tree_count = len(boxes)
-        total_trees += tree_count
-        
-        print(f"{'='*60}")
-        print(f"Image: {existing_images[i]}")
-        print(f"Trees detected: {tree_count}")
-        
-        if tree_count > 0:
-            confidences = boxes.conf.tolist()
-            print(f"Confidence scores: {[f'{conf:.2f}' for conf in confidences]}")
-            print(f"Average confidence: {sum(confidences)/len(confidences):.2f}")
-        
-        # Display result
-        result.show()
-        
-        # Save result with detected boxes
-        output_name = f"result_{Path(existing_images[i]).stem}.jpg"
-        result.save(filename=output_name)
-        print(f"Saved result to: {output_name}")
-        print(f"{'='*60}\n")
-    
-    # Summary
+import cv2
+import numpy as np
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+FIELDS = ["file", "count", "mean_conf", "max_conf", "width", "height", "error"]
+BOX_FIELD = "boxes"  # --save_boxes: [[x1, y1, x2, y2, conf], ...] in pixels
+
+
+def collect_inputs(inputs, list_files=()):
+    """Expand directories (recursively), glob patterns and file lists into a
+    sorted, de-duplicated list of image paths"""
+    paths = []
+    for lf in list_files:
+        with open(lf) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    found = set()
+    for item in list(inputs) + paths:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                found.update(os.path.join(root, n) for n in names if Path(n).suffix.lower() in IMAGE_EXTS)
+        elif glob.has_magic(item):
+            found.update(p for p in glob.glob(item, recursive=True) if Path(p).suffix.lower() in IMAGE_EXTS)
+        elif os.path.isfile(item):
+            found.add(item)
+        else:
+            print(f"⚠️ Not found: {item}")
+    return sorted(os.path.abspath(p) for p in found)
+
+
+# ---------- output ----------
+
+def _trim_partial_line(path):
+    """Drop a half-written last line left by an interrupted run"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+class RowWriter:
+    """Appends result rows to .jsonl, .csv or .parquet output.
+
+    JSONL/CSV are appended and flushed after every batch. Parquet files
+    can't be appended to, so `counts.parquet` is a directory of part files,
+    one per `flush_rows` rows, each complete on its own.
+    """
+
+    def __init__(self, path, flush_rows=5000, boxes=False):
+        self.path = path
+        self.fields = FIELDS + [BOX_FIELD] if boxes else FIELDS
+        self.kind = Path(path).suffix.lower().lstrip(".")
+        if self.kind not in ("jsonl", "csv", "parquet"):
+            raise ValueError(f"Unsupported output format: {path} (use .jsonl, .csv or .parquet)")
+        self.flush_rows = flush_rows
+        self._pending = []
+        self._f = None
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        if self.kind == "parquet":
+            import pyarrow  # noqa: F401  (fail before any work is done)
+            os.makedirs(path, exist_ok=True)
+            self._part = len(glob.glob(os.path.join(path, "part-*.parquet")))
+            return
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            _trim_partial_line(path)
+        self._f = open(path, "a", newline="")
+        if self.kind == "csv":
+            self._csv = csv.DictWriter(self._f, fieldnames=self.fields)
+            if not exists:
+                self._csv.writeheader()
+
+    def done_files(self):
+        """Files already recorded by earlier runs"""
+        if self.kind == "parquet":
+            import pyarrow.parquet as pq
+            done = set()
+            for part in glob.glob(os.path.join(self.path, "part-*.parquet")):
+                done.update(pq.read_table(part, columns=["file"]).column("file").to_pylist())
+            return done
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, newline="") as f:
+            if self.kind == "csv":
+                return {row["file"] for row in csv.DictReader(f) if row.get("file")}
+            done = set()
+            for line in f:
+                try:
+                    done.add(json.loads(line)["file"])
+                except (ValueError, KeyError):
+                    pass
+            return done
+
+    def write(self, rows):
+        if self.kind == "parquet":
+            self._pending.extend(rows)
+            if len(self._pending) >= self.flush_rows:
+                self._flush_parquet()
+            return
+        for row in rows:
+            if self.kind == "csv":
+                self._csv.writerow({**row, BOX_FIELD: json.dumps(row[BOX_FIELD])} if BOX_FIELD in row else row)
+            else:
+                self._f.write(json.dumps(row) + "\n")
+        self._f.flush()
+
+    def _flush_parquet(self):
+        if not self._pending:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        fields = [
+            ("file", pa.string()), ("count", pa.int32()), ("mean_conf", pa.float32()),
+            ("max_conf", pa.float32()), ("width", pa.int32()), ("height", pa.int32()), ("error", pa.string()),
+        ]
+        if BOX_FIELD in self.fields:
+            fields.append((BOX_FIELD, pa.list_(pa.list_(pa.float32()))))
+        table = pa.Table.from_pylist(self._pending, schema=pa.schema(fields))
+        name = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+        pq.write_table(table, name + ".tmp")
+        os.replace(name + ".tmp", name)
+        self._part += 1
+        self._pending = []
+
+    def close(self):
+        if self.kind == "parquet":
+            self._flush_parquet()
+        elif self._f is not None:
+            self._f.close()
+
+
+# ---------- pipeline ----------
+
+def prefetch(files, out_q, threads):
+    """Decode files on `threads` threads into `out_q` (bounded, so decoding
+    runs at most a few batches ahead). cv2 releases the GIL while decoding.
+    Puts one None per thread when done."""
+    it = iter(files)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                path = next(it, None)
+            if path is None:
+                out_q.put(None)
+                return
+            try:
+                img = cv2.imread(path, cv2.IMREAD_COLOR)
+            except Exception:
+                img = None
+            out_q.put((path, img))
+
+    pool = [threading.Thread(target=worker, name=f"decode-{i}", daemon=True) for i in range(threads)]
+    for t in pool:
+        t.start()
+    return pool
+
+
+def render(task):
+    """Draw boxes on a fresh decode of the image (runs in the render pool)"""
+    path, out_path, boxes, scores = task
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        return
+    for (x1, y1, x2, y2), s in zip(boxes.astype(int), scores):
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 200, 0), 2)
+        cv2.putText(img, f"{s:.2f}", (x1, max(12, y1 - 4)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 200, 0), 1)
+    cv2.putText(img, f"trees: {len(scores)}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    cv2.imwrite(out_path, img)
+
+
+def annotated_path(path, annotate_dir, root):
+    rel = os.path.relpath(path, root) if root else os.path.basename(path)
+    if rel.startswith(".."):
+        rel = os.path.basename(path)
+    return os.path.join(annotate_dir, os.path.splitext(rel)[0] + ".jpg")
+
+
+def run(files, opts, emit, render_submit=None):
+    """Count trees in `files`; `emit(rows)` receives one row per image after
+    every batch and `render_submit(task)` (if given) gets annotation jobs"""
+    import torch
+    from ultralytics import YOLO
+
+    if opts["threads"]:
+        torch.set_num_threads(opts["threads"])
+    model = YOLO(opts["model"], task="detect")
+    batch_size = opts["batch"]
+    q = queue.Queue(maxsize=batch_size * opts["prefetch"])
+    prefetch(files, q, opts["decode_threads"])
+    remaining = opts["decode_threads"]
+    while remaining:
+        batch, rows = [], []
+        while len(batch) < batch_size and remaining:
+            item = q.get()
+            if item is None:
+                remaining -= 1
+                continue
+            path, img = item
+            if img is None:
+                rows.append(dict(file=path, count=None, mean_conf=None, max_conf=None, width=None, height=None,
+                                 error="unreadable"))
+                if opts["boxes"]:
+                    rows[-1][BOX_FIELD] = []
+            else:
+                batch.append((path, img))
+        if batch:
+            results = model([img for _, img in batch], conf=opts["conf"], imgsz=opts["imgsz"],
+                            batch=len(batch), verbose=False)
+            for (path, img), r in zip(batch, results):
+                scores = r.boxes.conf.cpu().numpy()
+                boxes = r.boxes.xyxy.cpu().numpy()
+                rows.append(dict(file=path, count=int(len(scores)),
+                                 mean_conf=round(float(scores.mean()), 4) if len(scores) else None,
+                                 max_conf=round(float(scores.max()), 4) if len(scores) else None,
+                                 width=int(img.shape[1]), height=int(img.shape[0]), error=None))
+                if opts["boxes"]:
+                    rows[-1][BOX_FIELD] = np.round(np.column_stack([boxes, scores]), 3).tolist()
+                if render_submit is not None:
+                    render_submit((path, annotated_path(path, opts["annotate"], opts["root"]), boxes, scores))
+        if rows:
+            emit(rows)
+
+
+def _proc_main(index, files, opts, out_q):
+    """Inference process for --procs > 1: rows go back to the parent, which
+    owns the output file and the render pool"""
+    try:
+        run(files, opts, lambda rows: out_q.put(("rows", rows)),
+            (lambda task: out_q.put(("render", task))) if opts["annotate"] else None)
+    finally:
+        out_q.put(("done", index))
+
+
+def main():
+    p = argparse.ArgumentParser(description="Count trees in many images")
+    p.add_argument("inputs", nargs="*", help="image files, directories (recursive) or glob patterns")
+    p.add_argument("--list", action="append", default=[], help="text file with one image path per line")
+    p.add_argument("--model", default=str(Path(__file__).parent / "best.pt"))
+    p.add_argument("--conf", type=float, default=0.25)
+    p.add_argument("--imgsz", type=int, default=640)
+    p.add_argument("--batch", type=int, default=16)
+    p.add_argument("--out", default="counts.jsonl", help=".jsonl, .csv or .parquet (directory of parts)")
+    p.add_argument("--save_boxes", action="store_true", help="also write every box (for visualize.py)")
+    p.add_argument("--annotate", default=None, help="directory for annotated copies (off by default)")
+    p.add_argument("--render_workers", type=int, default=None, help="render processes (default: CPUs / 4)")
+    p.add_argument("--procs", type=int, default=1, help="inference processes, each with its own model copy")
+    p.add_argument("--threads", type=int, default=None, help="torch threads per process (default: CPUs / procs)")
+    p.add_argument("--decode_threads", type=int, default=2, help="decode threads per inference process")
+    p.add_argument("--prefetch", type=int, default=4, help="batches decoded ahead of inference")
+    p.add_argument("--overwrite", action="store_true", help="start over instead of skipping processed files")
+    args = p.parse_args()
+
+    files = collect_inputs(args.inputs, args.list)
+    if not files:
+        print("❌ No images found. Pass files, directories or glob patterns.")
+        return
+    if args.overwrite and os.path.exists(args.out):
+        import shutil
+        shutil.rmtree(args.out) if os.path.isdir(args.out) else os.remove(args.out)
+    writer = RowWriter(args.out, boxes=args.save_boxes)
+    done = writer.done_files()
+    todo = [f for f in files if f not in done]
+    print(f"🔍 {len(files)} images, {len(files) - len(todo)} already in {args.out}, {len(todo)} to process")
+    if not todo:
+        writer.close()
+        return
+
+    cpus = os.cpu_count() or 1
+    procs = max(1, min(args.procs, len(todo)))
+    opts = dict(model=args.model, conf=args.conf, imgsz=args.imgsz, batch=args.batch, prefetch=args.prefetch,
+                decode_threads=args.decode_threads, threads=args.threads or max(1, cpus // procs),
+                boxes=args.save_boxes, annotate=args.annotate,
+                root=os.path.commonpath(files) if len(files) > 1 else None)
+
+    render_pool, pending = None, []
+    render_workers = args.render_workers or max(1, cpus // 4)
+    if args.annotate:
+        from concurrent.futures import ProcessPoolExecutor
+        render_pool = ProcessPoolExecutor(render_workers)
+
+    def submit_render(task):
+        # bounded: don't let annotation fall arbitrarily far behind inference
+        pending.append(render_pool.submit(render, task))
+        if len(pending) > 8 * render_workers:
+            pending.pop(0).result()
+
+    stats = dict(images=0, trees=0, started=time.perf_counter(), last=0.0)
+
+    def emit(rows):
+        writer.write(rows)
+        stats["images"] += len(rows)
+        stats["trees"] += sum(r["count"] or 0 for r in rows)
+        now = time.perf_counter()
+        if now - stats["last"] > 10 or stats["images"] == len(todo):
+            stats["last"] = now
+            rate = stats["images"] / (now - stats["started"])
+            print(f"  {stats['images']}/{len(todo)} images, {rate:.1f} img/s, {stats['trees']} trees")
+
+    try:
+        if procs == 1:
+            run(todo, opts, emit, submit_render if render_pool else None)
+        else:
+            import multiprocessing as mp
+            ctx = mp.get_context("spawn")
+            out_q = ctx.Queue(maxsize=64)
+            workers = [ctx.Process(target=_proc_main, args=(i, todo[i::procs], opts, out_q), daemon=True)
+                       for i in range(procs)]
+            for w in workers:
+                w.start()
+            running, lost = set(range(procs)), []
+
+            def handle(kind, payload):
+                if kind == "rows":
+                    emit(payload)
+                elif kind == "render":
+                    submit_render(payload)
+                else:
+                    running.discard(payload)
+
+            while running:
+                try:
+                    handle(*out_q.get(timeout=5))
+                    continue
+                except queue.Empty:
+                    pass
+                # A process killed outright (OOM, SIGKILL) never sends "done"
+                dead = [i for i in running if not workers[i].is_alive()]
+                if dead:
+                    try:  # whatever it sent before exiting is already in the queue
+                        while True:
+                            handle(*out_q.get_nowait())
+                    except queue.Empty:
+                        pass
+                    for i in dead:
+                        if i in running:
+                            running.discard(i)
+                            lost.append(i)
+                            print(f"❌ Inference process {i} died (exit code {workers[i].exitcode})")
+            for w in workers:
+                w.join()
+            if lost:
+                raise SystemExit(f"❌ {len(lost)} inference process(es) died; rows written so far are kept, "
+                                 f"re-run the same command to process the rest")
+    finally:
+        writer.close()
+        if render_pool is not None:
+            for fut in pending:
+                fut.result()
+            render_pool.shutdown()
+
+    elapsed = time.perf_counter() - stats["started"]
     print(f"\n{'='*60}")
-    print(f"SUMMARY")
+    print("SUMMARY")
+    print(f"{'='*60}")
+    print(f"Images processed: {stats['images']} in {elapsed:.1f}s ({stats['images'] / max(elapsed, 1e-9):.1f} img/s)")
+    print(f"Total trees detected: {stats['trees']}")
+    print(f"Results: {args.out}")
     print(f"{'='*60}")
-    print(f"Total images processed: {len(existing_images)}")
-    print(f"Total trees detected: {total_trees}")
-    print(f"Average trees per image: {total_trees/len(existing_images):.2f}")
-    print(f"{'='*60}")
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 
-import os, argparse, json, shutil, math
+import os, argparse, json, shutil, math, zlib
 from glob import glob
 from pathlib import Path
 import cv2
@@ -25,126 +25,469 @@ def copy_files(file_list, dst_images, dst_labels, src_labels_ext='.txt'):
             # create empty label file so trainer knows no objects
             open(os.path.join(dst_labels, base + '.txt'), 'w').close()
 
-def coco_to_yolo(src_coco_json, images_dir, dst_dir, val_split=0.1, test_split=0.1):
+# ---------- conversion engine ----------
+#
+# Conversions run in three steps so that large exports (hundreds of
+# thousands of images) never hold the whole annotation file in memory or
+# copy image bytes:
+#   1. the annotation source is indexed (COCO JSON is streamed with ijson
+#      when installed) into compact numpy arrays;
+#   2. every image gets its split up front (seeded, so re-runs agree);
+#   3. chunks of images are linked into place and their label files written
+#      across a process pool. A manifest in the destination records finished
+#      chunks, so an interrupted run continues where it stopped.
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SPLITS = ('train', 'val', 'test')
+MANIFEST = '.prep_manifest.json'
+FICLONE = 0x40049409  # Linux ioctl: copy-on-write clone (btrfs, xfs)
+
+def assign_splits(n, val_split=0.1, test_split=0.1, seed=0):
+    """Split index (0=train, 1=val, 2=test) per item, decided before any file is touched"""
+    order = np.random.default_rng(seed).permutation(n)
+    ntest, nval = int(n * test_split), int(n * val_split)
+    split = np.zeros(n, dtype=np.int8)
+    split[order[:nval]] = 1
+    split[order[nval:nval + ntest]] = 2
+    return split
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except OSError:
+            fd.close()
+            os.unlink(dst)
+            raise
+
+def _same_content(src, dst):
+    """True if `dst` is `src` (hardlink/symlink) or a byte-identical copy of it"""
+    import filecmp
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        return os.path.getsize(src) == os.path.getsize(dst) and filecmp.cmp(src, dst, shallow=False)
+    except OSError:
+        return False
+
+def materialize(src, dst, mode='auto'):
+    """Place `src` at `dst` without copying bytes where the filesystem allows.
+
+    auto tries hardlink, then reflink, then symlink. Returns the method used.
+    An existing `dst` is only accepted if it is the same file as `src`
+    (e.g. from an interrupted run); anything else raises FileExistsError.
+    Copies are written to a temporary name first, so an interrupted copy
+    never leaves a truncated `dst`.
     """
-   
+    if os.path.lexists(dst):
+        if _same_content(src, dst):
+            return 'exists'
+        raise FileExistsError(f"{dst} already exists and is not {src} (two sources with the same name, "
+                              f"or output of another conversion; use --overwrite)")
+    methods = ['hardlink', 'reflink', 'symlink'] if mode == 'auto' else [mode]
+    for m in methods:
+        try:
+            if m == 'hardlink':
+                os.link(src, dst)
+            elif m == 'reflink':
+                _reflink(src, dst + '.tmp')
+                os.replace(dst + '.tmp', dst)
+            elif m == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                shutil.copyfile(src, dst + '.tmp')
+                os.replace(dst + '.tmp', dst)
+            return m
+        except (OSError, ImportError):
+            continue
+    shutil.copyfile(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+    return 'copy'
+
+def format_labels(rows):
+    """YOLO label text for rows of (cls, xc, yc, w, h)"""
+    return ''.join(f"{int(r[0])} {r[1]:.6f} {r[2]:.6f} {r[3]:.6f} {r[4]:.6f}\n" for r in rows)
+
+def _iter_json(path, prefix):
+    """Stream the items of a top-level array (e.g. 'images') of a JSON file"""
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            yield from ijson.items(f, prefix + '.item', use_float=True)
+    else:
+        # Fallback without ijson: parse once per array (whole file in memory)
+        with open(path, 'r') as f:
+            yield from json.load(f).get(prefix, [])
+
+def index_coco(src_coco_json):
+    """Stream a COCO file into compact arrays.
+
+    Returns dict with `files`, `widths`, `heights`, `names` (class names) and
+    per-annotation `ann_img` (row into files) and `ann_rows` (cls, xc, yc, w, h).
     """
-    with open(src_coco_json, 'r') as f:
-        coco = json.load(f)
-    id2name = {c['id']:c['name'] for c in coco['categories']}
-    name2id = {v:k for k,v in id2name.items()}
-    ann_by_img = defaultdict(list)
-    for a in coco['annotations']:
-        ann_by_img[a['image_id']].append(a)
-    imgid2f = {i['id']: i for i in coco['images']}
-    ensure_dirs(dst_dir)
-    all_images = []
-    for img_id, imginfo in imgid2f.items():
-        fname = imginfo['file_name']
+    from array import array
+    cats = sorted((c['id'], c['name']) for c in _iter_json(src_coco_json, 'categories'))
+    cat_index = {cid: i for i, (cid, _) in enumerate(cats)}
+    row_of, files, widths, heights = {}, [], array('i'), array('i')
+    for im in _iter_json(src_coco_json, 'images'):
+        row_of[im['id']] = len(files)
+        files.append(im['file_name'])
+        widths.append(int(im['width']))
+        heights.append(int(im['height']))
+    ann_img, ann_rows = array('i'), array('f')
+    for a in _iter_json(src_coco_json, 'annotations'):
+        r = row_of.get(a['image_id'])
+        if r is None:
+            continue
+        x, y, bw, bh = (float(v) for v in a['bbox'])  # COCO: x,y,w,h in pixels
+        w, h = widths[r], heights[r]
+        ann_img.append(r)
+        ann_rows.extend((cat_index.get(a['category_id'], 0), (x + bw / 2) / w, (y + bh / 2) / h, bw / w, bh / h))
+    return {
+        'files': np.array(files, dtype=str),
+        'widths': np.frombuffer(widths, dtype=np.int32),
+        'heights': np.frombuffer(heights, dtype=np.int32),
+        'names': np.array([n for _, n in cats] or ['tree'], dtype=str),
+        'ann_img': np.frombuffer(ann_img, dtype=np.int32),
+        'ann_rows': np.frombuffer(ann_rows, dtype=np.float32).reshape(-1, 5),
+    }
+
+def _coco_chunk(task):
+    """Worker: link one chunk of images into their splits and write their labels"""
+    chunk_id, images_dir, dst_dir, mode, items = task
+    stats = defaultdict(int)
+    for fname, split, rows in items:
         src_img = os.path.join(images_dir, fname)
         if not os.path.exists(src_img):
-            print("Skipping missing", src_img); continue
-        base = os.path.splitext(fname)[0]
-        dst_img = os.path.join(dst_dir, 'train','images', fname)  # temporary: move later to split
-        shutil.copy(src_img, dst_img)
-        # write label
-        h,w = imginfo['height'], imginfo['width']
-        ann_list = ann_by_img.get(img_id, [])
-        with open(os.path.join(dst_dir,'train','labels', base + '.txt'), 'w') as lf:
-            for a in ann_list:
-                bbox = a['bbox']  # COCO: x,y,w,h
-                x,y,bw,bh = bbox
-                x_c = x + bw/2
-                y_c = y + bh/2
-                # normalize
-                xc, yc, nw, nh = x_c/w, y_c/h, bw/w, bh/h
-                cls = a['category_id']-1 if a['category_id']>0 else 0
-                lf.write(f"{cls} {xc:.6f} {yc:.6f} {nw:.6f} {nh:.6f}\\n")
-        all_images.append(dst_img)
-    # split
-    random.shuffle(all_images)
-    N = len(all_images)
-    ntest = int(N*0.1)
-    nval = int(N*0.1)
-    train = all_images[ntest+nval:]
-    val = all_images[:nval]
-    test = all_images[nval: nval+ntest]
-    # move files to respective folders
-    for src in train:
-        base = os.path.basename(src)
-        shutil.move(src, os.path.join(dst_dir,'train','images', base))
-    for src in val:
-        base = os.path.basename(src)
-        shutil.move(src, os.path.join(dst_dir,'val','images', base))
-        # move corresponding label file
-        base_noext = os.path.splitext(base)[0]
-        lbl = os.path.join(dst_dir,'train','labels', base_noext + '.txt')
-        if os.path.exists(lbl):
-            shutil.move(lbl, os.path.join(dst_dir,'val','labels', base_noext + '.txt'))
-    for src in test:
-        base = os.path.basename(src)
-        shutil.move(src, os.path.join(dst_dir,'test','images', base))
-        base_noext = os.path.splitext(base)[0]
-        lbl = os.path.join(dst_dir,'train','labels', base_noext + '.txt')
-        if os.path.exists(lbl):
-            shutil.move(lbl, os.path.join(dst_dir,'test','labels', base_noext + '.txt'))
-    print("COCO -> YOLO structure created at", dst_dir)
-
-def voc_to_yolo(voc_images_dir, voc_anno_dir, dst_dir):
-    ensure_dirs(dst_dir)
-    imfiles = glob(os.path.join(voc_images_dir, '*'))
-    for img in imfiles:
+            stats['missing'] += 1
+            continue
+        name = os.path.basename(fname)
+        stats[materialize(src_img, os.path.join(dst_dir, split, 'images', name), mode)] += 1
+        label = os.path.join(dst_dir, split, 'labels', os.path.splitext(name)[0] + '.txt')
+        with open(label + '.tmp', 'w') as lf:
+            lf.write(format_labels(rows))
+        os.replace(label + '.tmp', label)
+    return chunk_id, dict(stats)
+
+def _voc_chunk(task):
+    """Worker: parse VOC XML for one chunk of images, link images and write labels"""
+    chunk_id, voc_anno_dir, dst_dir, mode, items = task
+    stats = defaultdict(int)
+    for img, split in items:
         name = os.path.basename(img)
         base = os.path.splitext(name)[0]
+        stats[materialize(img, os.path.join(dst_dir, split, 'images', name), mode)] += 1
         annf = os.path.join(voc_anno_dir, base + '.xml')
-        dst_img = os.path.join(dst_dir, 'train','images', name)
-        shutil.copy(img, dst_img)
-        h,w = 0,0
-        if os.path.exists(annf):
-            tree = ET.parse(annf)
-            root = tree.getroot()
-            size = root.find('size')
-            w = int(size.find('width').text); h = int(size.find('height').text)
-            with open(os.path.join(dst_dir,'train','labels', base + '.txt'),'w') as lf:
-                for obj in root.findall('object'):
-                    cls = obj.find('name').text
-                    bnd = obj.find('bndbox')
-                    xmin = float(bnd.find('xmin').text)
-                    ymin = float(bnd.find('ymin').text)
-                    xmax = float(bnd.find('xmax').text)
-                    ymax = float(bnd.find('ymax').text)
-                    bw = xmax - xmin; bh = ymax - ymin
-                    xc = xmin + bw/2; yc = ymin + bh/2
-                    lf.write(f"0 {xc/w:.6f} {yc/h:.6f} {bw/w:.6f} {bh/h:.6f}\\n")
-    print("VOC -> YOLO minimal conversion done.")
-
-def tile_image(img_path, out_dir, tile_size=512, stride=512, min_area_frac=0.001):
-    os.makedirs(out_dir, exist_ok=True)
+        if not os.path.exists(annf):
+            continue
+        root = ET.parse(annf).getroot()
+        size = root.find('size')
+        w = int(size.find('width').text); h = int(size.find('height').text)
+        rows = []
+        for obj in root.findall('object'):
+            bnd = obj.find('bndbox')
+            xmin, ymin, xmax, ymax = (float(bnd.find(k).text) for k in ('xmin', 'ymin', 'xmax', 'ymax'))
+            bw = xmax - xmin; bh = ymax - ymin
+            rows.append((0, (xmin + bw / 2) / w, (ymin + bh / 2) / h, bw / w, bh / h))
+        label = os.path.join(dst_dir, split, 'labels', base + '.txt')
+        with open(label + '.tmp', 'w') as lf:
+            lf.write(format_labels(rows))
+        os.replace(label + '.tmp', label)
+    return chunk_id, dict(stats)
+
+def source_signature(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+def _split_files(dst_dir):
+    """True if any split image/label directory of `dst_dir` has files"""
+    dirs = [os.path.join(dst_dir, split, kind) for split in SPLITS for kind in ('images', 'labels')]
+    return any(os.listdir(d) for d in dirs if os.path.isdir(d))
+
+def run_chunks(dst_dir, signature, tasks, worker_fn, workers=None, overwrite=False):
+    """Run chunk tasks on a process pool, skipping chunks a previous run finished.
+
+    `signature` describes the source and split parameters. Output of a
+    conversion with a different signature (another seed, other split
+    fractions, another source) would leave images in two splits, so it is
+    refused unless `overwrite`, which clears the split directories first.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    manifest_path = os.path.join(dst_dir, MANIFEST)
+    done = set()
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest is not None and manifest.get('signature') == signature and manifest.get('chunks') == len(tasks):
+        done = set(manifest['done'])
+    elif manifest is not None or _split_files(dst_dir):
+        if not overwrite:
+            raise FileExistsError(f"{dst_dir} holds the output of a different conversion; "
+                                  f"use --overwrite to replace it or pick another --dst")
+        print(f"Clearing previous conversion in {dst_dir}")
+        for split in SPLITS:
+            shutil.rmtree(os.path.join(dst_dir, split), ignore_errors=True)
+        ensure_dirs(dst_dir)
+    if done:
+        print(f"Resuming: {len(done)}/{len(tasks)} chunks already converted")
+
+    def save():
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'signature': signature, 'chunks': len(tasks), 'done': sorted(done)}, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    save()
+    totals = defaultdict(int)
+    pending = [t for t in tasks if t[0] not in done]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker_fn, t) for t in pending]
+        for n, fut in enumerate(as_completed(futures), 1):
+            chunk_id, stats = fut.result()
+            done.add(chunk_id)
+            for k, v in stats.items():
+                totals[k] += v
+            save()
+            if n % 20 == 0 or n == len(futures):
+                print(f"  {len(done)}/{len(tasks)} chunks")
+    return dict(totals)
+
+def coco_to_yolo(src_coco_json, images_dir, dst_dir, val_split=0.1, test_split=0.1,
+                 link='auto', workers=None, chunk_size=500, seed=0, overwrite=False):
+    """Convert a COCO detection export to a YOLO train/val/test tree (resumable)"""
+    ensure_dirs(dst_dir)
+    index = index_coco(src_coco_json)
+    files = index['files']
+    print(f"Indexed {len(files)} images, {len(index['ann_img'])} annotations")
+    split = assign_splits(len(files), val_split, test_split, seed)
+
+    # group annotation rows by image without a python dict of lists
+    order = np.argsort(index['ann_img'], kind='stable')
+    ann_img, ann_rows = index['ann_img'][order], index['ann_rows'][order]
+    bounds = np.searchsorted(ann_img, np.arange(len(files) + 1))
+
+    tasks = []
+    for c, start in enumerate(range(0, len(files), chunk_size)):
+        items = [(str(files[i]), SPLITS[split[i]], ann_rows[bounds[i]:bounds[i + 1]])
+                 for i in range(start, min(start + chunk_size, len(files)))]
+        tasks.append((c, images_dir, dst_dir, link, items))
+    signature = {'source': source_signature(src_coco_json), 'images_dir': os.path.abspath(images_dir),
+                 'val_split': val_split, 'test_split': test_split, 'seed': seed, 'chunk_size': chunk_size}
+    stats = run_chunks(dst_dir, signature, tasks, _coco_chunk, workers, overwrite)
+    if stats.get('missing'):
+        print(f"Skipped {stats['missing']} missing images")
+    sample_data_yaml(dst_dir, nc=len(index['names']), names=[str(n) for n in index['names']])
+    print("COCO -> YOLO structure created at", dst_dir, stats)
+
+def voc_to_yolo(voc_images_dir, voc_anno_dir, dst_dir, val_split=0.0, test_split=0.0,
+                link='auto', workers=None, chunk_size=500, seed=0, overwrite=False):
+    ensure_dirs(dst_dir)
+    imfiles = sorted(glob(os.path.join(voc_images_dir, '*')))
+    split = assign_splits(len(imfiles), val_split, test_split, seed)
+    tasks = [(c, voc_anno_dir, dst_dir, link,
+              [(imfiles[i], SPLITS[split[i]]) for i in range(start, min(start + chunk_size, len(imfiles)))])
+             for c, start in enumerate(range(0, len(imfiles), chunk_size))]
+    signature = {'source': os.path.abspath(voc_images_dir), 'count': len(imfiles),
+                 'anno_dir': os.path.abspath(voc_anno_dir), 'val_split': val_split, 'test_split': test_split,
+                 'seed': seed, 'chunk_size': chunk_size}
+    stats = run_chunks(dst_dir, signature, tasks, _voc_chunk, workers, overwrite)
+    print("VOC -> YOLO minimal conversion done.", stats)
+
+# ---------- label-aware tiling ----------
+#
+# Large orthomosaics are detected tile by tile at inference time (see
+# backend/tiling.py), so the training data is cut the same way: fixed-size
+# overlapping tiles with YOLO boxes remapped and clipped into each tile.
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+def tile_windows(w, h, tile_size=640, overlap=0.2):
+    """(N, 4) int array of x1, y1, x2, y2 tiles covering the image; edge tiles
+    are shifted inwards so every tile is full size"""
+    stride = max(1, int(round(tile_size * (1 - overlap))))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        s = list(range(0, length - tile_size, stride))
+        return s + [length - tile_size]
+
+    xs, ys = starts(w), starts(h)
+    gx, gy = np.meshgrid(xs, ys)
+    x1, y1 = gx.ravel(), gy.ravel()
+    return np.stack([x1, y1, np.minimum(x1 + tile_size, w), np.minimum(y1 + tile_size, h)], axis=1)
+
+def _tile_rows(windows):
+    """Group tiles by their row band: yields (y1, y2, indices of the tiles)"""
+    bands = windows[:, [1, 3]]
+    for (y1, y2) in np.unique(bands, axis=0):
+        yield int(y1), int(y2), np.flatnonzero((bands[:, 0] == y1) & (bands[:, 1] == y2))
+
+def blank_tiles(gray, windows, min_std=4.0, white=240, black=15):
+    """Vectorized blank check: tiles that are flat, near white or near black
+    (nodata borders).
+
+    Sums are taken one tile row at a time from column sums of that band
+    (squares as uint16), so memory stays at a few bytes per pixel of one
+    band instead of full-image float64 summed-area tables.
+    """
+    blank = np.zeros(len(windows), dtype=bool)
+    for y1, y2, idx in _tile_rows(windows):
+        band = gray[y1:y2]
+        cols = np.concatenate([[0], np.cumsum(band.sum(axis=0, dtype=np.int64))])
+        sq = band.astype(np.uint16)
+        sq *= sq  # 255 ** 2 fits in uint16
+        cols2 = np.concatenate([[0], np.cumsum(sq.sum(axis=0, dtype=np.int64))])
+        x1, x2 = windows[idx, 0], windows[idx, 2]
+        n = (x2 - x1) * (y2 - y1)
+        mean = (cols[x2] - cols[x1]) / n
+        std = np.sqrt(np.maximum((cols2[x2] - cols2[x1]) / n - mean ** 2, 0))
+        blank[idx] = (std < min_std) | (mean >= white) | (mean <= black)
+    return blank
+
+def read_yolo_labels(label_path):
+    """(N, 5) float array of cls, xc, yc, w, h (normalized)"""
+    if not label_path or not os.path.exists(label_path):
+        return np.zeros((0, 5), dtype=np.float32)
+    rows = np.loadtxt(label_path, dtype=np.float32, ndmin=2)
+    return rows[:, :5] if rows.size else np.zeros((0, 5), dtype=np.float32)
+
+def boxes_in_tiles(labels, w, h, windows, min_visibility=0.3, min_size=2):
+    """Remap boxes into every tile.
+
+    A box is kept in a tile if at least `min_visibility` of its area falls
+    inside it and the clipped box is at least `min_size` pixels on each side.
+    Tiles are processed one row at a time against the boxes overlapping that
+    row, so memory grows with the boxes near a row, not tiles x boxes.
+    Returns a list (one per tile) of (K, 5) arrays normalized to the tile.
+    """
+    out = [np.zeros((0, 5), dtype=np.float32) for _ in windows]
+    if len(labels) == 0:
+        return out
+    cls = labels[:, 0]
+    xc, yc, bw, bh = labels[:, 1] * w, labels[:, 2] * h, labels[:, 3] * w, labels[:, 4] * h
+    boxes = np.stack([xc - bw / 2, yc - bh / 2, xc + bw / 2, yc + bh / 2], axis=1)  # (N, 4)
+    area = np.maximum(bw * bh, 1e-9)
+    for y1, y2, idx in _tile_rows(windows):
+        near = np.flatnonzero((boxes[:, 3] > y1) & (boxes[:, 1] < y2))
+        if len(near) == 0:
+            continue
+        b = boxes[near]
+        win = windows[idx][:, None, :].astype(np.float32)  # (R, 1, 4)
+        ix1 = np.maximum(b[:, 0], win[..., 0])
+        iy1 = np.maximum(b[:, 1], win[..., 1])
+        ix2 = np.minimum(b[:, 2], win[..., 2])
+        iy2 = np.minimum(b[:, 3], win[..., 3])
+        iw, ih = ix2 - ix1, iy2 - iy1  # (R, M)
+        keep = (iw >= min_size) & (ih >= min_size) & (iw * ih / area[near] >= min_visibility)
+        for r, t in enumerate(idx):
+            k = keep[r]
+            x1, _, x2, _ = windows[t]
+            tw, th = x2 - x1, y2 - y1
+            out[t] = np.stack([
+                cls[near[k]],
+                ((ix1[r, k] + ix2[r, k]) / 2 - x1) / tw,
+                ((iy1[r, k] + iy2[r, k]) / 2 - y1) / th,
+                iw[r, k] / tw,
+                ih[r, k] / th,
+            ], axis=1).astype(np.float32)
+    return out
+
+def tile_image(img_path, label_path, out_images, out_labels, tile_size=640, overlap=0.2,
+               min_visibility=0.3, keep_empty=0.0, seed=0, quality=95):
+    """Cut one image (and its YOLO labels) into tiles; returns a stats dict.
+
+    Blank tiles are always dropped; tiles without any box are kept with
+    probability `keep_empty` (as background examples).
+    """
+    stats = defaultdict(int)
     im = cv2.imread(img_path)
-    h,w = im.shape[:2]
-    tile_id = 0
-    for y in range(0, h, stride):
-        for x in range(0, w, stride):
-            x2 = min(w, x + tile_size)
-            y2 = min(h, y + tile_size)
-            tile = im[y:y2, x:x2]
-            if tile.size == 0: continue
-            # skip mostly empty tiles
-            if (tile.mean() < 240):  # heuristic: not all-white
-                out_path = os.path.join(out_dir, f"{Path(img_path).stem}_tile_{tile_id}.jpg")
-                cv2.imwrite(out_path, tile)
-                tile_id += 1
-    return tile_id
-
-def sample_data_yaml(dst_dir, nc=1, names=['tree']):
-    content = {
-        'path': dst_dir,
-        'train': 'data/train/images',
-        'val': 'data/val/images',
-        'test': 'data/test/images',
-        'nc': nc,
-        'names': names
-    }
+    if im is None:
+        stats['unreadable'] += 1
+        return dict(stats)
+    h, w = im.shape[:2]
+    windows = tile_windows(w, h, tile_size, overlap)
+    blank = blank_tiles(cv2.cvtColor(im, cv2.COLOR_BGR2GRAY), windows)
+    per_tile = boxes_in_tiles(read_yolo_labels(label_path), w, h, windows, min_visibility)
+    stem = Path(img_path).stem
+    rng = np.random.default_rng([seed, zlib.crc32(stem.encode())])  # same choice on re-runs
+    for (x1, y1, x2, y2), is_blank, rows in zip(windows, blank, per_tile):
+        if is_blank:
+            stats['blank'] += 1
+            continue
+        if len(rows) == 0 and not rng.random() < keep_empty:
+            stats['empty'] += 1
+            continue
+        name = f"{stem}_{x1}_{y1}"
+        cv2.imwrite(os.path.join(out_images, name + '.jpg'), im[y1:y2, x1:x2], [cv2.IMWRITE_JPEG_QUALITY, quality])
+        with open(os.path.join(out_labels, name + '.txt'), 'w') as lf:
+            lf.write(format_labels(rows))
+        stats['tiles'] += 1
+        stats['boxes'] += len(rows)
+    return dict(stats)
+
+def _tile_task(task):
+    return tile_image(*task)
+
+def find_splits(src):
+    """{split name: (images dir, labels dir)} for a YOLO dataset root, an
+    images/labels pair or a bare images folder"""
+    splits = {}
+    for name in ('train', 'valid', 'val', 'test'):
+        d = os.path.join(src, name, 'images')
+        if os.path.isdir(d):
+            splits[name] = (d, os.path.join(src, name, 'labels'))
+    if not splits:
+        if os.path.isdir(os.path.join(src, 'images')):
+            splits['train'] = (os.path.join(src, 'images'), os.path.join(src, 'labels'))
+        else:
+            splits['train'] = (src, src)
+    return splits
+
+def tile_dataset(src, dst, tile_size=640, overlap=0.2, min_visibility=0.3, keep_empty=0.0,
+                 workers=None, seed=0):
+    """Tile every image of a YOLO dataset across a process pool, keeping splits"""
+    from concurrent.futures import ProcessPoolExecutor
+    splits = find_splits(src)
+    tasks = []
+    for split, (img_dir, lbl_dir) in splits.items():
+        out_images, out_labels = os.path.join(dst, split, 'images'), os.path.join(dst, split, 'labels')
+        os.makedirs(out_images, exist_ok=True)
+        os.makedirs(out_labels, exist_ok=True)
+        for img in sorted(glob(os.path.join(img_dir, '*'))):
+            if img.lower().endswith(IMAGE_EXTS):
+                label = os.path.join(lbl_dir, Path(img).stem + '.txt')
+                tasks.append((img, label, out_images, out_labels, tile_size, overlap, min_visibility,
+                              keep_empty, seed))
+    totals = defaultdict(int)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for n, stats in enumerate(pool.map(_tile_task, tasks, chunksize=8), 1):
+            for k, v in stats.items():
+                totals[k] += v
+            if n % 200 == 0:
+                print(f"  {n}/{len(tasks)} images")
+
+    names = ['tree']
+    src_yaml = os.path.join(src, 'data.yaml')
+    if os.path.exists(src_yaml):
+        import yaml
+        with open(src_yaml) as f:
+            names = yaml.safe_load(f).get('names', names)
+    sample_data_yaml(dst, nc=len(names), names=list(names), splits=list(splits))
+    print(f"Tiled {len(tasks)} images into {totals['tiles']} tiles ({totals['boxes']} boxes); "
+          f"dropped {totals['blank']} blank and {totals['empty']} empty tiles")
+    return dict(totals)
+
+def sample_data_yaml(dst_dir, nc=1, names=['tree'], splits=('train', 'val', 'test')):
+    content = {'path': os.path.abspath(dst_dir)}
+    for split in splits:
+        # ultralytics keys: train / val / test ('valid' folders map to val)
+        content['val' if split == 'valid' else split] = f'{split}/images'
+    content.update(nc=nc, names=names)
     import yaml
     with open(os.path.join(dst_dir, 'data.yaml'), 'w') as f:
         yaml.dump(content, f)
@@ -157,14 +500,38 @@ if __name__ == '__main__':
     p.add_argument('--src', type=str, help='source path or json')
     p.add_argument('--images', type=str, help='images dir')
     p.add_argument('--dst', default='./data', type=str)
-    p.add_argument('--tile_size', default=512, type=int)
-    p.add_argument('--stride', default=512, type=int)
+    p.add_argument('--tile_size', default=640, type=int)
+    p.add_argument('--overlap', default=0.2, type=float, help='tile overlap fraction')
+    p.add_argument('--stride', default=None, type=int, help='tile stride in pixels (overrides --overlap)')
+    p.add_argument('--min_visibility', default=0.3, type=float,
+                   help='min fraction of a box that must lie inside a tile to keep it')
+    p.add_argument('--keep_empty', default=0.0, type=float, help='fraction of tiles without boxes to keep')
+    p.add_argument('--val_split', default=None, type=float, help='default 0.1 (COCO) / 0 (VOC)')
+    p.add_argument('--test_split', default=None, type=float, help='default 0.1 (COCO) / 0 (VOC)')
+    p.add_argument('--link', default='auto', choices=['auto','hardlink','reflink','symlink','copy'],
+                   help='how images are placed in the output tree')
+    p.add_argument('--workers', default=None, type=int, help='processes (default: CPU count)')
+    p.add_argument('--chunk_size', default=500, type=int, help='images per task / manifest entry')
+    p.add_argument('--seed', default=0, type=int, help='split seed')
+    p.add_argument('--overwrite', action='store_true', help='replace the output of a different conversion in --dst')
     args = p.parse_args()
+    engine = dict(link=args.link, workers=args.workers, chunk_size=args.chunk_size, seed=args.seed,
+                  overwrite=args.overwrite)
+    splits = {k: v for k, v in (('val_split', args.val_split), ('test_split', args.test_split)) if v is not None}
     if args.mode == 'sample_yaml':
         sample_data_yaml(args.dst)
     elif args.mode == 'coco_to_yolo':
-        coco_to_yolo(args.src, args.images, args.dst)
+        coco_to_yolo(args.src, args.images, args.dst, **splits, **engine)
     elif args.mode == 'voc_to_yolo':
-        voc_to_yolo(args.images, args.src, args.dst)
+        voc_to_yolo(args.images, args.src, args.dst, **splits, **engine)
     elif args.mode == 'tile':
-        print(tile_image(args.src, args.dst, tile_size=args.tile_size, stride=args.stride))
\ No newline at end of file
+        overlap = 1 - args.stride / args.tile_size if args.stride else args.overlap
+        if os.path.isfile(args.src):
+            for d in ('images', 'labels'):
+                os.makedirs(os.path.join(args.dst, d), exist_ok=True)
+            label = os.path.join(os.path.dirname(args.src).replace('images', 'labels'), Path(args.src).stem + '.txt')
+            print(tile_image(args.src, label, os.path.join(args.dst, 'images'), os.path.join(args.dst, 'labels'),
+                             args.tile_size, overlap, args.min_visibility, args.keep_empty, args.seed))
+        else:
+            tile_dataset(args.src, args.dst, args.tile_size, overlap, args.min_visibility, args.keep_empty,
+                         args.workers, args.seed)
\ No newline at end of file
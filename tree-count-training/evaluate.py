@@ -1,9 +1,18 @@
-import argparse, os, json, glob, yaml
-from ultralytics import YOLO
+import argparse, os, json, glob, hashlib, yaml
 import numpy as np
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from tqdm import tqdm
 
+# Raw detections are cached at a low confidence floor with NMS effectively
+# disabled, so any (conf, iou) operating point can be recomputed from the
+# cache: greedy NMS on a score-sorted list only depends on higher-scoring
+# boxes, so the boxes kept at conf c are the ones kept over the full list
+# that also score >= c. The cache keeps up to MAX_CANDIDATES boxes per image
+# (ultralytics' own pre-NMS cap, max_nms), and --max_det is applied after NMS
+# exactly like predict() does, so dense images are not undercounted at low
+# confidence thresholds.
+
+MAX_CANDIDATES = 30000
+
 def load_yaml(p):
     with open(p, 'r') as f:
         return yaml.safe_load(f)
@@ -17,15 +26,207 @@ def gt_counts_from_labels(label_dir):
         counts[imgname] = len(lines)
     return counts
 
+def file_digest(path, chunk_size=1024 * 1024):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_grid(spec):
+    """'0.05:0.9:0.05' -> inclusive range, '0.25,0.5' -> list"""
+    if ':' in spec:
+        start, stop, step = (float(v) for v in spec.split(':'))
+        return np.round(np.arange(start, stop + step / 2, step), 4)
+    return np.array([float(v) for v in spec.split(',')])
+
+# ---------- prediction cache ----------
+
+def cache_path(cache_dir, model_hash, imgsz, conf_floor, max_det=MAX_CANDIDATES, tag=None):
+    """Cache file of one model and prediction setting; `tag` keeps input
+    variants (e.g. packed shards) in their own file so they don't evict each other"""
+    suffix = f'_{tag}' if tag else ''
+    return os.path.join(cache_dir, f'{model_hash}_{imgsz}_{conf_floor:g}_{max_det}{suffix}.npz')
+
+def load_cache(path):
+    """name -> (image digest, boxes Nx4 float32, scores N float32)"""
+    if not os.path.exists(path):
+        return {}
+    z = np.load(path, allow_pickle=False)
+    off = z['offsets']
+    return {
+        str(n): (str(d), z['boxes'][off[i]:off[i + 1]], z['scores'][off[i]:off[i + 1]])
+        for i, (n, d) in enumerate(zip(z['names'], z['digests']))
+    }
+
+def save_cache(path, entries):
+    names = sorted(entries)
+    sizes = [len(entries[n][2]) for n in names]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    boxes = np.concatenate([entries[n][1] for n in names]) if names else np.zeros((0, 4))
+    scores = np.concatenate([entries[n][2] for n in names]) if names else np.zeros(0)
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, names=np.array(names), digests=np.array([entries[n][0] for n in names]),
+                        offsets=offsets, boxes=boxes.astype(np.float32).reshape(-1, 4),
+                        scores=scores.astype(np.float32))
+    os.replace(tmp, path)
+
+def predict_missing(model_path, sources, entries, digests, conf_floor, imgsz, batch, max_det, scales=None):
+    """Batched inference for images not in the cache (or whose bytes changed).
+
+    `sources` maps image key -> path or BGR array; `scales` maps key -> (sx, sy)
+    taking boxes back to original pixels for pre-resized (packed) images.
+    """
+    todo = [k for k in sources if entries.get(k, (None,))[0] != digests[k]]
+    if not todo:
+        return 0
+    capped = []
+    from ultralytics import YOLO
+    y = YOLO(model_path, task='detect')
+    for i in tqdm(range(0, len(todo), batch), desc='Predicting'):
+        chunk = todo[i:i + batch]
+        # iou=1.0: keep every candidate, NMS is applied per threshold later
+        res = y.predict(source=[sources[k] for k in chunk], conf=conf_floor, iou=1.0, imgsz=imgsz,
+                        max_det=max_det, batch=len(chunk), verbose=False)
+        for k, r in zip(chunk, res):
+            order = np.argsort(-r.boxes.conf.cpu().numpy(), kind='stable')
+            boxes = r.boxes.xyxy.cpu().numpy()[order].astype(np.float32)
+            if scales is not None:
+                boxes *= np.tile(scales[k], 2).astype(np.float32)
+            entries[k] = (digests[k], boxes, r.boxes.conf.cpu().numpy()[order].astype(np.float32))
+            if len(order) >= max_det:
+                capped.append(k)
+    if capped:
+        print(f"⚠️ {len(capped)} image(s) hit the {max_det}-candidate cap at conf {conf_floor:g} "
+              f"(e.g. {capped[0]}); counts at the lowest thresholds may be low")
+    return len(todo)
+
+def img_key(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+# ---------- threshold sweep ----------
+
+def pairwise_iou(boxes, other=None):
+    """IoU matrix between `boxes` and `other` (default: `boxes` itself)"""
+    other = boxes if other is None else other
+    x1, y1, x2, y2 = boxes.T
+    ox1, oy1, ox2, oy2 = other.T
+    area = (x2 - x1) * (y2 - y1)
+    oarea = (ox2 - ox1) * (oy2 - oy1)
+    iw = np.clip(np.minimum(x2[:, None], ox2) - np.maximum(x1[:, None], ox1), 0, None)
+    ih = np.clip(np.minimum(y2[:, None], oy2) - np.maximum(y1[:, None], oy1), 0, None)
+    inter = iw * ih
+    return inter / np.maximum(area[:, None] + oarea - inter, 1e-9)
+
+def overlap_pairs(boxes, min_iou, block=256):
+    """(i, j, iou) of all pairs i < j with IoU > min_iou, sorted by i.
+
+    Boxes are swept in x order and each block is only compared with boxes
+    whose x range can reach it, so memory stays O(block * neighbours) even
+    for tens of thousands of candidates.
+    """
+    boxes = boxes.astype(np.float64)
+    by_x = np.argsort(boxes[:, 0], kind='stable')
+    sb = boxes[by_x]
+    x1 = sb[:, 0]
+    max_w = float((sb[:, 2] - sb[:, 0]).max()) if len(sb) else 0.0
+    ii, jj, vv = [], [], []
+    for a in range(0, len(sb), block):
+        rows = sb[a:a + block]
+        lo = np.searchsorted(x1, rows[0, 0] - max_w, side='left')
+        hi = np.searchsorted(x1, rows[:, 2].max(), side='right')
+        iou = pairwise_iou(rows, sb[lo:hi])
+        r, c = np.nonzero(iou > min_iou)
+        # back to score order; every pair shows up from both sides, keep i < j
+        i, j = by_x[r + a], by_x[c + lo]
+        upper = i < j
+        ii.append(i[upper])
+        jj.append(j[upper])
+        vv.append(iou[r[upper], c[upper]])
+    if not ii:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    i, j, v = np.concatenate(ii), np.concatenate(jj), np.concatenate(vv)
+    order = np.lexsort((j, i))
+    return i[order], j[order], v[order]
+
+def greedy_keep(n, pairs, thres):
+    """Greedy NMS keep mask for n score-sorted boxes from their overlap_pairs
+    (same rule as torchvision.nms: suppress when IoU > thres)"""
+    i, j, iou = pairs
+    sel = iou > thres
+    i, j = i[sel], j[sel]  # already ordered by i
+    keep = np.ones(n, dtype=bool)
+    if len(i) == 0:
+        return keep
+    firsts, starts = np.unique(i, return_index=True)
+    ends = np.append(starts[1:], len(i))
+    for a, s, e in zip(firsts.tolist(), starts.tolist(), ends.tolist()):
+        if keep[a]:
+            keep[j[s:e]] = False
+    return keep
+
+def count_grid(entries, names, conf_grid, iou_grid, max_det=None):
+    """Predicted counts, shape (n_iou, n_images, n_conf); at most `max_det`
+    boxes per image survive NMS, as in predict()"""
+    counts = np.zeros((len(iou_grid), len(names), len(conf_grid)), dtype=np.int64)
+    for j, name in enumerate(names):
+        _, boxes, scores = entries[name]
+        if len(scores) == 0:
+            continue
+        pairs = overlap_pairs(boxes, float(np.min(iou_grid)))
+        for k, t in enumerate(iou_grid):
+            kept = scores[greedy_keep(len(scores), pairs, t)][:max_det][::-1]
+            # number of kept scores >= each conf threshold
+            counts[k, j] = len(kept) - np.searchsorted(kept, conf_grid, side='left')
+    return counts
+
+def count_metrics(gt, counts):
+    """MAE/RMSE/R2 along the image axis (axis -2) for every grid cell"""
+    err = counts - gt[:, None]
+    mae = np.abs(err).mean(axis=-2)
+    rmse = np.sqrt((err ** 2).mean(axis=-2))
+    ss_tot = ((gt - gt.mean()) ** 2).sum()
+    r2 = 1 - (err ** 2).sum(axis=-2) / ss_tot if len(gt) > 1 and ss_tot > 0 else np.zeros_like(mae)
+    return mae, rmse, r2
+
+def save_curve(path, conf_grid, iou_grid, metric, name, best):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return False
+    fig, ax = plt.subplots(figsize=(7, 4.5))
+    for k, t in enumerate(iou_grid):
+        ax.plot(conf_grid, metric[k], label=f'iou={t:g}', lw=1.2)
+    ax.scatter([best['conf']], [best[name]], color='red', zorder=5, label='best')
+    ax.set_xlabel('confidence threshold')
+    ax.set_ylabel(name.upper())
+    ax.legend(fontsize=7, ncol=2)
+    ax.grid(alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+    plt.close(fig)
+    return True
+
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument('--model', required=True)
     p.add_argument('--data', required=True)
     p.add_argument('--conf_thres', type=float, default=0.25)
     p.add_argument('--iou_thres', type=float, default=0.45)
+    p.add_argument('--conf_grid', default='0.05:0.9:0.05', help='start:stop:step or comma list')
+    p.add_argument('--iou_grid', default='0.3:0.8:0.05', help='start:stop:step or comma list')
+    p.add_argument('--select', default='mae', choices=['mae', 'rmse', 'r2'], help='metric for the best operating point')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--max_det', type=int, default=1000, help='boxes kept per image after NMS')
+    p.add_argument('--cache_dir', default='eval_cache')
+    p.add_argument('--out', default='.', help='directory for the report, sweep CSV and curve')
+    p.add_argument('--no_val', action='store_true', help='skip the ultralytics detection validation pass')
+    p.add_argument('--shards', default=None, help='packed dataset dir from shards.py (read instead of test images)')
     args = p.parse_args()
 
-    y = YOLO(args.model, task='detect')
     data = load_yaml(args.data)
 
     # Auto-detect dataset directory (same folder as data.yaml)
@@ -39,66 +240,107 @@ if __name__ == '__main__':
             alt_path = os.path.join(data_dir, "data", rel_path)
             if os.path.exists(alt_path):
                 return alt_path
+            # Roboflow exports use "../test/images" relative to a data.yaml
+            # that actually sits next to test/
+            alt_path = os.path.join(data_dir, rel_path.lstrip('./'))
+            if os.path.exists(alt_path):
+                return alt_path
         return path
 
-    test_images_root = resolve_path(data.get('test', 'test/images'))
-    test_labels_root = test_images_root.replace('images', 'labels')
+    scales = None
+    cache_tag = None
+    if args.shards:
+        # 📦 Pre-decoded images and packed labels, memory-mapped
+        from shards import ShardSet
+        packed = ShardSet(os.path.join(args.shards, 'test'))
+        print(f"🗂 Using packed test split from: {packed.split_dir}")
+        sources = {n: packed.image(i) for i, n in enumerate(packed.names)}
+        # packed pixels differ slightly from the decoded originals: their predictions go to a separate cache file
+        digests = {n: f'{d}@{packed.imgsz}' for n, d in zip(packed.names, packed.digests)}
+        cache_tag = f'shards{packed.imgsz}'
+        scales = {n: (w0 / w, h0 / h) for n, (h, w), (h0, w0) in zip(packed.names, packed.hw, packed.hw0)}
+        gt_counts = dict(zip(packed.names, packed.counts().tolist()))
+        if not sources:
+            raise FileNotFoundError(f"No packed images in {packed.split_dir}")
+    else:
+        test_images_root = resolve_path(data.get('test', 'test/images'))
+        test_labels_root = test_images_root.replace('images', 'labels')
+
+        print(f"🗂 Using test images from: {test_images_root}")
+        print(f"🗂 Using test labels from: {test_labels_root}")
 
-    print(f"🗂 Using test images from: {test_images_root}")
-    print(f"🗂 Using test labels from: {test_labels_root}")
+        imgs = sorted(glob.glob(os.path.join(test_images_root, '*')))
+        gt_counts = gt_counts_from_labels(test_labels_root)
 
-    imgs = glob.glob(os.path.join(test_images_root, '*'))
-    gt_counts = gt_counts_from_labels(test_labels_root)
-    preds_counts = {}
+        if not imgs:
+            raise FileNotFoundError(f"No images found in {test_images_root}")
+        if not gt_counts:
+            raise FileNotFoundError(f"No label files found in {test_labels_root}")
+        sources = {img_key(im): im for im in imgs}
+        digests = {img_key(im): file_digest(im) for im in imgs}
 
-    if not imgs:
-        raise FileNotFoundError(f"No images found in {test_images_root}")
-    if not gt_counts:
-        raise FileNotFoundError(f"No label files found in {test_labels_root}")
+    conf_grid = np.union1d(parse_grid(args.conf_grid), [args.conf_thres])
+    iou_grid = np.union1d(parse_grid(args.iou_grid), [args.iou_thres])
+    conf_floor = float(conf_grid.min())
 
-    for im in tqdm(imgs, desc='Predicting'):
-        res = y.predict(source=im, conf=args.conf_thres, iou=args.iou_thres, verbose=False)
-        boxes = []
-        for r in res:
-            for b in r.boxes:
-                boxes.append(b)
-        imgname = os.path.splitext(os.path.basename(im))[0]
-        preds_counts[imgname] = len(boxes)
+    # 💾 Raw detections keyed by model hash + settings, then image name + content hash
+    os.makedirs(args.cache_dir, exist_ok=True)
+    cpath = cache_path(args.cache_dir, file_digest(args.model), args.imgsz, conf_floor, tag=cache_tag)
+    entries = load_cache(cpath)
+    n_new = predict_missing(args.model, sources, entries, digests, conf_floor, args.imgsz, args.batch,
+                            MAX_CANDIDATES, scales)
+    if n_new:
+        save_cache(cpath, entries)
+    print(f"💾 Predictions: {len(sources) - n_new} cached, {n_new} computed ({cpath})")
 
-    common = set(gt_counts.keys()) & set(preds_counts.keys())
+    common = sorted(set(gt_counts.keys()) & set(sources))
     print(f"✅ Found {len(common)} matching images between ground truth and predictions.")
 
     if len(common) == 0:
         print("⚠️ No matching image names found — check image/label filenames or extensions.")
         print(f"Example GT files: {list(gt_counts.keys())[:5]}")
-        print(f"Example Pred files: {list(preds_counts.keys())[:5]}")
+        print(f"Example Pred files: {list(sources)[:5]}")
         exit()
 
-    y_gt = [gt_counts[k] for k in common]
-    y_pred = [preds_counts[k] for k in common]
+    # 🧮 Counts and metrics for the whole (iou, conf) grid at once
+    gt = np.array([gt_counts[k] for k in common], dtype=np.float64)
+    counts = count_grid(entries, common, conf_grid, iou_grid, args.max_det)
+    mae, rmse, r2 = count_metrics(gt, counts.astype(np.float64))
+    metrics = {'mae': mae, 'rmse': rmse, 'r2': r2}
 
- 
-    # 🔧 Convert all counts to plain floats to avoid type issues
-    y_gt = [float(v) for v in y_gt]
-    y_pred = [float(v) for v in y_pred]
+    def point(k, c):
+        return {'conf': float(conf_grid[c]), 'iou': float(iou_grid[k]),
+                'mae': float(mae[k, c]), 'rmse': float(rmse[k, c]), 'r2': float(r2[k, c])}
 
-    # 🧮 Compute metrics safely
-    try:
-        mae = mean_absolute_error(y_gt, y_pred)
-        mse = mean_squared_error(y_gt, y_pred)
-        rmse = mse ** 0.5
-        r2 = r2_score(y_gt, y_pred) if len(y_gt) > 1 else 0.0
-    except Exception as e:
-        print(f"⚠️ Metric computation failed: {e}")
-        print(f"y_gt: {y_gt}")
-        print(f"y_pred: {y_pred}")
-        mae = rmse = r2 = 0.0
-
-    out = {'mae': float(mae), 'rmse': float(rmse), 'r2': float(r2), 'n_images': len(common)}
-    print("📊 Counting metrics:", out)
-
-    with open('counting_report.json', 'w') as f:
+    sel = metrics[args.select]
+    k_best, c_best = np.unravel_index(np.argmax(sel) if args.select == 'r2' else np.argmin(sel), sel.shape)
+    best = point(k_best, c_best)
+    k_req = int(np.flatnonzero(np.isclose(iou_grid, args.iou_thres))[0])
+    c_req = int(np.flatnonzero(np.isclose(conf_grid, args.conf_thres))[0])
+
+    out = {**point(k_req, c_req), 'n_images': len(common), 'best': best}
+    del out['conf'], out['iou']
+    print("📊 Counting metrics:", {k: out[k] for k in ('mae', 'rmse', 'r2', 'n_images')})
+    print(f"🎯 Best {args.select.upper()}: conf={best['conf']:g} iou={best['iou']:g} "
+          f"mae={best['mae']:.3f} rmse={best['rmse']:.3f} r2={best['r2']:.3f}")
+
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'counting_report.json'), 'w') as f:
         json.dump(out, f, indent=2)
+    with open(os.path.join(args.out, 'counting_sweep.csv'), 'w') as f:
+        f.write('iou,conf,mae,rmse,r2\n')
+        for k in range(len(iou_grid)):
+            for c in range(len(conf_grid)):
+                f.write(f'{iou_grid[k]:g},{conf_grid[c]:g},{mae[k, c]:.4f},{rmse[k, c]:.4f},{r2[k, c]:.4f}\n')
+    if save_curve(os.path.join(args.out, 'counting_sweep.png'), conf_grid, iou_grid, sel, args.select, best):
+        print(f"📈 Saved sweep curve to {os.path.join(args.out, 'counting_sweep.png')}")
 
-    print("⚙️ Running detection validation...")
-    y.val(data=args.data, conf=args.conf_thres, iou=args.iou_thres)
+    if not args.no_val:
+        from ultralytics import YOLO
+        print("⚙️ Running detection validation...")
+        if args.shards:
+            from shards import ShardValidator
+            YOLO(args.model, task='detect').val(data=os.path.join(args.shards, 'data.yaml'), conf=args.conf_thres,
+                                                iou=args.iou_thres, validator=ShardValidator)
+        else:
+            YOLO(args.model, task='detect').val(data=args.data, conf=args.conf_thres, iou=args.iou_thres)
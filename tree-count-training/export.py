@@ -1,13 +1,262 @@
+import argparse, os, glob, json, random, shutil, time
+import numpy as np
 
-import argparse
-from ultralytics import YOLO
+# Export pipeline for CPU serving: the trained .pt is exported to a
+# dynamic-batch fp32 ONNX, quantized to INT8 (static, QDQ) with activation
+# ranges calibrated on a sample of training images, and every artifact is
+# then benchmarked (latency per batch size, throughput, peak RSS) and scored
+# with the counting metrics from evaluate.py, so one table shows what each
+# deployment option costs and how many trees it gets wrong.
+
+def letterbox(im, imgsz, color=114):
+    """Resize (keeping aspect) and center-pad to imgsz x imgsz, like ultralytics LetterBox"""
+    import cv2
+    h, w = im.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    nh, nw = int(round(h * r)), int(round(w * r))
+    if (nh, nw) != (h, w):
+        im = cv2.resize(im, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    out = np.full((imgsz, imgsz, 3), color, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = im
+    return out
+
+def to_input(im, imgsz):
+    """BGR uint8 image -> (1, 3, imgsz, imgsz) float32 RGB in [0, 1]"""
+    x = letterbox(im, imgsz)[:, :, ::-1].transpose(2, 0, 1)
+    return np.ascontiguousarray(x, dtype=np.float32)[None] / 255.0
+
+def calibration_images(data_yaml, n, seed=0):
+    from shards import dataset_splits, IMAGE_EXTS
+    _, splits = dataset_splits(data_yaml)
+    if 'train' not in splits:
+        raise FileNotFoundError(f"No train split in {data_yaml} to calibrate on")
+    imgs = sorted(f for f in glob.glob(os.path.join(splits['train'][0], '*')) if f.lower().endswith(IMAGE_EXTS))
+    random.Random(seed).shuffle(imgs)
+    return imgs[:n]
+
+# ---------- export ----------
+
+def export_fp32(weights, out_dir, imgsz, opset=None, simplify=False):
+    """Dynamic batch (and spatial size) ONNX export"""
+    from ultralytics import YOLO
+    # ultralytics writes next to the weights; export a copy so an existing
+    # models/best.onnx is never overwritten
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    tmp = os.path.join(out_dir, stem + '.pt')
+    shutil.copy(weights, tmp)
+    try:
+        path = YOLO(tmp).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=simplify, opset=opset)
+    finally:
+        os.remove(tmp)
+    dst = os.path.join(out_dir, stem + '_fp32.onnx')
+    os.replace(path, dst)
+    return dst
+
+def head_nodes(model):
+    """Non-conv nodes of the detect head (box decoding, DFL softmax, concat):
+    their value ranges are too wide for a shared int8 scale and they are
+    cheap, so they stay in float"""
+    prefixes = sorted({n.name.split('/')[1] for n in model.graph.node if n.name.startswith('/model.')},
+                      key=lambda p: int(p.split('.')[1]))
+    last = f'/{prefixes[-1]}/' if prefixes else None
+    return [n.name for n in model.graph.node
+            if (last and n.name.startswith(last) and n.op_type != 'Conv') or not n.name.startswith('/model.')]
+
+def quantize_int8(fp32_path, images, imgsz, method='minmax', per_channel=True, keep_head_fp32=True):
+    """Static INT8 quantization (QDQ) calibrated on `images`"""
+    import cv2, onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.it = iter(images)
+
+        def get_next(self):
+            for f in self.it:
+                im = cv2.imread(f)
+                if im is not None:
+                    return {'images': to_input(im, imgsz)}
+            return None
+
+    src = fp32_path
+    prep = fp32_path.replace('_fp32.onnx', '_prep.onnx')
+    try:
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        quant_pre_process(fp32_path, prep, skip_symbolic_shape=True)
+        src = prep
+    except Exception as e:
+        print(f"⚠️ Pre-processing skipped ({e})")
+    model = onnx.load(src)
+    dst = fp32_path.replace('_fp32.onnx', '_int8.onnx')
+    quantize_static(src, dst, Reader(), quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method={'minmax': CalibrationMethod.MinMax, 'entropy': CalibrationMethod.Entropy,
+                                      'percentile': CalibrationMethod.Percentile}[method],
+                    nodes_to_exclude=head_nodes(model) if keep_head_fp32 else [])
+    # ultralytics reads names/stride/imgsz from the metadata; quantization drops it
+    q = onnx.load(dst)
+    del q.metadata_props[:]
+    q.metadata_props.extend(onnx.load(fp32_path).metadata_props)
+    q.metadata_props.add(key='precision', value='int8')
+    onnx.save(q, dst)
+    if src == prep:
+        os.remove(prep)
+    return dst
+
+# ---------- benchmark ----------
+
+def reset_peak_rss():
+    """Restart this process's high-water mark (Linux); False where unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """VmHWM of this process in MB, None where /proc is unavailable"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def bench_artifact(path, imgsz, batch_sizes, runs, warmup):
+    """Runs in a fresh process. A spawned child inherits its parent's
+    ru_maxrss, so the peak is reset here and read from VmHWM instead."""
+    measured = reset_peak_rss()
+    from ultralytics import YOLO
+    y = YOLO(path, task='detect')
+    rng = np.random.default_rng(0)
+    latency = {}
+    for bs in batch_sizes:
+        imgs = [rng.integers(0, 255, (imgsz, imgsz, 3), dtype=np.uint8) for _ in range(bs)]
+        for _ in range(warmup):
+            y.predict(imgs, imgsz=imgsz, batch=bs, verbose=False)
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            y.predict(imgs, imgsz=imgsz, batch=bs, verbose=False)
+            times.append((time.perf_counter() - started) * 1000)
+        latency[bs] = float(np.median(times))
+    return {
+        'latency_ms': latency,
+        'throughput': max(bs * 1000 / ms for bs, ms in latency.items()),
+        'peak_rss_mb': peak_rss_mb() if measured else None,
+    }
+
+def count_accuracy(path, data_yaml, imgsz, conf, iou, batch, cache_dir):
+    """MAE/RMSE/R2 on the test split at one operating point, via evaluate.py
+    (predictions land in the same cache evaluate.py uses)"""
+    from evaluate import (MAX_CANDIDATES, cache_path, count_grid, count_metrics, file_digest, gt_counts_from_labels,
+                          img_key, load_cache, predict_missing, save_cache)
+    from shards import dataset_splits, IMAGE_EXTS
+    _, splits = dataset_splits(data_yaml)
+    images_dir, labels_dir = splits.get('test') or splits['val']
+    imgs = sorted(f for f in glob.glob(os.path.join(images_dir, '*')) if f.lower().endswith(IMAGE_EXTS))
+    gt_counts = gt_counts_from_labels(labels_dir)
+    sources = {img_key(im): im for im in imgs}
+    digests = {img_key(im): file_digest(im) for im in imgs}
+    os.makedirs(cache_dir, exist_ok=True)
+    cpath = cache_path(cache_dir, file_digest(path), imgsz, conf)
+    entries = load_cache(cpath)
+    if predict_missing(path, sources, entries, digests, conf, imgsz, batch, MAX_CANDIDATES):
+        save_cache(cpath, entries)
+    common = sorted(set(gt_counts) & set(sources))
+    gt = np.array([gt_counts[k] for k in common], dtype=np.float64)
+    counts = count_grid(entries, common, np.array([conf]), np.array([iou]), 1000)
+    mae, rmse, r2 = count_metrics(gt, counts.astype(np.float64))
+    return {'mae': float(mae[0, 0]), 'rmse': float(rmse[0, 0]), 'r2': float(r2[0, 0]), 'n_images': len(common)}
+
+def choose(rows, tolerance):
+    """Fastest artifact whose MAE is within `tolerance` trees of the .pt reference"""
+    ref = rows[0]['mae']
+    ok = [r for r in rows if r['mae'] <= ref + tolerance]
+    return max(ok, key=lambda r: r['throughput'])
+
+def markdown_table(rows, batch_sizes, chosen):
+    head = ['artifact', 'MB'] + [f'bs{bs} ms' for bs in batch_sizes] + ['img/s', 'peak RSS MB', 'MAE', 'RMSE', 'R2']
+    lines = ['| ' + ' | '.join(head) + ' |', '|' + '---|' * len(head)]
+    for r in rows:
+        name = os.path.basename(r['path']) + (' ✅' if r is chosen else '')
+        cells = [name, f"{r['size_mb']:.1f}"] + [f"{r['latency_ms'][bs]:.1f}" for bs in batch_sizes]
+        cells += [f"{r['throughput']:.1f}", f"{r['peak_rss_mb']:.0f}" if r['peak_rss_mb'] is not None else 'n/a', f"{r['mae']:.2f}", f"{r['rmse']:.2f}",
+                  f"{r['r2']:.3f}"]
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines)
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument('--weights', required=True)
     p.add_argument('--format', default='onnx', choices=['onnx','torchscript','pb'])
     p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--data', default='data/data.yaml', help='dataset for calibration (train) and accuracy (test)')
+    p.add_argument('--out', default='exports', help='directory for the artifacts and the report')
+    p.add_argument('--opset', type=int, default=None)
+    p.add_argument('--simplify', action='store_true', help='run onnxslim on the fp32 export')
+    p.add_argument('--no_int8', action='store_true')
+    p.add_argument('--calib_images', type=int, default=200, help='training images used for calibration')
+    p.add_argument('--calib_method', default='minmax', choices=['minmax', 'entropy', 'percentile'])
+    p.add_argument('--no_per_channel', action='store_true')
+    p.add_argument('--quantize_head', action='store_true', help='also quantize the detect head (less accurate)')
+    p.add_argument('--batch_sizes', default='1,4,8')
+    p.add_argument('--runs', type=int, default=10, help='timed runs per batch size')
+    p.add_argument('--warmup', type=int, default=2)
+    p.add_argument('--conf_thres', type=float, default=0.25)
+    p.add_argument('--iou_thres', type=float, default=0.45)
+    p.add_argument('--cache_dir', default='eval_cache')
+    p.add_argument('--mae_tolerance', type=float, default=0.5, help='max MAE increase over the .pt to be chosen')
+    p.add_argument('--deploy', default=None, help='copy the chosen artifact here (e.g. ../models/best.onnx)')
+    p.add_argument('--no_bench', action='store_true', help='only export')
     args = p.parse_args()
-    y = YOLO(args.weights)
-    print("Exporting to", args.format)
-    y.export(format=args.format, imgsz=args.imgsz)
\ No newline at end of file
+
+    if args.format != 'onnx':
+        from ultralytics import YOLO
+        print("Exporting to", args.format)
+        YOLO(args.weights).export(format=args.format, imgsz=args.imgsz)
+        raise SystemExit
+
+    os.makedirs(args.out, exist_ok=True)
+    print("📦 Exporting dynamic-batch ONNX (fp32)")
+    artifacts = [args.weights, export_fp32(args.weights, args.out, args.imgsz, args.opset, args.simplify)]
+    if not args.no_int8:
+        calib = calibration_images(args.data, args.calib_images)
+        print(f"📦 Quantizing to INT8, calibrating on {len(calib)} training images ({args.calib_method})")
+        artifacts.append(quantize_int8(artifacts[1], calib, args.imgsz, args.calib_method,
+                                       not args.no_per_channel, not args.quantize_head))
+    for a in artifacts[1:]:
+        print(f"✅ {a} ({os.path.getsize(a) / 1e6:.1f} MB)")
+    if args.no_bench:
+        raise SystemExit
+
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing as mp
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    rows = []
+    for a in artifacts:
+        print(f"⏱️ Benchmarking {a}")
+        with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+            row = pool.submit(bench_artifact, a, args.imgsz, batch_sizes, args.runs, args.warmup).result()
+        row.update(count_accuracy(a, args.data, args.imgsz, args.conf_thres, args.iou_thres, max(batch_sizes),
+                                  args.cache_dir))
+        row.update(path=a, size_mb=os.path.getsize(a) / 1e6)
+        rows.append(row)
+
+    chosen = choose(rows, args.mae_tolerance)
+    table = markdown_table(rows, batch_sizes, chosen)
+    print(table)
+    print(f"🎯 Chosen: {chosen['path']} (fastest within {args.mae_tolerance:g} MAE of the .pt)")
+    with open(os.path.join(args.out, 'export_report.json'), 'w') as f:
+        json.dump({'imgsz': args.imgsz, 'conf': args.conf_thres, 'iou': args.iou_thres, 'artifacts': rows,
+                   'chosen': chosen['path']}, f, indent=2)
+    with open(os.path.join(args.out, 'export_report.md'), 'w') as f:
+        f.write(table + '\n')
+    if args.deploy:
+        shutil.copy(chosen['path'], args.deploy)
+        print(f"🚀 Copied {chosen['path']} -> {args.deploy}")
@@ -0,0 +1,320 @@
+import os, json, glob, hashlib, math, random, time, yaml
+import cv2
+import numpy as np
+
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+from ultralytics.utils import colorstr
+
+from data_prep import IMAGE_EXTS, read_yolo_labels
+
+# Packed dataset format: the JPEG decode + resize ultralytics does for every
+# image on every epoch is done once here. Each split directory holds
+#   images_000.npy ...  flat uint8 shards of BGR pixels, resized so the long
+#                       side is `imgsz` (exactly what YOLODataset.load_image
+#                       produces), images stored back to back
+#   index.npz           names, source digests, shard id + byte offset + (h, w)
+#                       of every image, original (h0, w0), and the labels of
+#                       all images as one (M, 5) array sliced by label_offsets
+# Shards are opened with np.load(mmap_mode=...), so an image is a reshaped
+# view of the page cache: no decode, no resize, no copy.
+
+INDEX = 'index.npz'
+
+def load_yaml(p):
+    with open(p, 'r') as f:
+        return yaml.safe_load(f)
+
+def dataset_splits(data_yaml):
+    """{split: (images dir, labels dir)} for the splits a data.yaml defines"""
+    data = load_yaml(data_yaml)
+    root = data.get('path') or os.path.dirname(os.path.abspath(data_yaml))
+    if not os.path.isabs(root):
+        root = os.path.join(os.path.dirname(os.path.abspath(data_yaml)), root)
+    splits = {}
+    for split in ('train', 'val', 'test'):
+        rel = data.get(split)
+        if not rel:
+            continue
+        d = os.path.normpath(os.path.join(root, rel))
+        if not os.path.isdir(d):
+            # Roboflow exports use "../train/images" next to the data.yaml
+            d = os.path.join(root, rel.lstrip('./'))
+        if os.path.isdir(d):
+            splits[split] = (d, os.path.join(os.path.dirname(d), 'labels'))
+    return data, splits
+
+def resize_long_side(im, imgsz):
+    """Same resize as YOLODataset.load_image(rect_mode=True)"""
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = (min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz))
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+    return im
+
+# ---------- pack ----------
+
+def _pack_shard(task):
+    """Decode, resize and write one shard; returns its index rows"""
+    shard_id, out_dir, items, imgsz = task
+    ims, rows = [], []
+    for img_path, label_path in items:
+        raw = np.fromfile(img_path, dtype=np.uint8)
+        im = cv2.imdecode(raw, cv2.IMREAD_COLOR)
+        if im is None:
+            print(f"⚠️ Skipping unreadable image {img_path}")
+            continue
+        h0, w0 = im.shape[:2]
+        im = resize_long_side(im, imgsz)
+        ims.append(im)
+        rows.append((os.path.splitext(os.path.basename(img_path))[0],
+                     hashlib.blake2b(raw.tobytes(), digest_size=16).hexdigest(),
+                     im.shape[0], im.shape[1], h0, w0, read_yolo_labels(label_path)))
+    sizes = [im.size for im in ims]
+    path = os.path.join(out_dir, f'images_{shard_id:03d}.npy')
+    arr = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8, shape=(max(1, sum(sizes)),))
+    offset = 0
+    for im, n in zip(ims, sizes):
+        arr[offset:offset + n] = im.reshape(-1)
+        offset += n
+    arr.flush()
+    del arr
+    os.replace(path + '.tmp', path)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64) if sizes else np.zeros(0, np.int64)
+    return shard_id, rows, offsets
+
+def pack_split(images_dir, labels_dir, out_dir, imgsz=640, shard_size=256, workers=None):
+    """Pack one split into `out_dir`; returns the number of images"""
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(out_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(out_dir, 'images_*.npy')):
+        os.remove(old)
+    imgs = sorted(f for f in glob.glob(os.path.join(images_dir, '*')) if f.lower().endswith(IMAGE_EXTS))
+    items = [(f, os.path.join(labels_dir, os.path.splitext(os.path.basename(f))[0] + '.txt')) for f in imgs]
+    tasks = [(k, out_dir, items[i:i + shard_size], imgsz) for k, i in enumerate(range(0, len(items), shard_size))]
+
+    names, digests, shard, offset, hw, hw0, labels = [], [], [], [], [], [], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard_id, rows, offs in pool.map(_pack_shard, tasks):
+            for (name, digest, h, w, h0, w0, lb), off in zip(rows, offs):
+                names.append(name)
+                digests.append(digest)
+                shard.append(shard_id)
+                offset.append(off)
+                hw.append((h, w))
+                hw0.append((h0, w0))
+                labels.append(lb)
+            print(f"  {os.path.basename(out_dir)}: shard {shard_id + 1}/{len(tasks)}")
+    label_offsets = np.concatenate([[0], np.cumsum([len(lb) for lb in labels])]).astype(np.int64)
+    np.savez(os.path.join(out_dir, INDEX), imgsz=imgsz, names=np.array(names), digests=np.array(digests),
+             shard=np.array(shard, dtype=np.int32), offset=np.array(offset, dtype=np.int64),
+             hw=np.array(hw, dtype=np.int32).reshape(-1, 2), hw0=np.array(hw0, dtype=np.int32).reshape(-1, 2),
+             label_offsets=label_offsets,
+             labels=np.concatenate(labels).astype(np.float32) if labels else np.zeros((0, 5), np.float32))
+    return len(names)
+
+def pack_dataset(data_yaml, dst, imgsz=640, shard_size=256, workers=None):
+    """Pack every split of a YOLO data.yaml and write a data.yaml for the shards"""
+    data, splits = dataset_splits(data_yaml)
+    if not splits:
+        raise FileNotFoundError(f"No split directories found for {data_yaml}")
+    content = {'path': os.path.abspath(dst)}
+    for split, (images_dir, labels_dir) in splits.items():
+        started = time.perf_counter()
+        n = pack_split(images_dir, labels_dir, os.path.join(dst, split), imgsz, shard_size, workers)
+        print(f"✅ Packed {n} {split} images in {time.perf_counter() - started:.1f}s")
+        content[split] = split
+    content.update(nc=data.get('nc', len(data.get('names', []))), names=data.get('names'), shards=True)
+    with open(os.path.join(dst, 'data.yaml'), 'w') as f:
+        yaml.dump(content, f)
+    print("Wrote", os.path.join(dst, 'data.yaml'))
+
+# ---------- read ----------
+
+class ShardSet:
+    """Read side of one packed split. Shards are opened lazily in each
+    process (so DataLoader workers map them themselves instead of pickling
+    arrays); `mmap_mode='c'` lets in-place augmentations write to private
+    pages without touching the files."""
+
+    def __init__(self, split_dir, mmap_mode='r'):
+        self.split_dir = split_dir
+        self.mmap_mode = mmap_mode
+        z = np.load(os.path.join(split_dir, INDEX), allow_pickle=False)
+        self.imgsz = int(z['imgsz'])
+        self.names = [str(n) for n in z['names']]
+        self.digests = [str(d) for d in z['digests']]
+        self.shard, self.offset = z['shard'], z['offset']
+        self.hw, self.hw0 = z['hw'], z['hw0']
+        self.label_offsets, self.all_labels = z['label_offsets'], z['labels']
+        self._shards = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def image(self, i):
+        """(h, w, 3) BGR view into the shard"""
+        if self._shards is None:
+            n = int(self.shard.max()) + 1 if len(self.shard) else 0
+            self._shards = [np.load(os.path.join(self.split_dir, f'images_{k:03d}.npy'), mmap_mode=self.mmap_mode)
+                            for k in range(n)]
+        h, w = self.hw[i]
+        start = self.offset[i]
+        return self._shards[self.shard[i]][start:start + h * w * 3].reshape(h, w, 3)
+
+    def labels(self, i):
+        """(K, 5) cls, xc, yc, w, h (normalized) view"""
+        return self.all_labels[self.label_offsets[i]:self.label_offsets[i + 1]]
+
+    def counts(self):
+        return np.diff(self.label_offsets)
+
+def is_packed(path):
+    return os.path.exists(os.path.join(path, INDEX))
+
+class ShardDataset(YOLODataset):
+    """YOLODataset that takes images and labels from a packed split instead
+    of decoding JPEGs and scanning label files"""
+
+    def __init__(self, *args, **kwargs):
+        self.shards = ShardSet(kwargs['img_path'], mmap_mode='c' if kwargs.get('augment') else 'r')
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        return [os.path.join(img_path, n + '.jpg') for n in self.shards.names]
+
+    def get_labels(self):
+        self.label_files = []
+        labels = []
+        for i, f in enumerate(self.im_files):
+            lb = self.shards.labels(i)
+            labels.append(dict(im_file=f, shape=tuple(int(v) for v in self.shards.hw0[i]),
+                               cls=lb[:, :1].copy(), bboxes=lb[:, 1:].copy(), segments=[], keypoints=None,
+                               normalized=True, bbox_format='xywh'))
+        if not labels:
+            raise RuntimeError(f"No images in {self.img_path}")
+        return labels
+
+    def load_image(self, i, rect_mode=True, resize_short=False):
+        if self.ims[i] is not None:  # cache='ram'
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+        im = self.shards.image(i)
+        h0, w0 = (int(v) for v in self.shards.hw0[i])
+        if rect_mode:
+            if resize_short:
+                r = self.imgsz / min(h0, w0)
+                w, h = math.ceil(w0 * r), math.ceil(h0 * r)
+            else:
+                r = self.imgsz / max(h0, w0)
+                w, h = min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz)
+            if im.shape[:2] != (h, w):  # packed at a different imgsz
+                im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+        elif im.shape[:2] != (self.imgsz, self.imgsz):
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        # Mosaic samples partner images from the buffer; pixels stay in the page cache
+        if self.augment:
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, (h0, w0), im.shape[:2]
+
+def build_shard_dataset(cfg, img_path, batch, data, mode='train', rect=False, stride=32):
+    """build_yolo_dataset() for packed splits"""
+    return ShardDataset(
+        img_path=img_path,
+        imgsz=cfg.imgsz,
+        batch_size=batch,
+        augment=mode == 'train',
+        hyp=cfg,
+        rect=cfg.rect or rect,
+        cache=cfg.cache or None,
+        single_cls=cfg.single_cls or False,
+        stride=stride,
+        pad=0.0 if mode == 'train' else 0.5,
+        prefix=colorstr(f'{mode}: '),
+        task=cfg.task,
+        classes=cfg.classes,
+        data=data,
+        fraction=cfg.fraction if mode == 'train' else 1.0,
+    )
+
+class ShardTrainer(DetectionTrainer):
+    def build_dataset(self, img_path, mode='train', batch=None):
+        from ultralytics.utils.torch_utils import unwrap_model
+        gs = max(int(unwrap_model(self.model).stride.max()), 32)
+        return build_shard_dataset(self.args, img_path, batch, self.data, mode=mode, rect=mode == 'val', stride=gs)
+
+class ShardValidator(DetectionValidator):
+    def build_dataset(self, img_path, mode='val', batch=None):
+        return build_shard_dataset(self.args, img_path, batch, self.data, mode=mode, stride=self.stride)
+
+# ---------- loader benchmark ----------
+
+def loader_rate(dataset, n, fn):
+    """Random-access items/sec. The mosaic buffer is dropped before every
+    item so the JPEG path decodes like it does on a dataset much larger than
+    its buffer (a small set otherwise ends up held in RAM after one pass)."""
+    idx = [random.randrange(len(dataset)) for _ in range(n)]
+    started = time.perf_counter()
+    for i in idx:
+        for j in dataset.buffer:
+            dataset.ims[j] = None
+        fn(dataset, i)
+    return n / (time.perf_counter() - started)
+
+def bench(data_yaml, shards_dir, split='train', imgsz=640, n=200, workers=0, batch=16):
+    """Images/sec of the JPEG loader vs the shard loader on the same split"""
+    from ultralytics.cfg import get_cfg
+    from ultralytics.data import build_yolo_dataset, build_dataloader
+    from ultralytics.data.utils import check_det_dataset
+    cfg = get_cfg(overrides=dict(imgsz=imgsz, task='detect'))
+    results = {}
+    variants = (('jpeg', data_yaml, build_yolo_dataset), ('shards', os.path.join(shards_dir, 'data.yaml'),
+                                                          build_shard_dataset))
+    for name, yaml_path, build in variants:
+        data = check_det_dataset(yaml_path)
+        ds = build(cfg, data[split], batch, data, mode='train')
+        random.seed(0)
+        row = {
+            'load_image': loader_rate(ds, n, lambda d, i: d.load_image(i)),
+            'getitem': loader_rate(ds, n, lambda d, i: d[i]),
+        }
+        if workers:
+            loader = build_dataloader(ds, batch, workers, shuffle=True)
+            it, seen = iter(loader), 0
+            next(it)  # worker start-up
+            started = time.perf_counter()
+            for b in it:
+                seen += len(b['im_file'])
+                if seen >= n:
+                    break
+            row['dataloader'] = seen / (time.perf_counter() - started)
+        results[name] = row
+        print(f"  {name:>6}: " + ", ".join(f"{k} {v:.1f} img/s" for k, v in row.items()))
+    for k in results['jpeg']:
+        print(f"⚡ {k}: {results['shards'][k] / results['jpeg'][k]:.2f}x")
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('--mode', default='pack', choices=['pack', 'bench'])
+    p.add_argument('--data', required=True, help='data.yaml of the YOLO dataset')
+    p.add_argument('--dst', default='./data/shards', help='output directory for the packed dataset')
+    p.add_argument('--imgsz', default=640, type=int, help='long side the images are resized to')
+    p.add_argument('--shard_size', default=256, type=int, help='images per shard file')
+    p.add_argument('--workers', default=None, type=int, help='pack processes / bench DataLoader workers')
+    p.add_argument('--split', default='train')
+    p.add_argument('--n', default=200, type=int, help='images per bench measurement')
+    args = p.parse_args()
+    if args.mode == 'pack':
+        pack_dataset(args.data, args.dst, args.imgsz, args.shard_size, args.workers)
+    else:
+        res = bench(args.data, args.dst, args.split, args.imgsz, args.n, args.workers or 0)
+        print(json.dumps(res, indent=2))
@@ -19,6 +19,7 @@ if __name__ == '__main__':
     p.add_argument('--save_period', type=int, default=5)
     p.add_argument('--resume', action='store_true')
     p.add_argument('--wandb', action='store_true')
+    p.add_argument('--shards', default=None, help='packed dataset dir from shards.py (used instead of --data images)')
     args = p.parse_args()
 
     project_dir = args.project or os.path.join(os.path.dirname(args.data), '..','experiments')
@@ -34,7 +35,7 @@ if __name__ == '__main__':
     y = YOLO(args.model)
     # training is passed as a dict to y.train
     train_params = dict(
-        data=args.data,
+        data=os.path.join(args.shards, 'data.yaml') if args.shards else args.data,
         epochs=args.epochs,
         batch=args.batch,
         imgsz=args.imgsz,
@@ -53,4 +54,9 @@ if __name__ == '__main__':
         os.environ['WANDB_MODE'] = 'online'
 
     print("Starting training with params:", train_params)
-    y.train(**train_params)
\ No newline at end of file
+    if args.shards:
+        # images come pre-decoded from memory-mapped shards
+        from shards import ShardTrainer
+        y.train(trainer=ShardTrainer, **train_params)
+    else:
+        y.train(**train_params)
\ No newline at end of file
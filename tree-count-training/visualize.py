@@ -1,43 +1,214 @@
+import os, argparse, glob, json, csv
+import cv2, numpy as np
 
-import os, argparse, yaml, json
-import cv2, numpy as np, matplotlib.pyplot as plt
-from sklearn.metrics import precision_recall_curve, mean_absolute_error
-from ultralytics import YOLO
+# Draws predictions for a whole split without repeating inference when it
+# can be avoided. Detections come from (in order of preference)
+#   --detections  an evaluate.py cache (.npz, raw boxes: conf filter + NMS
+#                 are applied here) or `models/app.py --save_boxes` output
+#                 (.jsonl / .csv / .parquet)
+#   --model       the evaluate.py cache for that model in --cache_dir; images
+#                 it doesn't cover are predicted in batches and added to it
+# Rendering runs in a process pool. Boxes are drawn with one polylines call
+# per confidence bin instead of one call per box.
 
-def draw_boxes(img_path, boxes, scores=None, labels=None, out_path=None):
-    im = cv2.imread(img_path)
-    for i,box in enumerate(boxes):
-        x1,y1,x2,y2 = map(int, box)
-        cv2.rectangle(im, (x1,y1), (x2,y2), (0,255,0), 2)
-        caption = f"{scores[i]:.2f}" if scores is not None else ""
-        cv2.putText(im, caption, (x1, max(0,y1-5)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 1)
-    if out_path:
-        cv2.imwrite(out_path, im)
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+N_BINS = 10
+# BGR, low -> high confidence
+PALETTE = [tuple(int(c) for c in px) for px in
+           cv2.applyColorMap(np.linspace(0, 255, N_BINS).astype(np.uint8)[:, None], cv2.COLORMAP_PLASMA)[:, 0]]
+GT_COLOR = (0, 255, 0)
+
+def stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+# ---------- detections ----------
+
+def read_app_rows(path):
+    """Rows of models/app.py output (boxes as a list or a JSON string)"""
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pylist()
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_detections(path):
+    """key -> (boxes Nx4, scores N, raw); raw detections still need NMS"""
+    if path.endswith('.npz'):
+        from evaluate import load_cache
+        return {k: (b, s, True) for k, (_, b, s) in load_cache(path).items()}
+    dets = {}
+    for row in read_app_rows(path):
+        boxes = row.get('boxes')
+        if boxes is None:
+            raise ValueError(f"{path} has no boxes; re-run models/app.py with --save_boxes")
+        if isinstance(boxes, str):
+            boxes = json.loads(boxes) if boxes else []
+        arr = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+        dets[os.path.abspath(row['file'])] = (arr[:, :4], arr[:, 4], False)
+    return dets
+
+def find_cache(cache_dir, model_hash, imgsz, conf, max_det):
+    """Reuse an evaluate.py cache whose confidence floor is <= conf"""
+    best = None
+    for f in glob.glob(os.path.join(cache_dir, f'{model_hash}_{imgsz}_*_{max_det}.npz')):
+        try:
+            floor = float(os.path.basename(f)[:-4].split('_')[2])
+        except ValueError:
+            continue
+        if floor <= conf and (best is None or floor > best[0]):
+            best = (floor, f)
+    return best
+
+def select(boxes, scores, raw, conf, iou, max_det=None):
+    keep = scores >= conf
+    boxes, scores = boxes[keep], scores[keep]
+    if raw and len(scores):
+        from evaluate import overlap_pairs, greedy_keep
+        order = np.argsort(-scores, kind='stable')
+        boxes, scores = boxes[order], scores[order]
+        k = greedy_keep(len(scores), overlap_pairs(boxes, iou), iou)
+        boxes, scores = boxes[k][:max_det], scores[k][:max_det]
+    return boxes, scores
+
+def model_detections(model, imgs, cache_dir, conf, imgsz, batch):
+    """Detections from the evaluate.py cache, predicting only what's missing"""
+    from evaluate import MAX_CANDIDATES, file_digest, img_key, load_cache, save_cache, cache_path, predict_missing
+    os.makedirs(cache_dir, exist_ok=True)
+    model_hash = file_digest(model)
+    found = find_cache(cache_dir, model_hash, imgsz, conf, MAX_CANDIDATES)
+    cpath = found[1] if found else cache_path(cache_dir, model_hash, imgsz, conf)
+    floor = found[0] if found else conf
+    entries = load_cache(cpath)
+    sources = {img_key(im): im for im in imgs}
+    digests = {img_key(im): file_digest(im) for im in imgs}
+    n_new = predict_missing(model, sources, entries, digests, floor, imgsz, batch, MAX_CANDIDATES)
+    if n_new:
+        save_cache(cpath, entries)
+    print(f"💾 Detections: {len(imgs) - n_new} from cache, {n_new} predicted ({cpath})")
+    return {k: (b, s, True) for k, (_, b, s) in entries.items()}
+
+# ---------- rendering ----------
+
+def draw_boxes(im, boxes, scores=None, color=None, thickness=2, labels=False):
+    """Draw all boxes in place: one polylines call per color"""
+    if len(boxes) == 0:
+        return im
+    b = np.round(boxes).astype(np.int32)
+    polys = np.stack([b[:, [0, 1]], b[:, [2, 1]], b[:, [2, 3]], b[:, [0, 3]]], axis=1)
+    if color is not None or scores is None:
+        cv2.polylines(im, list(polys), True, color or GT_COLOR, thickness)
+    else:
+        bins = np.minimum((scores * N_BINS).astype(int), N_BINS - 1)
+        for k in np.unique(bins):
+            cv2.polylines(im, list(polys[bins == k]), True, PALETTE[k], thickness)
+    if labels and scores is not None:
+        for (x1, y1), s in zip(b[:, :2], scores):
+            cv2.putText(im, f'{s:.2f}', (int(x1), max(10, int(y1) - 3)), cv2.FONT_HERSHEY_SIMPLEX, 0.4,
+                        (255, 255, 255), 1, cv2.LINE_AA)
     return im
 
+def header(im, text):
+    bar = np.zeros((28, im.shape[1], 3), dtype=np.uint8)
+    cv2.putText(bar, text, (8, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
+    return np.vstack([bar, im])
+
+def read_gt(label_path, w, h):
+    """YOLO label file -> (N, 4) xyxy pixels"""
+    if not label_path or not os.path.exists(label_path) or os.path.getsize(label_path) == 0:
+        return np.zeros((0, 4), np.float32)
+    rows = np.loadtxt(label_path, dtype=np.float32, ndmin=2)[:, 1:5]
+    xy, wh = rows[:, :2] * (w, h), rows[:, 2:4] * (w, h)
+    return np.hstack([xy - wh / 2, xy + wh / 2])
+
+def render(task):
+    img_path, label_path, boxes, scores, opts = task
+    im = cv2.imread(img_path)
+    if im is None:
+        return stem(img_path), None, None
+    h, w = im.shape[:2]
+    gt = read_gt(label_path, w, h) if opts['gt'] else None
+    pred = draw_boxes(im.copy() if gt is not None else im, boxes, scores, thickness=opts['thickness'],
+                      labels=opts['labels'])
+    if gt is not None:
+        left = header(draw_boxes(im, gt, thickness=opts['thickness']), f'GT: {len(gt)}')
+        right = header(pred, f'Pred: {len(scores)}  (err {len(scores) - len(gt):+d})')
+        out = np.hstack([left, np.full((left.shape[0], 4, 3), 255, np.uint8), right])
+    else:
+        out = header(pred, f'Pred: {len(scores)}')
+    name = stem(img_path) + '.jpg'
+    cv2.imwrite(os.path.join(opts['out'], name), out, [cv2.IMWRITE_JPEG_QUALITY, opts['quality']])
+    if opts['thumb']:
+        r = opts['thumb'] / max(out.shape[:2])
+        if r < 1:
+            out = cv2.resize(out, (round(out.shape[1] * r), round(out.shape[0] * r)), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(os.path.join(opts['out'], 'thumbs', name), out, [cv2.IMWRITE_JPEG_QUALITY, opts['quality']])
+    return stem(img_path), len(scores), None if gt is None else len(gt)
+
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
-    p.add_argument('--model', required=True)
-    p.add_argument('--data', required=True)
+    p.add_argument('--model', default=None, help='predict images without cached detections')
+    p.add_argument('--detections', default=None, help='evaluate.py cache (.npz) or models/app.py --save_boxes output')
+    p.add_argument('--data', default=None, help='data.yaml; draws the --split images')
+    p.add_argument('--split', default='test')
+    p.add_argument('--images', default=None, help='image dir or glob instead of --data')
     p.add_argument('--out', default='viz_out')
+    p.add_argument('--conf', type=float, default=0.25)
+    p.add_argument('--iou', type=float, default=0.45, help='NMS IoU for raw (evaluate cache) detections')
+    p.add_argument('--imgsz', type=int, default=640)
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--max_det', type=int, default=1000, help='boxes drawn per image after NMS')
+    p.add_argument('--cache_dir', default='eval_cache')
+    p.add_argument('--gt', action='store_true', help='side-by-side ground truth vs prediction panels')
+    p.add_argument('--thumb', type=int, default=0, help='also write thumbnails with this long side')
+    p.add_argument('--labels', action='store_true', help='print the score next to every box')
+    p.add_argument('--thickness', type=int, default=2)
+    p.add_argument('--quality', type=int, default=90, help='JPEG quality')
+    p.add_argument('--limit', type=int, default=None, help='only the first N images')
+    p.add_argument('--workers', type=int, default=None, help='render processes (default: CPU count)')
     args = p.parse_args()
-    os.makedirs(args.out, exist_ok=True)
-    y = YOLO(args.model)
-    with open(args.data, 'r') as f:
-        data = yaml.safe_load(f)
-    test_images_root = os.path.join(data['path'], data['test'])
-    import glob
-    imgs = glob.glob(os.path.join(test_images_root, '*'))[:50]
+
+    if args.images:
+        pattern = os.path.join(args.images, '*') if os.path.isdir(args.images) else args.images
+        imgs = glob.glob(pattern, recursive=True)
+        labels_dir = None
+    elif args.data:
+        from shards import dataset_splits
+        _, splits = dataset_splits(args.data)
+        if args.split not in splits:
+            raise FileNotFoundError(f"No '{args.split}' split in {args.data}")
+        images_dir, labels_dir = splits[args.split]
+        imgs = glob.glob(os.path.join(images_dir, '*'))
+    else:
+        p.error('pass --data or --images')
+    imgs = sorted(os.path.abspath(f) for f in imgs if f.lower().endswith(IMAGE_EXTS))[:args.limit]
+    if not imgs:
+        raise FileNotFoundError("No images to visualize")
+
+    dets = load_detections(args.detections) if args.detections else {}
+    missing = [im for im in imgs if im not in dets and stem(im) not in dets]
+    if missing and args.model:
+        dets.update(model_detections(args.model, missing, args.cache_dir, args.conf, args.imgsz, args.batch))
+    elif missing:
+        print(f"⚠️ {len(missing)} images have no detections (pass --model to predict them)")
+
+    os.makedirs(os.path.join(args.out, 'thumbs') if args.thumb else args.out, exist_ok=True)
+    opts = dict(out=args.out, gt=args.gt and labels_dir is not None, thumb=args.thumb, labels=args.labels,
+                thickness=args.thickness, quality=args.quality)
+    empty = (np.zeros((0, 4), np.float32), np.zeros(0, np.float32), False)
+    tasks = []
     for im in imgs:
-        res = y.predict(source=im, conf=0.25, verbose=False)
-        boxes=[]
-        scores=[]
-        for r in res:
-            for b in r.boxes:
-                xyxy = b.xyxy[0].cpu().numpy()
-                conf = float(b.conf[0].cpu().numpy())
-                boxes.append(xyxy)
-                scores.append(conf)
-        outp = os.path.join(args.out, os.path.basename(im))
-        draw_boxes(im, boxes, scores, out_path=outp)
-    print("Saved visualizations to", args.out)
\ No newline at end of file
+        boxes, scores = select(*dets.get(im, dets.get(stem(im), empty)), args.conf, args.iou, args.max_det)
+        label = os.path.join(labels_dir, stem(im) + '.txt') if labels_dir else None
+        tasks.append((im, label, boxes, scores, opts))
+
+    from concurrent.futures import ProcessPoolExecutor
+    summary = {}
+    with ProcessPoolExecutor(args.workers) as pool:
+        for name, n_pred, n_gt in pool.map(render, tasks, chunksize=max(1, len(tasks) // 64)):
+            if n_pred is not None:
+                summary[name] = {'pred': n_pred, 'gt': n_gt}
+    with open(os.path.join(args.out, 'counts.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    print(f"Saved {len(summary)} visualizations to", args.out)